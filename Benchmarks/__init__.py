@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The bot is started from inside Bot/, so its modules import each other as Pixiv.Source.<module>
+sys.path.append(str((Path(__file__).parent.parent / "Bot").resolve()))
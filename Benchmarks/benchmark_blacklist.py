@@ -0,0 +1,88 @@
+import argparse
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from pixivpy3.utils import JsonDict
+
+from Bot.Pixiv.Source.pixiv_blacklist import BlacklistMatcher
+
+
+# tags_in_blacklist before the blacklists were frozensets, a list scan per tag that never stops early
+def legacy_tags_in_blacklist(tags: list, blacklist: list) -> bool:
+    contains_banned_word = False
+    for tag_pair in tags:
+        if "name" in tag_pair:
+            if tag_pair["name"] in blacklist:
+                contains_banned_word = True
+        if "translated_name" in tag_pair:
+            if tag_pair["translated_name"] in blacklist:
+                contains_banned_word = True
+    return contains_banned_word
+
+
+# The three checks PixivDownloader ran per illustration
+def legacy_is_blocked(illustration, tags: list, nsfw_tags: list, artists: list) -> bool:
+    if str(illustration.user.id) in artists:
+        return True
+    if legacy_tags_in_blacklist(illustration.tags, tags):
+        return True
+    if legacy_tags_in_blacklist(illustration.tags, nsfw_tags) and illustration.x_restrict == 1:
+        return True
+    return False
+
+
+def build_illustrations(count: int, tags_per_illustration: int) -> list:
+    illustrations = []
+    for pixiv_image_id in range(count):
+        tags = [JsonDict({"name": "tag" + str(random.randint(1, 100000)),
+                          "translated_name": "translated" + str(random.randint(1, 100000))})
+                for _ in range(tags_per_illustration)]
+        illustrations.append(JsonDict({"id": pixiv_image_id, "x_restrict": random.randint(0, 1),
+                                       "user": JsonDict({"id": random.randint(1, 10 ** 8)}), "tags": tags}))
+    return illustrations
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per illustration cost of the blacklist checks.")
+    parser.add_argument("--entries", type=int, default=5000, help="entries per blacklist")
+    parser.add_argument("--illustrations", type=int, default=3000)
+    parser.add_argument("--tags-per-illustration", type=int, default=10)
+    args = parser.parse_args()
+
+    blacklists = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name, prefix in [("tags", "tag"), ("nsfw_tags", "translated"), ("artists", "")]:
+            blacklists[name] = [prefix + str(entry) for entry in random.sample(range(10 ** 6), args.entries)]
+            (Path(directory) / name).write_text("\n".join(blacklists[name]))
+
+        matcher = BlacklistMatcher(Path(directory) / "tags", Path(directory) / "nsfw_tags",
+                                   Path(directory) / "artists")
+
+        illustrations = build_illustrations(args.illustrations, args.tags_per_illustration)
+
+        start = time.perf_counter()
+        legacy_blocked = [legacy_is_blocked(illustration, blacklists["tags"], blacklists["nsfw_tags"],
+                                            blacklists["artists"])
+                          for illustration in illustrations]
+        legacy_us = (time.perf_counter() - start) / len(illustrations) * 10 ** 6
+
+        start = time.perf_counter()
+        blocked = [matcher.blocked_reason(illustration) is not None for illustration in illustrations]
+        matcher_us = (time.perf_counter() - start) / len(illustrations) * 10 ** 6
+
+        start = time.perf_counter()
+        for _ in range(100):
+            matcher.reload()
+        reload_us = (time.perf_counter() - start) / 100 * 10 ** 6
+
+    assert blocked == legacy_blocked
+    print("blacklist entries           " + str(args.entries) + " per list")
+    print(f"legacy us/illustration      {legacy_us:.2f}")
+    print(f"matcher us/illustration     {matcher_us:.2f}")
+    print(f"unchanged reload us         {reload_us:.2f}")
+
+
+if __name__ == '__main__':
+    main()
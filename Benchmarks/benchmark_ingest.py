@@ -0,0 +1,112 @@
+import argparse
+import copy
+import logging
+import random
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import schedule
+
+from Bot.Pixiv.Source.pixiv_db_initializer import initialize_image_table
+from Pixiv.Source.pixiv_downloader import PixivDownloader
+from Pixiv.Source.pixiv_fake_api import FakePixivAPI, load_search_results
+
+discordbot_dir = Path(__file__).parent.parent.resolve()
+fixture_path = discordbot_dir / "Bot" / "Pixiv" / "Tests" / "Fixtures" / "search_illust.json"
+
+
+# Search results for tag0 to tag<tag_count - 1>, every illustration is a copy of a recorded one with a new id.
+# Illustrations carry 8 tags of a shared pool, so later tags run into images that are already in the database.
+def generate_search_results(tag_count: int, illustrations_per_tag: int, nsfw_ratio: float, seed: int) -> dict:
+    generator = random.Random(seed)
+    template = next(iter(load_search_results(fixture_path).values()))[0]
+
+    search_results = {}
+    pixiv_image_id = 1
+    for tag_number in range(tag_count):
+        illustrations = []
+        for _ in range(illustrations_per_tag):
+            # an illustration of an earlier tag shows up again
+            if tag_number and generator.random() < 0.1:
+                earlier_tag = "tag" + str(generator.randrange(tag_number))
+                illustrations.append(generator.choice(search_results[earlier_tag]))
+                continue
+
+            illustration = copy.deepcopy(template)
+            illustration["id"] = pixiv_image_id
+            illustration["image_urls"]["medium"] = "https://i.pximg.net/c/540x540_70/" + str(pixiv_image_id) + ".jpg"
+            illustration["user"]["id"] = generator.randrange(1, 1000)
+            illustration["x_restrict"] = int(generator.random() < nsfw_ratio)
+            other_tags = generator.sample(range(tag_count * 4), 7)
+            illustration["tags"] = [{"name": "tag" + str(tag_number), "translated_name": None}] + [
+                {"name": "tag" + str(other_tag), "translated_name": "translated" + str(other_tag)}
+                for other_tag in other_tags]
+            illustrations.append(illustration)
+            pixiv_image_id += 1
+        search_results["tag" + str(tag_number)] = illustrations
+    return search_results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End to end ingest throughput of PixivDownloader against the "
+                                                 "offline FakePixivAPI.")
+    parser.add_argument("--tags", type=int, default=20)
+    parser.add_argument("--illustrations-per-tag", type=int, default=150)
+    parser.add_argument("--images-per-download", type=int, default=30)
+    parser.add_argument("--search-latency", type=float, default=0.2, help="seconds per search request")
+    parser.add_argument("--download-latency", type=float, default=0.05, help="seconds per image download")
+    parser.add_argument("--search-error-rate", type=float, default=0.0)
+    parser.add_argument("--download-error-rate", type=float, default=0.0)
+    parser.add_argument("--fixture", type=Path, help="replay recorded search results instead of generated ones")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.fixture is not None:
+        search_results = load_search_results(args.fixture)
+    else:
+        search_results = generate_search_results(args.tags, args.illustrations_per_tag, 0.3, args.seed)
+
+    # a fresh database every run
+    database_directory = discordbot_dir / "DB" / "Benchmark"
+    database_directory.mkdir(parents=True, exist_ok=True)
+    (database_directory / "pixiv.db").unlink(missing_ok=True)
+    shutil.rmtree(database_directory / "Images", ignore_errors=True)
+    initialize_image_table(str(database_directory / "pixiv.db"))
+
+    api = FakePixivAPI(search_results, search_latency=args.search_latency, download_latency=args.download_latency,
+                       search_error_rate=args.search_error_rate, download_error_rate=args.download_error_rate,
+                       seed=args.seed)
+    with tempfile.TemporaryDirectory() as credentials_directory:
+        downloader = PixivDownloader(database="Benchmark", api=api,
+                                     credentials_path=Path(credentials_directory) / "credentials.json")
+        logging.getLogger().setLevel(logging.WARNING)
+
+        # every tag is crawled until its results wrap around, like the fetcher picks the same tags again and again
+        start = time.perf_counter()
+        calls = 0
+        for tag in search_results:
+            downloader.add_new_images_to_db(tag, args.images_per_download)
+            calls += 1
+            while downloader.offsets[tag] != 0:
+                downloader.add_new_images_to_db(tag, args.images_per_download)
+                calls += 1
+        seconds = time.perf_counter() - start
+
+        image_count = downloader.db.return_images_row_count()
+        downloader.tokens.stop()
+        downloader.download_executor.shutdown()
+        downloader.variant_executor.shutdown()
+        schedule.clear()
+
+    print(f"add_new_images_to_db calls {calls}")
+    print(f"search requests            {api.search_calls}")
+    print(f"image downloads            {api.download_calls}")
+    print(f"images stored              {image_count}")
+    print(f"seconds                    {seconds:.2f}")
+    print(f"images/s                   {image_count / seconds:.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+import argparse
+import random
+import sqlite3
+import time
+from pathlib import Path
+
+from Bot.Pixiv.Source.pixiv_db import PixivDB
+from Bot.Pixiv.Source.pixiv_db_initializer import MIGRATIONS
+
+discordbot_dir = Path(__file__).parent.parent.resolve()
+
+
+# Schema version 7, the last one before TagStats were counted per batch
+LEGACY_SCHEMA_VERSION = 7
+
+
+# How PixivDB.insert_images wrote a batch before it was batched, four statements per (image, tag) pair
+def legacy_insert_images(db: PixivDB, images_to_add: list):
+    for image in images_to_add:
+        db.cursor.execute(
+            "INSERT OR IGNORE INTO Images (pixiv_image_id, file_path, safety_level, artist, random_key) "
+            "VALUES (?,?,?,?,?)",
+            [image["pixiv_image_id"], image["file_path"], image["safety_level"], image["artist"],
+             random.getrandbits(63)]
+        )
+        db.cursor.execute("INSERT OR IGNORE INTO Tags (tag) VALUES (?)", [image["tag"]])
+        db.cursor.execute("SELECT tag_id FROM Tags WHERE tag = ?", [image["tag"]])
+        tag_id = db.cursor.fetchone()["tag_id"]
+        db.cursor.execute(
+            "INSERT OR IGNORE INTO ImageTags (tag_id, pixiv_image_id, random_key) "
+            "VALUES (?, ?, (SELECT random_key FROM Images WHERE pixiv_image_id = ?))",
+            [tag_id, image["pixiv_image_id"], image["pixiv_image_id"]]
+        )
+
+    db.connection.commit()
+
+
+# One batch like PixivDownloader.add_new_images_to_db builds it, one entry per english and japanese tag.
+# The images of a batch are results of one search, so all of them carry the searched tag.
+def build_batch(first_pixiv_image_id: int, images_per_batch: int, tags_per_image: int, tag_count: int) -> list:
+    batch = []
+    searched_tag_number = random.randrange(tag_count)
+    for pixiv_image_id in range(first_pixiv_image_id, first_pixiv_image_id + images_per_batch):
+        safety_level = random.randint(0, 1)
+        artist = random.randint(1, 10000)
+        tag_numbers = set(random.sample(range(tag_count), tags_per_image - 1)) | {searched_tag_number}
+        for tag_number in tag_numbers:
+            for tag in ("tag" + str(tag_number), "translated" + str(tag_number)):
+                batch.append({"file_path": "Images/" + str(pixiv_image_id) + ".jpg", "tag": tag,
+                              "pixiv_image_id": pixiv_image_id, "safety_level": safety_level, "artist": artist})
+    return batch
+
+
+# Applies the first schema_version migrations to an empty database
+def create_schema(db_file_path: Path, schema_version: int):
+    conn = sqlite3.connect(str(db_file_path))
+    conn.isolation_level = None
+    c = conn.cursor()
+    for version, migration in enumerate(MIGRATIONS[:schema_version], start=1):
+        c.execute("BEGIN")
+        migration(c)
+        c.execute(f"PRAGMA user_version = {version}")
+        c.execute("COMMIT")
+    conn.close()
+
+
+def time_batches(insert_function, batches: list, schema_version: int) -> float:
+    db_file_path = discordbot_dir / "DB" / "Benchmark" / "pixiv.db"
+    db_file_path.parent.mkdir(parents=True, exist_ok=True)
+    # both runs start from an empty database, WAL and shared memory files included
+    for suffix in ["", "-wal", "-shm"]:
+        Path(str(db_file_path) + suffix).unlink(missing_ok=True)
+    create_schema(db_file_path, schema_version)
+
+    db = PixivDB(database="Benchmark")
+    try:
+        start = time.perf_counter()
+        for batch in batches:
+            insert_function(db, batch)
+        return (time.perf_counter() - start) / len(batches) * 1000
+    finally:
+        db.connections.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare per-row inserts with the batched insert_images.")
+    parser.add_argument("--batches", type=int, default=200)
+    parser.add_argument("--images-per-batch", type=int, default=30)
+    parser.add_argument("--tags-per-image", type=int, default=10)
+    parser.add_argument("--tags", type=int, default=5000)
+    args = parser.parse_args()
+
+    batches = [build_batch(batch_number * args.images_per_batch + 1, args.images_per_batch, args.tags_per_image,
+                           args.tags)
+               for batch_number in range(args.batches)]
+
+    legacy_ms = time_batches(legacy_insert_images, batches, LEGACY_SCHEMA_VERSION)
+    batched_ms = time_batches(PixivDB.insert_images, batches, len(MIGRATIONS))
+
+    print("entries per batch  " + str(len(batches[0])))
+    print(f"legacy ms/batch    {legacy_ms:.3f}")
+    print(f"batched ms/batch   {batched_ms:.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+import argparse
+import logging
+import random
+import statistics
+import time
+from pathlib import Path
+
+from Benchmarks.generate_database import generate_database
+from Bot.Pixiv.Source.pixiv_db import PixivDB
+
+discordbot_dir = Path(__file__).parent.parent.resolve()
+
+
+def print_header():
+    print(f"{'method':<44} {'calls':>6} {'p50 ms':>10} {'p90 ms':>10} {'p99 ms':>10} {'max ms':>10}")
+
+
+def print_latencies(name: str, latencies: list):
+    if len(latencies) > 1:
+        percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+        p50, p90, p99 = percentiles[49], percentiles[89], percentiles[98]
+    else:
+        p50 = p90 = p99 = latencies[0]
+    print(f"{name:<44} {len(latencies):>6} {p50:>10.3f} {p90:>10.3f} {p99:>10.3f} {max(latencies):>10.3f}")
+
+
+# Calls function once per entry of arguments and prints the latency percentiles
+def measure(name: str, function, arguments: list):
+    latencies = []
+    for argument in arguments:
+        start = time.perf_counter()
+        function(*argument)
+        latencies.append((time.perf_counter() - start) * 1000)
+    print_latencies(name, latencies)
+
+
+# Tags at a few points of the Zipf distribution, by rank
+def pick_tags(db: PixivDB) -> dict:
+    db.cursor.execute("SELECT COUNT(*) FROM Tags WHERE tag LIKE 'tag%'")
+    tag_count = db.cursor.fetchone()[0]
+
+    db.cursor.execute("SELECT MIN(CAST(SUBSTR(tag, 11) AS INTEGER)) FROM Tags WHERE tag LIKE 'translated%'")
+    translated_rank = db.cursor.fetchone()[0] or 1
+
+    return {
+        "popular": "tag1",
+        "common": "tag" + str(max(1, tag_count // 100)),
+        "rare": "tag" + str(max(1, tag_count // 2)),
+        "translated_rank": translated_rank,
+    }
+
+
+def run_read_benchmarks(db: PixivDB, calls: int):
+    tags = pick_tags(db)
+    translated_pair = ["tag" + str(tags["translated_rank"]), "translated" + str(tags["translated_rank"])]
+
+    tag_cases = {
+        "no tags": [],
+        "popular tag": [tags["popular"]],
+        "common tag": [tags["common"]],
+        "rare tag": [tags["rare"]],
+        "popular and common tag": [tags["popular"], tags["common"]],
+        "tag and its translation": translated_pair,
+    }
+
+    for safety_level in [0, 1]:
+        for case, case_tags in tag_cases.items():
+            measure("return_image " + case + " sl" + str(safety_level), db.return_image,
+                    [(case_tags, safety_level)] * calls)
+
+    for case, case_tags in tag_cases.items():
+        measure("sample_images(20) " + case, db.sample_images, [(case_tags, 0, 20)] * calls)
+
+    for case, case_tags in tag_cases.items():
+        measure("return_image_count " + case, db.return_image_count, [(case_tags,)] * calls)
+
+    measure("return_top_tags", db.return_top_tags, [()] * calls)
+
+    db.cursor.execute("SELECT MAX(pixiv_image_id) FROM Images")
+    max_pixiv_image_id = db.cursor.fetchone()[0]
+    measure("check_if_image_exists", db.check_if_image_exists,
+            [(random.randint(1, max_pixiv_image_id * 2),) for _ in range(calls)])
+
+
+# Deletions change the database, every call deletes something else
+def run_delete_benchmarks(db: PixivDB, calls: int):
+    db.cursor.execute("SELECT COUNT(*) FROM Tags WHERE tag LIKE 'tag%'")
+    tag_count = db.cursor.fetchone()[0]
+    db.cursor.execute("SELECT MAX(pixiv_image_id) FROM Images")
+    max_pixiv_image_id = db.cursor.fetchone()[0]
+
+    # tags and artists from the middle of the distribution, a few hundred to a few thousand images each
+    measure("remove_tag_and_delete_from_file_system", db.remove_tag_and_delete_from_file_system,
+            [("tag" + str(rank), False) for rank in range(tag_count // 200, tag_count // 200 + calls)])
+    measure("remove_tag nsfw_only", db.remove_tag_and_delete_from_file_system,
+            [("tag" + str(rank), True) for rank in range(tag_count // 100, tag_count // 100 + calls)])
+    measure("remove_artist_and_delete_from_file_system", db.remove_artist_and_delete_from_file_system,
+            [(str(artist),) for artist in range(50, 50 + calls)])
+    measure("remove_image_and_delete_from_file_system", db.remove_image_and_delete_from_file_system,
+            [(pixiv_image_id,) for pixiv_image_id in random.sample(range(1, max_pixiv_image_id + 1), calls)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latency percentiles of the PixivDB methods.")
+    parser.add_argument("--images", type=int, default=100000)
+    parser.add_argument("--tags", type=int, default=20000)
+    parser.add_argument("--calls", type=int, default=200, help="calls per read benchmark")
+    parser.add_argument("--delete-calls", type=int, default=10, help="calls per delete benchmark")
+    parser.add_argument("--reuse", action="store_true", help="keep the database of the previous run")
+    parser.add_argument("--tag-index", action="store_true", help="answer tag lookups from the TagIndex")
+    parser.add_argument("--skip-deletes", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    db_file_path = discordbot_dir / "DB" / "Benchmark" / "pixiv.db"
+    if not args.reuse or not db_file_path.exists():
+        print("Generating " + str(args.images) + " images in " + str(db_file_path))
+        generate_database(db_file_path, args.images, tag_count=args.tags, seed=args.seed)
+
+    db = PixivDB(database="Benchmark", use_tag_index=args.tag_index)
+    # deletions log every file they can't find, and the generated images have no files
+    logging.getLogger().setLevel(logging.WARNING)
+
+    print_header()
+    run_read_benchmarks(db, args.calls)
+    if not args.skip_deletes:
+        run_delete_benchmarks(db, args.delete_calls)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+import argparse
+import sqlite3
+import time
+from pathlib import Path
+
+from Benchmarks.generate_database import generate_database
+from Bot.Pixiv.Source.pixiv_db_initializer import rebuild_stats
+from Bot.Pixiv.Source.pixiv_db import PixivDB
+
+discordbot_dir = Path(__file__).parent.parent.resolve()
+
+
+# The query PixivDB.return_image used before random keys existed
+def legacy_return_image(cursor: sqlite3.Cursor, tags: list, safety_level: int):
+    if tags:
+        where_condition = " or ".join("tag = ?" for _ in tags)
+        query = f"""
+                SELECT *
+                FROM Images
+                WHERE pixiv_image_id IN (
+                    SELECT pixiv_image_id
+                    FROM ImageTags
+                    WHERE ImageTags.tag_id IN (
+                        SELECT tag_id
+                        FROM Tags
+                        WHERE {where_condition}
+                    )
+                    GROUP BY pixiv_image_id
+                    HAVING COUNT(*) >= ?
+                )
+                AND safety_level = ?
+                ORDER BY RANDOM()
+                LIMIT 1
+                """
+        values = tags + [len(tags), safety_level]
+
+    else:
+        query = """
+                SELECT *
+                FROM Images
+                WHERE pixiv_image_id IN
+                    (
+                    SELECT pixiv_image_id
+                    FROM Images
+                    ORDER BY RANDOM()
+                    LIMIT 100
+                    )
+                AND safety_level = ?
+                LIMIT 1
+                """
+        values = [safety_level]
+
+    cursor.execute(query, values)
+    return cursor.fetchone()
+
+
+# Adds a tag to every sfw image but only to nsfw_image_count nsfw images, like a popular sfw tag.
+# Sampling its nsfw images must not walk past all of its sfw ones, and a safety level without images must not either.
+def add_skewed_tag(db_file_path: Path, tag: str, nsfw_image_count: int):
+    connection = sqlite3.connect(str(db_file_path))
+    c = connection.cursor()
+    c.execute("INSERT INTO Tags (tag) VALUES (?)", [tag])
+    tag_id = c.lastrowid
+    c.execute(
+        """
+        INSERT INTO ImageTags (pixiv_image_id, tag_id, safety_level, random_key)
+        SELECT pixiv_image_id, ?, safety_level, random_key
+        FROM Images
+        WHERE safety_level = 0
+        """,
+        [tag_id]
+    )
+    c.execute(
+        """
+        INSERT INTO ImageTags (pixiv_image_id, tag_id, safety_level, random_key)
+        SELECT pixiv_image_id, ?, safety_level, random_key
+        FROM Images
+        WHERE safety_level = 1
+        LIMIT ?
+        """,
+        [tag_id, nsfw_image_count]
+    )
+    rebuild_stats(c)
+    connection.commit()
+    connection.close()
+
+
+def time_calls(function, repeats: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeats):
+        function()
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare ORDER BY RANDOM() with random key sampling.")
+    parser.add_argument("--images", type=int, default=200000)
+    parser.add_argument("--tags", type=int, default=2000)
+    parser.add_argument("--tags-per-image", type=int, default=8)
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    db_file_path = discordbot_dir / "DB" / "Benchmark" / "pixiv.db"
+    print("Building " + str(args.images) + " images in " + str(db_file_path))
+    generate_database(db_file_path, args.images, tag_count=args.tags, tags_per_image=args.tags_per_image)
+    add_skewed_tag(db_file_path, "landscape", nsfw_image_count=5)
+
+    db = PixivDB(database="Benchmark")
+    # name -> (tags, safety_level)
+    cases = {
+        "no tags": ([], 0),
+        "popular tag": (["tag1"], 0),
+        "rare tag": (["tag" + str(args.tags)], 0),
+        "two tags": (["tag1", "tag2"], 0),
+        "skewed sfw": (["landscape"], 0),
+        "skewed nsfw": (["landscape"], 1),
+        "skewed nsfl": (["landscape"], 2),
+    }
+
+    print(f"{'case':<12} {'legacy ms':>10} {'random key ms':>14}")
+    for name, (tags, safety_level) in cases.items():
+        legacy_ms = time_calls(lambda: legacy_return_image(db.cursor, list(tags), safety_level), args.repeats)
+        random_key_ms = time_calls(lambda: db.return_image(list(tags), safety_level), args.repeats)
+        print(f"{name:<12} {legacy_ms:>10.3f} {random_key_ms:>14.3f}")
+
+
+if __name__ == '__main__':
+    main()
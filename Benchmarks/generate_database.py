@@ -0,0 +1,129 @@
+import argparse
+import bisect
+import itertools
+import random
+import sqlite3
+import time
+from pathlib import Path
+
+from Bot.Pixiv.Source.pixiv_db_initializer import initialize_image_table, rebuild_stats
+
+discordbot_dir = Path(__file__).parent.parent.resolve()
+
+# pixiv x_restrict, 0 -> sfw, 1 -> nsfw, 2 -> nsfl
+DEFAULT_SAFETY_LEVEL_WEIGHTS = (0.7, 0.28, 0.02)
+
+
+# Weights of rank 1..n for a Zipf distribution, summed up for bisect
+def zipf_cumulative_weights(n: int, exponent: float) -> list:
+    return list(itertools.accumulate(1 / rank ** exponent for rank in range(1, n + 1)))
+
+
+def zipf_rank(rng: random.Random, cumulative_weights: list) -> int:
+    return bisect.bisect(cumulative_weights, rng.random() * cumulative_weights[-1]) + 1
+
+
+# Tags are named by their popularity rank, tag1 is the most common one.
+# Like on pixiv most tags also have a translated name, which the downloader stores as a second tag of the same image.
+# Translated tags are named translated<rank>.
+def generate_database(db_file_path: Path, image_count: int, tag_count: int = 20000, tags_per_image: int = 8,
+                      translated_ratio: float = 0.6, zipf_exponent: float = 1.0, artist_count: int = 50000,
+                      safety_level_weights: tuple = DEFAULT_SAFETY_LEVEL_WEIGHTS, seed: int = 0,
+                      chunk_size: int = 100000):
+    rng = random.Random(seed)
+
+    db_file_path.parent.mkdir(parents=True, exist_ok=True)
+    for path in [db_file_path, Path(str(db_file_path) + "-wal"), Path(str(db_file_path) + "-shm")]:
+        if path.exists():
+            path.unlink()
+
+    initialize_image_table(str(db_file_path))
+    connection = sqlite3.connect(str(db_file_path), isolation_level=None)
+    c = connection.cursor()
+
+    # a throwaway database doesn't need to survive a crash
+    c.execute("PRAGMA journal_mode = OFF")
+    c.execute("PRAGMA synchronous = OFF")
+    c.execute("PRAGMA cache_size = -512000")
+
+    # building indexes once after loading is much faster than updating them per row,
+    # the stats triggers are replaced by a single rebuild_stats
+    c.execute("SELECT type, name, sql FROM sqlite_master WHERE type IN ('index', 'trigger') AND sql IS NOT NULL")
+    schema_objects = c.fetchall()
+    for object_type, name, _ in schema_objects:
+        c.execute(f'DROP {object_type.upper()} "{name}"')
+
+    c.execute("BEGIN")
+
+    translated_tag_ids = {}
+    tags = []
+    for rank in range(1, tag_count + 1):
+        tags.append((rank, "tag" + str(rank)))
+        if rng.random() < translated_ratio:
+            translated_tag_ids[rank] = tag_count + rank
+            tags.append((tag_count + rank, "translated" + str(rank)))
+    c.executemany("INSERT INTO Tags (tag_id, tag) VALUES (?, ?)", tags)
+
+    tag_weights = zipf_cumulative_weights(tag_count, zipf_exponent)
+    artist_weights = zipf_cumulative_weights(artist_count, zipf_exponent)
+    safety_levels = list(range(len(safety_level_weights)))
+
+    for first_pixiv_image_id in range(1, image_count + 1, chunk_size):
+        last_pixiv_image_id = min(first_pixiv_image_id + chunk_size, image_count + 1)
+
+        images = []
+        image_tags = []
+        for pixiv_image_id in range(first_pixiv_image_id, last_pixiv_image_id):
+            random_key = rng.getrandbits(63)
+            safety_level = rng.choices(safety_levels, weights=safety_level_weights)[0]
+            artist = zipf_rank(rng, artist_weights)
+            images.append((pixiv_image_id, "Images/" + str(pixiv_image_id) + ".jpg", safety_level, artist,
+                           random_key))
+
+            # pixiv images carry a varying number of tags
+            image_tag_count = rng.randint(max(1, tags_per_image // 2), tags_per_image * 3 // 2)
+            ranks = {zipf_rank(rng, tag_weights) for _ in range(image_tag_count)}
+            for rank in sorted(ranks):
+                image_tags.append((pixiv_image_id, rank, safety_level, random_key))
+                if rank in translated_tag_ids:
+                    image_tags.append((pixiv_image_id, translated_tag_ids[rank], safety_level, random_key))
+
+        c.executemany(
+            "INSERT INTO Images (pixiv_image_id, file_path, safety_level, artist, random_key) VALUES (?,?,?,?,?)",
+            images
+        )
+        c.executemany("INSERT INTO ImageTags (pixiv_image_id, tag_id, safety_level, random_key) VALUES (?,?,?,?)",
+                      image_tags)
+        print("Generated " + str(last_pixiv_image_id - 1) + "/" + str(image_count) + " images")
+
+    for _, _, sql in schema_objects:
+        c.execute(sql)
+    rebuild_stats(c)
+    c.execute("COMMIT")
+
+    c.execute("ANALYZE")
+    connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic pixiv.db for benchmarks.")
+    parser.add_argument("--images", type=int, default=100000)
+    parser.add_argument("--tags", type=int, default=20000)
+    parser.add_argument("--tags-per-image", type=int, default=8)
+    parser.add_argument("--translated-ratio", type=float, default=0.6)
+    parser.add_argument("--zipf-exponent", type=float, default=1.0)
+    parser.add_argument("--artists", type=int, default=50000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--database", default="Benchmark", help="folder in DB/ the pixiv.db is written to")
+    args = parser.parse_args()
+
+    db_file_path = discordbot_dir / "DB" / args.database / "pixiv.db"
+    start = time.perf_counter()
+    generate_database(db_file_path, args.images, tag_count=args.tags, tags_per_image=args.tags_per_image,
+                      translated_ratio=args.translated_ratio, zipf_exponent=args.zipf_exponent,
+                      artist_count=args.artists, seed=args.seed)
+    print("Generated " + str(db_file_path) + " in " + f"{time.perf_counter() - start:.1f}" + " s")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,4 @@
+import asyncio
 import configparser
 import logging
 import time
@@ -5,10 +6,12 @@ from multiprocessing.connection import Client
 from pathlib import Path
 
 import discord
-from discord.ext import commands, tasks
+from discord.ext import commands
 
-from Pixiv.Source.pixiv_db import PixivDB
+from Pixiv.Source.pixiv_db_async import AsyncPixivDB
 from Pixiv.Source.pixiv_downloader import PixivDownloader
+from Pixiv.Source.pixiv_image_links import ImageLinkFetcher
+from Pixiv.Source.pixiv_image_prefetcher import ImagePrefetcher
 
 
 def file_to_list(file_path: str) -> list:
@@ -42,12 +45,19 @@ class Pixiv(commands.Cog):
         config_path = (Path(__file__).parent.parent.parent.absolute() / "config.ini").resolve()
         config.read(str(config_path))
 
-        # Setup db
-        self.pixiv_db = PixivDB(database="Main")
+        # Setup db, queries run on a thread pool so they never block the event loop
+        self.pixiv_db = AsyncPixivDB(database="Main",
+                                     use_tag_index=config.getboolean("pixiv", "use_tag_index", fallback=False))
+
+        # .p and .pn are served from buffers of pre-sampled images, see ImagePrefetcher
+        self.image_prefetcher = ImagePrefetcher(self.pixiv_db)
 
         # Setup pixivdownloader
         self.pixiv_downloader = PixivDownloader(database="Main")
 
+        # tags without images in the database are answered with a link from a cached live search
+        self.image_link_fetcher = ImageLinkFetcher(self.pixiv_downloader)
+
         # needed paths
         cogs_folder_path = str(Path(__file__).parent.parent.absolute())
 
@@ -80,12 +90,40 @@ class Pixiv(commands.Cog):
         self.logger.info("attempting to connect to.." + str(address))
         self.conn = Client(address, authkey=config["process-communication"]["authkey"].encode())
 
-        self.fetcher_ping.start()
-
-    @tasks.loop(seconds=65)
-    async def fetcher_ping(self):
-        self.logger.info("Sent ping to the Pixiv Image Fetcher.")
-        self.conn.send("pixivping")
+    def cog_unload(self):
+        self.conn.close()
+        self.image_prefetcher.close()
+        self.image_link_fetcher.close()
+        # the downloader's thread and process pools are shut down without blocking the event loop
+        self.pixiv_downloader.tokens.stop()
+        self.pixiv_downloader.download_executor.shutdown(wait=False)
+        self.pixiv_downloader.variant_executor.shutdown(wait=False)
+        self.pixiv_downloader.db.connections.close()
+        self.pixiv_db.close()
+
+    async def cog_command_error(self, context, error):
+        if isinstance(getattr(error, "original", None), asyncio.TimeoutError):
+            self.logger.info("Database timed out for " + str(context.command))
+            await context.send("The database is busy right now, please try again.")
+        elif isinstance(error, commands.CommandOnCooldown):
+            # every rate limited .p ends up here, it isn't worth a traceback
+            self.logger.info(str(context.command) + " on cooldown for " + str(context.author.id))
+            await context.send("Slow down, try again in " + f"{error.retry_after:.1f}" + " seconds.")
+        elif isinstance(error, (commands.UserInputError, commands.CheckFailure)):
+            self.logger.info("Rejected " + str(context.command) + ": " + str(error))
+            await context.send(str(error))
+        else:
+            # a cog error handler replaces the default one, so everything else still has to be logged
+            self.logger.error("Error in " + str(context.command) + ": " + str(error), exc_info=error)
+
+    # The fetcher queues the tags and answers right away, a fetcher that is down only costs the download.
+    # The tags are sent as a list, a single tag may contain spaces.
+    def send_to_fetcher(self, tags_list: list, safety_level: int):
+        try:
+            self.conn.send((tags_list, safety_level))
+            self.logger.info("Sent " + str(tags_list) + " to fetcher.")
+        except OSError as e:
+            self.logger.info("Sending " + str(tags_list) + " to fetcher failed: " + repr(e))
 
     #########################################################
     # BASIC SETUP
@@ -177,22 +215,22 @@ class Pixiv(commands.Cog):
             tags_string = tags_string[1:]
 
             self.logger.info(str(tags_list))
-            self.logger.info("Sent " + tags_string + " to fetcher.")
-            self.conn.send(tags_string)
+            self.send_to_fetcher(tags_list, safety_level=0)
 
-            image_data = self.pixiv_db.return_image(tags=tags_list, safety_level=0)
+            image_data = await self.image_prefetcher.return_image(tags=tags_list, safety_level=0)
 
             if "file_path" not in image_data:
                 self.logger.info("No image for " + tags_string + " in database")
-                image_link: str = self.pixiv_downloader.fetch_single_image_link(tag=tags_string, safety_level=0)
+                image_link: str = await self.image_link_fetcher.fetch_single_image_link(tag=tags_string,
+                                                                                        safety_level=0)
                 await context.send(image_link)
             else:
-                await context.send(file=discord.File(image_data["file_path"]),
+                await context.send(file=discord.File(image_data["upload_file_path"]),
                                    content=str(image_data["pixiv_image_id"]))
 
         else:
-            image_data = self.pixiv_db.return_image(tags=[], safety_level=0)
-            await context.send(file=discord.File(image_data["file_path"]),
+            image_data = await self.image_prefetcher.return_image(tags=[], safety_level=0)
+            await context.send(file=discord.File(image_data["upload_file_path"]),
                                content=str(image_data["pixiv_image_id"]))
 
     @commands.command(name="pn", brief="Fetch a nsfw picture.")
@@ -212,28 +250,28 @@ class Pixiv(commands.Cog):
             tags_string = tags_string[1:]
 
             self.logger.info(str(tags_list))
-            self.logger.info("Sent " + tags_string + " to fetcher.")
-            self.conn.send(tags_string)
+            self.send_to_fetcher(tags_list, safety_level=1)
 
-            image_data = self.pixiv_db.return_image(tags=tags_list, safety_level=1)
+            image_data = await self.image_prefetcher.return_image(tags=tags_list, safety_level=1)
 
             if "file_path" not in image_data:
                 self.logger.info("No image for " + tags_string + " in database")
-                image_link: str = self.pixiv_downloader.fetch_single_image_link(tag=tags_string, safety_level=1)
+                image_link: str = await self.image_link_fetcher.fetch_single_image_link(tag=tags_string,
+                                                                                        safety_level=1)
                 await context.send(image_link)
             else:
-                await context.send(file=discord.File(image_data["file_path"]),
+                await context.send(file=discord.File(image_data["upload_file_path"]),
                                    content=str(image_data["pixiv_image_id"]))
 
         else:
-            image_data = self.pixiv_db.return_image(tags=[], safety_level=1)
-            await context.send(file=discord.File(image_data["file_path"]),
+            image_data = await self.image_prefetcher.return_image(tags=[], safety_level=1)
+            await context.send(file=discord.File(image_data["upload_file_path"]),
                                content=str(image_data["pixiv_image_id"]))
 
     @pixiv.command(name="toptags", brief="Top 10 tags in the database.")
     @commands.cooldown(1, 5, commands.BucketType.user)
     async def top_tags(self, context):
-        data = self.pixiv_db.return_top_tags()
+        data = await self.pixiv_db.return_top_tags()
         response = discord.Embed(title="Top Tags")
 
         for db_entries, tag in data.items():
@@ -256,11 +294,11 @@ class Pixiv(commands.Cog):
                     tag = tag.lower()
                     tags_list.append(tag)
 
-                image_count = self.pixiv_db.return_image_count(tags_list)
+                image_count = await self.pixiv_db.return_image_count(tags_list)
                 await context.send(str(image_count))
 
             else:
-                image_count = self.pixiv_db.return_image_count([])
+                image_count = await self.pixiv_db.return_image_count([])
                 await context.send(str(image_count))
 
     #########################################################
@@ -348,11 +386,32 @@ class Pixiv(commands.Cog):
             self.logger.info(str(blacklist))
             return False
 
+    # Returns a progress_callback for the PixivDB deletions, which edits a single message.
+    # Edits are spaced out, a purge deletes in hundreds of chunks and discord rate limits message edits.
+    # The last edit is always sent, a deletion without images reports (0, 0).
+    async def send_deletion_progress(self, context):
+        message = await context.send("Deleting images...")
+        loop = asyncio.get_running_loop()
+        last_edit = 0
+
+        def report_progress(deleted_count: int, total_count: int):
+            nonlocal last_edit
+            if time.monotonic() - last_edit > 2 or deleted_count == total_count:
+                last_edit = time.monotonic()
+                if total_count == 0:
+                    content = "Nothing to delete."
+                else:
+                    content = "Deleted " + str(deleted_count) + "/" + str(total_count) + " images."
+                asyncio.run_coroutine_threadsafe(message.edit(content=content), loop)
+
+        return report_progress
+
     @blacklist.command(name="image", hidden=True)
     @commands.cooldown(1, 1, commands.BucketType.user)
     async def blacklist_image(self, context, pixiv_image_id: int):
         if self.is_admin(context.author.id):
-            self.pixiv_db.remove_image_and_delete_from_file_system(pixiv_image_id)
+            await self.pixiv_db.remove_image_and_delete_from_file_system(pixiv_image_id)
+            self.image_prefetcher.invalidate()
             await context.send("Removed " + str(pixiv_image_id) + " from the database.")
 
     @blacklist.command(name="tag", hidden=True)
@@ -360,7 +419,10 @@ class Pixiv(commands.Cog):
     async def blacklist_tag(self, context, tag: str):
         tag = tag.lower()
         if self.is_admin(context.author.id):
-            self.pixiv_db.remove_tag_and_delete_from_file_system(tag, nsfw_only=False)
+            progress_callback = await self.send_deletion_progress(context)
+            await self.pixiv_db.remove_tag_and_delete_from_file_system(tag, nsfw_only=False,
+                                                                       progress_callback=progress_callback)
+            self.image_prefetcher.invalidate()
             success = self.add_item_to_blacklist(item=tag,
                                                  blacklist=self.blacklisted_tags,
                                                  blacklist_path=self.blacklisted_tags_path,
@@ -391,7 +453,10 @@ class Pixiv(commands.Cog):
     async def blacklist_nsfw_tag(self, context, tag: str):
         tag = tag.lower()
         if self.is_admin(context.author.id):
-            self.pixiv_db.remove_tag_and_delete_from_file_system(tag, nsfw_only=True)
+            progress_callback = await self.send_deletion_progress(context)
+            await self.pixiv_db.remove_tag_and_delete_from_file_system(tag, nsfw_only=True,
+                                                                       progress_callback=progress_callback)
+            self.image_prefetcher.invalidate()
             success = self.add_item_to_blacklist(item=tag,
                                                  blacklist=self.blacklisted_tags_nsfw,
                                                  blacklist_path=self.blacklisted_tags_nsfw_path,
@@ -422,7 +487,9 @@ class Pixiv(commands.Cog):
     async def blacklist_artist(self, context, artist: str):
         artist = artist.lower()
         if self.is_admin(context.author.id):
-            self.pixiv_db.remove_artist_and_delete_from_file_system(artist)
+            progress_callback = await self.send_deletion_progress(context)
+            await self.pixiv_db.remove_artist_and_delete_from_file_system(artist, progress_callback=progress_callback)
+            self.image_prefetcher.invalidate()
             success = self.add_item_to_blacklist(item=artist,
                                                  blacklist=self.blacklisted_artists,
                                                  blacklist_path=self.blacklisted_artists_path,
@@ -456,10 +523,10 @@ class Pixiv(commands.Cog):
     @commands.cooldown(1, 5, commands.BucketType.user)
     async def rows(self, context):
         if self.is_admin(context.author.id):
-            await context.send(str(self.pixiv_db.return_imagetags_row_count()))
+            await context.send(str(await self.pixiv_db.return_imagetags_row_count()))
 
     @pixiv.command(name="debug", hidden=True)
     @commands.cooldown(1, 5, commands.BucketType.user)
     async def debug(self, context):
         if self.is_admin(context.author.id):
-            self.pixiv_db.log_debug_info()
+            await self.pixiv_db.log_debug_info()
@@ -0,0 +1,163 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+
+# Blocks until the lock of the open file is held, other processes wait in lock_file until unlock_file
+def lock_file(file):
+    if fcntl is not None:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        return
+
+    # msvcrt locks a byte range, LK_LOCK gives up with an OSError after 10 seconds
+    file.seek(0)
+    while True:
+        try:
+            msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            continue
+
+
+def unlock_file(file):
+    if fcntl is not None:
+        fcntl.flock(file, fcntl.LOCK_UN)
+    else:
+        file.seek(0)
+        msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+# Keeps the access token of an AppPixivAPI valid.
+#
+# pixiv access tokens expire after an hour. ensure_token() refreshes the token refresh_margin seconds before that,
+# and a background thread calls it in time, so requests don't have to fail first.
+# Only one caller refreshes at a time, within a process through a lock and across processes through a lock file.
+# The bot and the image fetcher share the credentials file, whichever refreshes first hands its token to the other.
+class PixivTokenManager:
+    def __init__(self, api, refresh_token: str, credentials_path: Path, refresh_margin: float = 300):
+        self.logger = logging.getLogger()
+
+        self.api = api
+        self.refresh_token = refresh_token
+        self.credentials_path = Path(credentials_path)
+        self.lock_path = Path(str(credentials_path) + ".lock")
+        self.refresh_margin = refresh_margin
+
+        self.lock = threading.Lock()
+        self.expires_at = 0.0
+        # refresh_after_error doesn't hammer the auth endpoint while pixiv is down
+        self.last_forced_refresh = 0.0
+        self.forced_refresh_interval = 60
+
+        self.refresher = None
+        self.stopped = threading.Event()
+
+    def token_is_fresh(self) -> bool:
+        return time.time() < self.expires_at - self.refresh_margin
+
+    # Cheap when the token is fresh, call it before every API request
+    def ensure_token(self):
+        if self.token_is_fresh():
+            return
+
+        with self.lock:
+            # another thread refreshed while this one waited
+            if self.token_is_fresh():
+                return
+            self.refresh()
+
+    # An error response can mean the token was revoked early, refresh at most once per forced_refresh_interval
+    def refresh_after_error(self):
+        with self.lock:
+            if time.time() - self.last_forced_refresh < self.forced_refresh_interval:
+                return
+            self.last_forced_refresh = time.time()
+            self.expires_at = 0.0
+            self.refresh(use_cached=False)
+
+    # Needs self.lock
+    def refresh(self, use_cached: bool = True):
+        self.lock_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.lock_path, "w") as credentials_lock:
+            lock_file(credentials_lock)
+            try:
+                if use_cached and self.load_cached_credentials():
+                    self.logger.info("Using cached pixiv credentials")
+                    return
+
+                token = self.api.auth(refresh_token=self.refresh_token)
+                self.expires_at = time.time() + token.response.expires_in
+                self.save_credentials()
+                self.logger.info("Refreshed pixiv access token")
+            finally:
+                unlock_file(credentials_lock)
+
+    # Returns True if the credentials file holds a token that is still fresh
+    def load_cached_credentials(self) -> bool:
+        try:
+            with open(self.credentials_path) as f:
+                credentials = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        # a different refresh_token in the config.ini belongs to a different account
+        if credentials.get("configured_refresh_token") != self.refresh_token:
+            return False
+        if time.time() >= credentials["expires_at"] - self.refresh_margin:
+            return False
+
+        self.api.set_auth(credentials["access_token"], credentials["refresh_token"])
+        self.api.user_id = credentials["user_id"]
+        self.expires_at = credentials["expires_at"]
+        return True
+
+    # Written to a temporary file and renamed, so the other process never reads half a file
+    def save_credentials(self):
+        credentials = {
+            "configured_refresh_token": self.refresh_token,
+            "access_token": self.api.access_token,
+            "refresh_token": self.api.refresh_token,
+            "user_id": self.api.user_id,
+            "expires_at": self.expires_at
+        }
+
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=self.credentials_path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(file_descriptor, "w") as f:
+                json.dump(credentials, f)
+            os.chmod(temporary_path, 0o600)
+            os.replace(temporary_path, self.credentials_path)
+        except BaseException:
+            os.unlink(temporary_path)
+            raise
+
+    def start(self):
+        self.refresher = threading.Thread(target=self.refresh_in_background, name="PixivTokenRefresher", daemon=True)
+        self.refresher.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def refresh_in_background(self):
+        while not self.stopped.is_set():
+            try:
+                self.ensure_token()
+            except Exception as e:
+                self.logger.exception(e)
+                self.logger.info("Refreshing the pixiv access token failed")
+                self.stopped.wait(30)
+                continue
+
+            # wake up once the token needs a refresh
+            self.stopped.wait(max(1.0, self.expires_at - self.refresh_margin - time.time()))
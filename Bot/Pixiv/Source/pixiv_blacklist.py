@@ -0,0 +1,68 @@
+import os
+
+
+# One blacklist file (one entry per line) loaded into a frozenset.
+# reload() only reads the file again if its modification time or size changed.
+class Blacklist:
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.entries = frozenset()
+        self.file_state = None
+        self.reload()
+
+    def __contains__(self, item: str):
+        return item in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Returns True if the file changed
+    def reload(self) -> bool:
+        stat = os.stat(self.file_path)
+        file_state = (stat.st_mtime_ns, stat.st_size)
+        if file_state == self.file_state:
+            return False
+
+        with open(self.file_path, "r") as file:
+            # pixiv tags are case insensitive, the cog stores entries in lower case already
+            self.entries = frozenset(line.strip().lower() for line in file if line.strip())
+        self.file_state = file_state
+        return True
+
+
+# pixiv tags_list are kv pairs of tag:translated_tag
+# return True if any tag in the tags_list is part of the blacklist
+def tags_in_blacklist(tags: list, blacklist: Blacklist) -> bool:
+    for tag_pair in tags:
+        for name in ["name", "translated_name"]:
+            tag = tag_pair.get(name)
+            if tag is not None and tag.lower() in blacklist:
+                return True
+    return False
+
+
+# The tag, nsfw tag and artist blacklists of the downloader
+class BlacklistMatcher:
+    def __init__(self, tags_path, nsfw_tags_path, artists_path):
+        self.tags = Blacklist(tags_path)
+        self.nsfw_tags = Blacklist(nsfw_tags_path)
+        self.artists = Blacklist(artists_path)
+
+    # Returns True if any blacklist changed
+    def reload(self) -> bool:
+        # no short circuit, every file has to be checked
+        changed = [self.tags.reload(), self.nsfw_tags.reload(), self.artists.reload()]
+        return any(changed)
+
+    # Returns why the illustration is blacklisted, or None if it isn't
+    def blocked_reason(self, illustration):
+        if str(illustration.user.id) in self.artists:
+            return "blacklisted artist"
+
+        if tags_in_blacklist(illustration.tags, self.tags):
+            return "completly banned tag"
+
+        if illustration.x_restrict == 1 and tags_in_blacklist(illustration.tags, self.nsfw_tags):
+            return "nsfw banned tag"
+
+        return None
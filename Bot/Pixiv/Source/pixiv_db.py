@@ -1,10 +1,17 @@
 import logging
-import sqlite3
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+from Pixiv.Source.pixiv_db_connection import PixivDBConnectionManager
+from Pixiv.Source.pixiv_db_initializer import rebuild_stats
+from Pixiv.Source.pixiv_image_store import ImageStore
+from Pixiv.Source.pixiv_tag_index import TagIndex
+
 
 class PixivDB:
-    def __init__(self, database: str):
+    def __init__(self, database: str, reader_pool_size: int = 4, use_tag_index: bool = False):
         self.logger = logging.getLogger()
         logging.basicConfig(
             level=logging.INFO,
@@ -13,58 +20,205 @@ class PixivDB:
         )
 
         discordbot_dir = Path(__file__).parent.parent.parent.parent.resolve()
-        db_file_path = (discordbot_dir / 'DB' / database / "pixiv.db").resolve()
-        self.connection = sqlite3.connect(str(db_file_path))
-        self.connection.row_factory = sqlite3.Row
+        self.db_file_path = (discordbot_dir / 'DB' / database / "pixiv.db").resolve()
+        self.image_store = ImageStore((discordbot_dir / 'DB' / database / 'Images').resolve())
+
+        # Writes go through the single writer connection, reads through a pool of read only connections
+        self.connections = PixivDBConnectionManager(self.db_file_path, reader_pool_size=reader_pool_size)
+        self.connection = self.connections.writer
         self.cursor = self.connection.cursor()
 
-    def insert_images(self, images_to_add: list):
+        # tag -> tag_id
+        self.tag_id_cache = {}
+
+        # Deletions, see delete_images
+        self.delete_lock = threading.Lock()
+        self.delete_chunk_size = 500
+        self.file_delete_workers = 8
+
+        # Optionally answer tag lookups from memory, see TagIndex and load_tag_index
+        self.tag_index = None
+        if use_tag_index:
+            self.load_tag_index()
+
+    # Lookups use SQLite until the index is loaded, then switch over to it.
+    # AsyncPixivDB runs this on its executor, so the bot starts without waiting for the whole of ImageTags.
+    # Deletes wait for the load, a delete in the middle of it would be missing from the index. Inserts are read by
+    # the next refresh.
+    def load_tag_index(self):
+        try:
+            with self.delete_lock:
+                tag_index = TagIndex()
+                with self.connections.reader() as cursor:
+                    tag_index.load(cursor)
+                self.tag_index = tag_index
+        except Exception as e:
+            self.logger.exception(e)
+            self.logger.info("Loading the tag index failed, tag lookups stay in SQLite")
+            return
+
+        self.logger.info("Loaded tag index")
+
+    # images_to_add holds one entry per (image, tag) pair, see PixivDownloader.add_new_images_to_db
+    # Images are deduplicated first, so each row is written once no matter how many tags it has
+    # offsets (tag -> search offset) are written in the same transaction,
+    # so the stored offset of a tag never runs ahead of the images that were stored for it
+    def insert_images(self, images_to_add: list, offsets: dict = None):
+        images = {}
+        image_tags = set()
         for image in images_to_add:
-            self.insert_image_without_commit(file_path=image["file_path"], pixiv_image_id=image["pixiv_image_id"],
-                                             tag=image["tag"],
-                                             safety_level=image["safety_level"], artist=image["artist"])
-
-        self.connection.commit()
+            pixiv_image_id = image["pixiv_image_id"]
+            if pixiv_image_id not in images:
+                images[pixiv_image_id] = (pixiv_image_id, image["file_path"], image["safety_level"],
+                                          image["artist"], random.getrandbits(63), image.get("checksum"),
+                                          image.get("upload_file_path"))
+            image_tags.add((pixiv_image_id, image["tag"]))
+
+        with self.connections.write_lock:
+            try:
+                tag_ids = self.insert_tags_without_commit({tag for _, tag in image_tags})
+
+                query = """
+                        INSERT OR IGNORE INTO Images 
+                        (pixiv_image_id, file_path, safety_level, artist, random_key, checksum, upload_file_path)
+                        VALUES (?,?,?,?,?,?,?)
+                        """
+                self.cursor.executemany(query, images.values())
+
+                # images which were already stored keep their old random_key and safety_level
+                stored_images = self.select_in_chunks(
+                    """
+                    SELECT pixiv_image_id, safety_level, random_key
+                    FROM Images
+                    WHERE pixiv_image_id IN ({placeholders})
+                    """,
+                    list(images)
+                )
+                stored_images = {row["pixiv_image_id"]: row for row in stored_images}
+                stored_image_tags = self.select_in_chunks(
+                    """
+                    SELECT pixiv_image_id, tag_id
+                    FROM ImageTags
+                    WHERE pixiv_image_id IN ({placeholders})
+                    """,
+                    list(images)
+                )
+                stored_image_tags = {(row["pixiv_image_id"], row["tag_id"]) for row in stored_image_tags}
+
+                # safety_level and random_key are copied from Images, so sampling by tag can seek in the tag's index
+                new_image_tags = [(tag_ids[tag], pixiv_image_id, stored_images[pixiv_image_id]["safety_level"],
+                                   stored_images[pixiv_image_id]["random_key"])
+                                  for pixiv_image_id, tag in image_tags
+                                  if (pixiv_image_id, tag_ids[tag]) not in stored_image_tags]
+                query = """
+                        INSERT INTO ImageTags 
+                        (tag_id, pixiv_image_id, safety_level, random_key)
+                        VALUES (?, ?, ?, ?)
+                        """
+                self.cursor.executemany(query, new_image_tags)
+                self.add_tag_stats_without_commit(new_image_tags)
+
+                if offsets:
+                    self.save_offsets_without_commit(offsets)
+
+                self.connection.commit()
+            except BaseException:
+                self.connection.rollback()
+                raise
+
+            # only ids of committed tags are cached, a rolled back tag_id may be handed to another tag
+            self.tag_id_cache.update(tag_ids)
+
+            if self.tag_index is not None:
+                self.tag_index.refresh(self.cursor)
+
+    # Counts the new (tag_id, pixiv_image_id, safety_level, random_key) rows of ImageTags into TagStats,
+    # one UPSERT per tag. Replaces a trigger per row, a tag that was crawled shows up in every image of its batch.
+    def add_tag_stats_without_commit(self, new_image_tags: list):
+        # tag_id -> [image_count, sfw_count, nsfw_count]
+        tag_stats = {}
+        for tag_id, _, safety_level, _ in new_image_tags:
+            stats = tag_stats.setdefault(tag_id, [0, 0, 0])
+            stats[0] += 1
+            if safety_level == 0:
+                stats[1] += 1
+            else:
+                stats[2] += 1
 
-    def insert_image_without_commit(self, file_path: str, pixiv_image_id: int, tag: str,
-                                    safety_level: int, artist: int):
-        # Insert into Images
         query = """
-                INSERT OR IGNORE INTO Images 
-                (pixiv_image_id, file_path, safety_level, artist)
-                VALUES (?,?,?,?)
+                INSERT INTO TagStats 
+                (tag_id, image_count, sfw_count, nsfw_count)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(tag_id) DO UPDATE 
+                SET image_count = image_count + excluded.image_count,
+                    sfw_count = sfw_count + excluded.sfw_count,
+                    nsfw_count = nsfw_count + excluded.nsfw_count
                 """
-        values = [pixiv_image_id, file_path, safety_level, artist]
-        self.cursor.execute(query, values)
+        self.cursor.executemany(query, [(tag_id, *stats) for tag_id, stats in tag_stats.items()])
 
-        # Insert into Tags
-        query = """
-                INSERT OR IGNORE INTO Tags 
-                (tag)
-                VALUES (?)
-                """
-        values = [tag]
-        self.cursor.execute(query, values)
+    def save_offsets(self, offsets: dict):
+        with self.connections.write_lock:
+            self.save_offsets_without_commit(offsets)
+            self.connection.commit()
 
-        # Get tag_id
+    def save_offsets_without_commit(self, offsets: dict):
         query = """
-                SELECT tag_id
-                FROM Tags
-                WHERE tag = ? 
+                INSERT OR REPLACE INTO CrawlOffsets 
+                (tag, offset)
+                VALUES (?, ?)
                 """
-        values = [tag]
-        self.cursor.execute(query, values)
-        row = self.cursor.fetchone()
-        tag_id = row["tag_id"]
+        self.cursor.executemany(query, offsets.items())
+
+    # Returns a tag -> offset dict of all crawled tags
+    def return_offsets(self) -> dict:
+        with self.connections.reader() as cursor:
+            cursor.execute("SELECT tag, offset FROM CrawlOffsets")
+            return {row["tag"]: row["offset"] for row in cursor.fetchall()}
+
+    # Returns a tag -> tag_id dict for all given tags, creating missing tags.
+    # Tags are never deleted, so the ids are kept in tag_id_cache for the lifetime of this object once the
+    # transaction that created them is committed.
+    def insert_tags_without_commit(self, tags: set) -> dict:
+        tag_ids = {tag: self.tag_id_cache[tag] for tag in tags if tag in self.tag_id_cache}
+        uncached_tags = [tag for tag in tags if tag not in tag_ids]
+
+        if uncached_tags:
+            query = """
+                    INSERT OR IGNORE INTO Tags 
+                    (tag)
+                    VALUES (?)
+                    """
+            self.cursor.executemany(query, [[tag] for tag in uncached_tags])
+            tag_ids.update(self.select_tag_ids(self.cursor, uncached_tags))
+
+        return tag_ids
 
-        # Insert into ImageTags
+    def cache_tag_ids(self, cursor, tags: list):
+        self.tag_id_cache.update(self.select_tag_ids(cursor, tags))
+
+    # Returns a tag -> tag_id dict of the given tags that exist
+    def select_tag_ids(self, cursor, tags: list) -> dict:
         query = """
-                INSERT OR IGNORE INTO ImageTags 
-                (tag_id, pixiv_image_id)
-                VALUES (?, ?)
+                SELECT tag, tag_id
+                FROM Tags
+                WHERE tag IN ({placeholders})
                 """
-        values = [tag_id, pixiv_image_id]
-        self.cursor.execute(query, values)
+        return {row["tag"]: row["tag_id"] for row in self.select_in_chunks(query, tags, cursor)}
+
+    # Runs query once per chunk of values, {placeholders} in query is replaced by the placeholders of a chunk
+    def select_in_chunks(self, query: str, values: list, cursor=None) -> list:
+        if cursor is None:
+            cursor = self.cursor
+
+        rows = []
+        # stay well below SQLITE_MAX_VARIABLE_NUMBER
+        chunk_size = 500
+        for chunk_start in range(0, len(values), chunk_size):
+            chunk = values[chunk_start:chunk_start + chunk_size]
+            placeholders = ",".join("?" for _ in chunk)
+            cursor.execute(query.format(placeholders=placeholders), chunk)
+            rows.extend(cursor.fetchall())
+        return rows
 
     def check_if_image_exists(self, pixiv_image_id: int) -> bool:
         query = """
@@ -73,8 +227,9 @@ class PixivDB:
                 WHERE pixiv_image_id = ?                
                 """
 
-        self.cursor.execute(query, [pixiv_image_id])
-        data = self.cursor.fetchone()
+        with self.connections.reader() as cursor:
+            cursor.execute(query, [pixiv_image_id])
+            data = cursor.fetchone()
         if data is None:
             return False
         else:
@@ -86,8 +241,9 @@ class PixivDB:
                 FROM TAGS
                 """
 
-        self.cursor.execute(query)
-        data: list = self.cursor.fetchall()
+        with self.connections.reader() as cursor:
+            cursor.execute(query)
+            data: list = cursor.fetchall()
 
         all_tags = []
 
@@ -99,133 +255,307 @@ class PixivDB:
 
     def return_top_tags(self):
         query = """
-                SELECT tag, count
-                FROM Tags
-                INNER JOIN (
-                    SELECT tag_id, COUNT(*) as count
-                    FROM ImageTags 
-                    GROUP BY tag_id
-                    ORDER BY COUNT(*) DESC     
-                    LIMIT 10       
-                ) ImageTagsTopTen
-                ON Tags.tag_id=ImageTagsTopTen.tag_id
+                SELECT tag, image_count
+                FROM TagStats
+                INNER JOIN Tags
+                ON Tags.tag_id = TagStats.tag_id
+                WHERE image_count > 0
+                ORDER BY image_count DESC
+                LIMIT 10
                 """
-        self.cursor.execute(query)
-        data = dict(self.cursor.fetchall())
+        with self.connections.reader() as cursor:
+            cursor.execute(query)
+            data = dict(cursor.fetchall())
 
         return data
 
-    def return_image(self, tags: list, safety_level: int):
-        safety_condition = "safety_level = ?"
-
-        if tags:
-            where_condition = ""
+    # Returns {tag: (sfw_count, nsfw_count)} of every tag, tags without images count 0
+    def return_tag_image_counts(self) -> dict:
+        query = """
+                SELECT tag, COALESCE(sfw_count, 0) as sfw_count, COALESCE(nsfw_count, 0) as nsfw_count
+                FROM Tags
+                LEFT JOIN TagStats
+                ON Tags.tag_id = TagStats.tag_id
+                """
+        with self.connections.reader() as cursor:
+            cursor.execute(query)
+            data = {row["tag"]: (row["sfw_count"], row["nsfw_count"]) for row in cursor.fetchall()}
 
-            for _ in tags:
-                where_condition += "tag = ? or "
+        return data
 
-            # remove last "or "
-            where_condition = where_condition[:-3]
+    # Returns the tag_ids in the same order as tags, or an empty list if any tag is unknown
+    def return_tag_ids(self, cursor, tags: list) -> list:
+        self.cache_tag_ids(cursor, [tag for tag in tags if tag not in self.tag_id_cache])
 
-            query = f"""
-                    SELECT *
-                    FROM Images
-                    WHERE pixiv_image_id IN (
-                        SELECT pixiv_image_id
-                        FROM ImageTags
-                        WHERE ImageTags.tag_id IN (
-                            SELECT tag_id
-                            FROM Tags
-                            WHERE {where_condition}
-                        )
-                        GROUP BY pixiv_image_id
-                        HAVING COUNT(*) >= ?
-                    )
-                    AND {safety_condition}
-                    ORDER BY RANDOM()
-                    LIMIT 1
-                    """
+        if not all(tag in self.tag_id_cache for tag in tags):
+            return []
 
-            tag_count = len(tags)
-            tags.append(tag_count)
-            tags.append(safety_level)
-            values = tags
+        return [self.tag_id_cache[tag] for tag in tags]
 
+    def return_image(self, tags: list, safety_level: int):
+        images = self.sample_images(tags, safety_level, 1)
+        if images:
+            return images[0]
         else:
-            query = f"""
-                    SELECT * 
-                    FROM Images
-                    WHERE pixiv_image_id IN 
-                        (
-                        SELECT pixiv_image_id 
-                        FROM Images
-                        ORDER BY RANDOM() 
-                        LIMIT 100
-                        )
-                    AND safety_level = ?
-                    LIMIT 1
-                    """
-
-            values = [safety_level]
-
-        self.cursor.execute(query, values)
-        data = self.cursor.fetchone()
+            return {}
 
-        if data is not None:
-            return dict(data)
+    # Every image carries a random_key that is drawn once on insert.
+    # Picking the first images at or after a random point of the key space is an index seek,
+    # so the cost stays logarithmic instead of sorting every candidate with ORDER BY RANDOM().
+    # Returns up to image_count distinct images in random order.
+    def sample_images(self, tags: list, safety_level: int, image_count: int) -> list:
+        with self.connections.reader() as cursor:
+            if tags and self.tag_index is not None:
+                return self.sample_images_from_tag_index(cursor, tags, safety_level, image_count)
+
+            if tags:
+                # the same tag twice would only add a redundant condition
+                tag_ids = list(dict.fromkeys(self.return_tag_ids(cursor, tags)))
+
+                # an unknown tag can't match any image
+                if not tag_ids:
+                    return []
+
+                # the first tag drives the index walk, all other tags have to exist for the same image
+                # starting with the rarest tag keeps the walk short
+                tag_ids = self.sort_tag_ids_by_image_count(cursor, tag_ids, safety_level)
+                other_tags_condition = ""
+                for _ in tag_ids[1:]:
+                    other_tags_condition += """
+                        AND EXISTS (
+                            SELECT 1
+                            FROM ImageTags OtherTags
+                            WHERE OtherTags.pixiv_image_id = ImageTags.pixiv_image_id
+                            AND OtherTags.tag_id = ?
+                        )"""
+
+                query = f"""
+                        SELECT Images.*
+                        FROM ImageTags
+                        INNER JOIN Images
+                        ON Images.pixiv_image_id = ImageTags.pixiv_image_id
+                        WHERE ImageTags.tag_id = ?
+                        AND ImageTags.random_key >= ?
+                        AND ImageTags.safety_level = ?{other_tags_condition}
+                        ORDER BY ImageTags.random_key
+                        LIMIT ?
+                        """
+
+                values = [tag_ids[0], random.getrandbits(63), safety_level] + tag_ids[1:] + [image_count]
+
+            else:
+                query = """
+                        SELECT *
+                        FROM Images
+                        WHERE safety_level = ?
+                        AND random_key >= ?
+                        ORDER BY random_key
+                        LIMIT ?
+                        """
+
+                values = [safety_level, random.getrandbits(63), image_count]
+
+            cursor.execute(query, values)
+            images = {row["pixiv_image_id"]: self.image_from_row(row) for row in cursor.fetchall()}
+
+            # not enough images after the random point, wrap around to the start of the key space
+            if len(images) < image_count:
+                values[1] = 0
+                cursor.execute(query, values)
+                for row in cursor.fetchall():
+                    if len(images) == image_count:
+                        break
+                    images.setdefault(row["pixiv_image_id"], self.image_from_row(row))
+
+        # neighbours in the key space come back sorted by random_key, shuffle them to not always pair them up
+        images = list(images.values())
+        random.shuffle(images)
+        return images
+
+    # safety_level None sorts by the count over all safety levels
+    def sort_tag_ids_by_image_count(self, cursor, tag_ids: list, safety_level) -> list:
+        if len(tag_ids) == 1:
+            return tag_ids
+
+        if safety_level is None:
+            count_column = "image_count"
+        elif safety_level == 0:
+            count_column = "sfw_count"
         else:
-            return {}
+            count_column = "nsfw_count"
+        placeholders = ",".join("?" for _ in tag_ids)
+        query = f"""
+                SELECT tag_id, {count_column} as count
+                FROM TagStats
+                WHERE tag_id IN ({placeholders})
+                """
+        cursor.execute(query, tag_ids)
+        image_counts = dict(cursor.fetchall())
 
-    def return_image_count(self, tags: list):
+        return sorted(tag_ids, key=lambda tag_id: image_counts.get(tag_id, 0))
+
+    def sample_images_from_tag_index(self, cursor, tags: list, safety_level: int, image_count: int) -> list:
+        self.tag_index.refresh(cursor)
 
-        if tags:
-            where_condition = ""
+        tag_ids = self.return_tag_ids(cursor, tags)
+        if not tag_ids:
+            return []
 
-            for _ in tags:
-                where_condition += "tag = ? or "
+        # draws can repeat, small intersections return fewer images than requested
+        pixiv_image_ids = set()
+        for _ in range(image_count):
+            pixiv_image_id = self.tag_index.random_image_id(tag_ids, safety_level)
+            if pixiv_image_id is None:
+                return []
+            pixiv_image_ids.add(pixiv_image_id)
 
-            # remove last "or "
-            where_condition = where_condition[:-3]
+        placeholders = ",".join("?" for _ in pixiv_image_ids)
+        query = f"""
+                SELECT *
+                FROM Images
+                WHERE pixiv_image_id IN ({placeholders})
+                """
+        cursor.execute(query, list(pixiv_image_ids))
+        images = [self.image_from_row(row) for row in cursor.fetchall()]
+
+        random.shuffle(images)
+        return images
+
+    # upload_file_path is what the cog sends, the upload variant if there is one and the original otherwise
+    @staticmethod
+    def image_from_row(row) -> dict:
+        image = dict(row)
+        if image["upload_file_path"] is None:
+            image["upload_file_path"] = image["file_path"]
+        return image
+
+    # Single tags and the whole database are answered from TagStats and ImageStats,
+    # only intersections of several tags have to be computed
+    def return_image_count(self, tags: list):
+        # the same tag twice would only add a redundant condition
+        tags = list(dict.fromkeys(tags))
+
+        if len(tags) > 1 and self.tag_index is not None:
+            with self.connections.reader() as cursor:
+                self.tag_index.refresh(cursor)
+                tag_ids = self.return_tag_ids(cursor, tags)
+
+            if not tag_ids:
+                return 0
+            return self.tag_index.count(tag_ids, self.tag_index.safety_levels())
+
+        if len(tags) > 1:
+            with self.connections.reader() as cursor:
+                tag_ids = self.return_tag_ids(cursor, tags)
+                if not tag_ids:
+                    return 0
+
+                # same shape as return_image, walk the rarest tag and look up the others per image
+                tag_ids = self.sort_tag_ids_by_image_count(cursor, tag_ids, safety_level=None)
+
+            other_tags_condition = ""
+            for _ in tag_ids[1:]:
+                other_tags_condition += """
+                    AND EXISTS (
+                        SELECT 1
+                        FROM ImageTags OtherTags
+                        WHERE OtherTags.pixiv_image_id = ImageTags.pixiv_image_id
+                        AND OtherTags.tag_id = ?
+                    )"""
 
             query = f"""
                     SELECT COUNT(*) as count
-                    FROM(
-                        SELECT pixiv_image_id
-                        FROM ImageTags
-                        WHERE ImageTags.tag_id IN (
-                            SELECT tag_id
-                            FROM Tags
-                            WHERE {where_condition}
-                        )
-                        GROUP BY pixiv_image_id
-                        HAVING COUNT(*) >= ?
-                    )
+                    FROM ImageTags
+                    WHERE ImageTags.tag_id = ?{other_tags_condition}
                     """
+            values = tag_ids
 
-            tag_count = len(tags)
-            tags.append(tag_count)
+        elif tags:
+            query = """
+                    SELECT COALESCE(SUM(image_count), 0) as count
+                    FROM TagStats
+                    INNER JOIN Tags
+                    ON Tags.tag_id = TagStats.tag_id
+                    WHERE tag = ?
+                    """
             values = tags
-            self.cursor.execute(query, values)
 
         else:
-            query = f"""
-                    SELECT COUNT(*) as count
-                    FROM Images
+            query = """
+                    SELECT COALESCE(SUM(image_count), 0) as count
+                    FROM ImageStats
                     """
-            self.cursor.execute(query)
+            values = []
+
+        with self.connections.reader() as cursor:
+            cursor.execute(query, values)
+            data = dict(cursor.fetchone())
 
-        data = dict(self.cursor.fetchone())
         count: int = data["count"]
         return count
 
+    # Returns (sfw_count, nsfw_count) of the images that have all tags
+    def return_image_counts_by_safety(self, tags: list) -> tuple:
+        tags = list(dict.fromkeys(tags))
+
+        if len(tags) == 1:
+            query = """
+                    SELECT COALESCE(SUM(sfw_count), 0) as sfw_count, COALESCE(SUM(nsfw_count), 0) as nsfw_count
+                    FROM TagStats
+                    INNER JOIN Tags
+                    ON Tags.tag_id = TagStats.tag_id
+                    WHERE tag = ?
+                    """
+            with self.connections.reader() as cursor:
+                cursor.execute(query, tags)
+                data = cursor.fetchone()
+            return data["sfw_count"], data["nsfw_count"]
+
+        with self.connections.reader() as cursor:
+            if self.tag_index is not None:
+                self.tag_index.refresh(cursor)
+            tag_ids = self.return_tag_ids(cursor, tags)
+            if not tag_ids:
+                return 0, 0
+
+            if self.tag_index is not None:
+                nsfw_levels = [safety_level for safety_level in self.tag_index.safety_levels() if safety_level != 0]
+                return self.tag_index.count(tag_ids, [0]), self.tag_index.count(tag_ids, nsfw_levels)
+
+            tag_ids = self.sort_tag_ids_by_image_count(cursor, tag_ids, safety_level=None)
+
+            other_tags_condition = ""
+            for _ in tag_ids[1:]:
+                other_tags_condition += """
+                    AND EXISTS (
+                        SELECT 1
+                        FROM ImageTags OtherTags
+                        WHERE OtherTags.pixiv_image_id = ImageTags.pixiv_image_id
+                        AND OtherTags.tag_id = ?
+                    )"""
+
+            query = f"""
+                    SELECT COALESCE(SUM(Images.safety_level = 0), 0) as sfw_count,
+                           COALESCE(SUM(Images.safety_level != 0), 0) as nsfw_count
+                    FROM ImageTags
+                    INNER JOIN Images
+                    ON Images.pixiv_image_id = ImageTags.pixiv_image_id
+                    WHERE ImageTags.tag_id = ?{other_tags_condition}
+                    """
+            cursor.execute(query, tag_ids)
+            data = cursor.fetchone()
+
+        return data["sfw_count"], data["nsfw_count"]
+
     def return_imagetags_row_count(self):
         query = f"""
                 SELECT COUNT(*) as count
                 FROM ImageTags
                 """
 
-        self.cursor.execute(query)
-        data = dict(self.cursor.fetchone())
+        with self.connections.reader() as cursor:
+            cursor.execute(query)
+            data = dict(cursor.fetchone())
         count: int = data["count"]
 
         return count
@@ -236,162 +566,271 @@ class PixivDB:
                 FROM Images
                 """
 
-        self.cursor.execute(query)
-        data = dict(self.cursor.fetchone())
+        with self.connections.reader() as cursor:
+            cursor.execute(query)
+            data = dict(cursor.fetchone())
         count: int = data["count"]
 
         return count
 
-    def remove_tag_and_delete_from_file_system(self, tag: str, nsfw_only: bool):
+    # progress_callback(deleted_count, total_count) is called from the deleting thread after every chunk,
+    # a deletion without images calls it once with (0, 0)
+    def remove_tag_and_delete_from_file_system(self, tag: str, nsfw_only: bool, progress_callback=None):
         self.logger.info("Deleting all images with tag " + tag)
 
         # Get images to delete
         if nsfw_only:
-            query = """
-                    SELECT pixiv_image_id,file_path
-                    FROM Images
-                    WHERE pixiv_image_id in(
-                        SELECT pixiv_image_id
-                        FROM ImageTags
-                        WHERE ImageTags.tag_id IN (
-                            SELECT tag_id
-                            FROM Tags
-                            WHERE tag = ? AND safety_level = 1
-                        )
-                    )
-                    """
-
+            safety_condition = "AND Images.safety_level = 1"
         else:
-            query = """
-                    SELECT pixiv_image_id,file_path
-                    FROM Images
-                    WHERE pixiv_image_id in(
-                        SELECT pixiv_image_id
-                        FROM ImageTags
-                        WHERE ImageTags.tag_id IN (
-                            SELECT tag_id
-                            FROM Tags
-                            WHERE tag = ?
-                        )
-                    )
-                    """
-
-        values = [tag]
-        self.cursor.execute(query, values)
-        rows = self.cursor.fetchall()
+            safety_condition = ""
 
-        # Filter relevant data
-        file_paths = []
-        pixiv_image_ids = []
-        for row in rows:
-            file_paths.append(row["file_path"])
-            pixiv_image_ids.append(int(row["pixiv_image_id"]))
+        query = f"""
+                SELECT Images.pixiv_image_id, Images.file_path, Images.upload_file_path
+                FROM ImageTags
+                INNER JOIN Images
+                ON Images.pixiv_image_id = ImageTags.pixiv_image_id
+                WHERE ImageTags.tag_id = (
+                    SELECT tag_id
+                    FROM Tags
+                    WHERE tag = ?
+                )
+                {safety_condition}
+                """
 
-        self.delete_images_from_file_system(file_paths)
-        self.delete_images_from_database(pixiv_image_ids)
+        values = [tag]
+        return self.delete_images(query, values, progress_callback)
 
-    def remove_artist_and_delete_from_file_system(self, artist: str):
+    def remove_artist_and_delete_from_file_system(self, artist: str, progress_callback=None):
         self.logger.info("Deleting all images with tag " + artist)
 
         # Get images to delete
         query = """
-                SELECT pixiv_image_id,file_path
+                SELECT pixiv_image_id, file_path, upload_file_path
                 FROM Images
                 WHERE artist = ?
                 """
 
         values = [artist]
-        self.cursor.execute(query, values)
-        rows = self.cursor.fetchall()
-
-        # Filter relevant data
-        file_paths = []
-        pixiv_image_ids = []
-        for row in rows:
-            file_paths.append(row["file_path"])
-            pixiv_image_ids.append(int(row["pixiv_image_id"]))
-
-        self.delete_images_from_file_system(file_paths)
-        self.delete_images_from_database(pixiv_image_ids)
+        return self.delete_images(query, values, progress_callback)
 
-    def remove_image_and_delete_from_file_system(self, pixiv_image_id: int):
+    def remove_image_and_delete_from_file_system(self, pixiv_image_id: int, progress_callback=None):
         self.logger.info("Deleting all image with id " + str(pixiv_image_id))
 
         # Get images to delete
         query = """
-                SELECT pixiv_image_id,file_path
+                SELECT pixiv_image_id, file_path, upload_file_path
                 FROM Images
                 WHERE pixiv_image_id = ?
                 """
 
         values = [pixiv_image_id]
-        self.cursor.execute(query, values)
-        rows = self.cursor.fetchall()
-
-        # Filter relevant data
-        file_paths = []
-        pixiv_image_ids = []
-        for row in rows:
-            file_paths.append(row["file_path"])
-            pixiv_image_ids.append(int(row["pixiv_image_id"]))
-
-        self.delete_images_from_file_system(file_paths)
-        self.delete_images_from_database(pixiv_image_ids)
-
-    def delete_images_from_file_system(self, file_paths: list):
-        if file_paths:
-            delete_count = 0
-            for file_path in file_paths:
-                file_to_delete = Path(file_path)
-                try:
-                    file_to_delete.unlink()
-                    delete_count += 1
-                    self.logger.info("Deleted " + file_path)
-                except FileNotFoundError:
-                    self.logger.info(str(FileNotFoundError))
-                    self.logger.info("Failed deleting " + file_path)
-
-            self.logger.info("Delete count: " + str(delete_count))
-            self.connection.commit()
-            self.logger.info("Commited deleting.")
+        return self.delete_images(query, values, progress_callback)
+
+    # Stages the (pixiv_image_id, file_path, upload_file_path) rows of select_query in a temp table and deletes them
+    # chunk by chunk.
+    # Nothing is bound per image, so a purge of any size stays below SQLite's variable limit.
+    # Returns how many images were deleted from the database.
+    def delete_images(self, select_query: str, values: list, progress_callback=None) -> int:
+        # the staging table belongs to the writer connection, so only one deletion runs at a time
+        with self.delete_lock:
+            with self.connections.write_lock:
+                self.create_staging_table()
+                self.cursor.execute("INSERT OR IGNORE INTO temp.ImagesToDelete "
+                                    "(pixiv_image_id, file_path, upload_file_path) " + select_query, values)
+                self.connection.commit()
+
+            return self.delete_staged_images(progress_callback)
+
+    def delete_images_from_database(self, pixiv_image_ids: list, progress_callback=None) -> int:
+        if pixiv_image_ids:
+            with self.delete_lock:
+                with self.connections.write_lock:
+                    self.create_staging_table()
+                    # the file paths stay NULL, only the database entries are deleted
+                    query = """
+                            INSERT OR IGNORE INTO temp.ImagesToDelete (pixiv_image_id)
+                            SELECT pixiv_image_id
+                            FROM Images
+                            WHERE pixiv_image_id = ?
+                            """
+                    self.cursor.executemany(query, [[pixiv_image_id] for pixiv_image_id in pixiv_image_ids])
+                    self.connection.commit()
+
+                return self.delete_staged_images(progress_callback)
 
         else:
-            self.logger.info("No files to delete from file system")
+            self.logger.info("No files to delete from database")
+            if progress_callback is not None:
+                progress_callback(0, 0)
+            return 0
+
+    def create_staging_table(self):
+        self.cursor.execute("""
+                            CREATE TEMP TABLE IF NOT EXISTS ImagesToDelete (
+                                pixiv_image_id INTEGER PRIMARY KEY,
+                                file_path TEXT,
+                                upload_file_path TEXT
+                            )
+                            """)
+        self.cursor.execute("DELETE FROM temp.ImagesToDelete")
+
+    # Every chunk is its own transaction and the write lock is released in between,
+    # so inserts of the fetcher and other writes of the bot can interleave with a long purge.
+    # Files of a chunk are unlinked on a worker pool while the next chunk is deleted.
+    def delete_staged_images(self, progress_callback=None) -> int:
+        with self.connections.write_lock:
+            self.cursor.execute("SELECT COUNT(*) as count FROM temp.ImagesToDelete")
+            total_count = self.cursor.fetchone()["count"]
+
+        if total_count == 0:
+            self.logger.info("No files to delete from database")
+            if progress_callback is not None:
+                progress_callback(0, 0)
+            return 0
 
-    def delete_images_from_database(self, pixiv_image_ids: list):
-        if pixiv_image_ids:
-            where_condition = ""
+        deleted_count = 0
+        file_deletions = []
+        with ThreadPoolExecutor(max_workers=self.file_delete_workers, thread_name_prefix="PixivDelete") as executor:
+            while True:
+                with self.connections.write_lock:
+                    rows = self.delete_next_chunk()
 
-            for _ in pixiv_image_ids:
-                where_condition += "pixiv_image_id = ? or "
+                if not rows:
+                    break
 
-            # remove last "or "
-            where_condition = where_condition[:-3]
+                deleted_count += len(rows)
+                file_paths = [row[column] for row in rows for column in ["file_path", "upload_file_path"]
+                              if row[column] is not None]
+                file_deletions.append(executor.submit(self.delete_images_from_file_system, file_paths))
 
-            delete_images_entries = f"""
-                    DELETE
-                    FROM Images
-                    WHERE {where_condition}
+                self.logger.info("Deleted " + str(deleted_count) + "/" + str(total_count) + " images from database")
+                if progress_callback is not None:
+                    progress_callback(deleted_count, total_count)
+
+            deleted_files = sum(file_deletion.result() for file_deletion in file_deletions)
+
+        self.logger.info("Commited deleting " + str(deleted_count) + " images, " + str(deleted_files) + " files.")
+        return deleted_count
+
+    def delete_next_chunk(self) -> list:
+        query = """
+                SELECT pixiv_image_id, file_path, upload_file_path
+                FROM temp.ImagesToDelete
+                LIMIT ?
+                """
+        self.cursor.execute(query, [self.delete_chunk_size])
+        rows = self.cursor.fetchall()
+        if not rows:
+            return rows
+
+        values = [row["pixiv_image_id"] for row in rows]
+        placeholders = ",".join("?" for _ in values)
+
+        if self.tag_index is not None:
+            deleted_rows_query = f"""
+                    SELECT ImageTags.tag_id, ImageTags.pixiv_image_id, Images.safety_level
+                    FROM ImageTags
+                    INNER JOIN Images
+                    ON Images.pixiv_image_id = ImageTags.pixiv_image_id
+                    WHERE ImageTags.pixiv_image_id IN ({placeholders})
                     """
+            self.cursor.execute(deleted_rows_query, values)
+            deleted_rows = self.cursor.fetchall()
 
-            delete_imagetags_entries = f"""
-                    DELETE
+        # ImageTags first, the TagStats triggers look up the safety_level in Images
+        self.cursor.execute(f"DELETE FROM ImageTags WHERE pixiv_image_id IN ({placeholders})", values)
+        self.cursor.execute(f"DELETE FROM Images WHERE pixiv_image_id IN ({placeholders})", values)
+        self.cursor.execute(f"DELETE FROM temp.ImagesToDelete WHERE pixiv_image_id IN ({placeholders})", values)
+        self.connection.commit()
+
+        if self.tag_index is not None:
+            self.tag_index.remove_rows(deleted_rows, self.cursor)
+
+        return rows
+
+    # Returns how many files were deleted
+    def delete_images_from_file_system(self, file_paths: list) -> int:
+        if not file_paths:
+            self.logger.info("No files to delete from file system")
+            return 0
+
+        delete_count = 0
+        for file_path in file_paths:
+            if self.image_store.delete(file_path):
+                delete_count += 1
+
+        self.logger.info("Deleted " + str(delete_count) + " files")
+        return delete_count
+
+    # Recomputes TagStats and ImageStats and rebuilds both if they drifted from the real counts.
+    # Returns True if they were consistent.
+    def check_stats(self) -> bool:
+        # rows which only exist on one side of computed and stored counts
+        drift_query = """
+                WITH Computed AS ({computed}),
+                Stored AS ({stored})
+                SELECT COUNT(*) as count
+                FROM (
+                    SELECT * FROM (SELECT * FROM Computed EXCEPT SELECT * FROM Stored)
+                    UNION ALL
+                    SELECT * FROM (SELECT * FROM Stored EXCEPT SELECT * FROM Computed)
+                )
+                """
+
+        tag_stats_drift_query = drift_query.format(
+            computed="""
+                    SELECT ImageTags.tag_id, COUNT(*), SUM(Images.safety_level = 0), SUM(Images.safety_level != 0)
                     FROM ImageTags
-                    WHERE {where_condition}
+                    INNER JOIN Images
+                    ON Images.pixiv_image_id = ImageTags.pixiv_image_id
+                    GROUP BY ImageTags.tag_id
+                    """,
+            stored="""
+                    SELECT tag_id, image_count, sfw_count, nsfw_count
+                    FROM TagStats
+                    WHERE image_count != 0
                     """
+        )
 
-            values = pixiv_image_ids
-            self.cursor.execute(delete_images_entries, values)
-            self.cursor.execute(delete_imagetags_entries, values)
-            self.connection.commit()
-            self.logger.info("Commited deleting.")
+        image_stats_drift_query = drift_query.format(
+            computed="""
+                    SELECT safety_level, COUNT(*)
+                    FROM Images
+                    GROUP BY safety_level
+                    """,
+            stored="""
+                    SELECT safety_level, image_count
+                    FROM ImageStats
+                    WHERE image_count != 0
+                    """
+        )
 
-        else:
-            self.logger.info("No files to delete from database")
+        # the write lock and transaction keep inserts from landing in between both sides of the comparison.
+        # IMMEDIATE takes the database write lock before the read, a deferred transaction couldn't upgrade to the
+        # rebuild after another process, like the cog deleting images, committed in between (SQLITE_BUSY_SNAPSHOT).
+        with self.connections.write_lock:
+            self.cursor.execute("BEGIN IMMEDIATE")
+            try:
+                self.cursor.execute(tag_stats_drift_query)
+                tag_stats_drift = self.cursor.fetchone()["count"]
+                self.cursor.execute(image_stats_drift_query)
+                image_stats_drift = self.cursor.fetchone()["count"]
+
+                consistent = tag_stats_drift == 0 and image_stats_drift == 0
+                if not consistent:
+                    self.logger.info("Stats drifted, rebuilding TagStats and ImageStats")
+                    rebuild_stats(self.cursor)
+                self.connection.commit()
+            except BaseException:
+                self.connection.rollback()
+                raise
+
+        return consistent
 
     def log_debug_info(self):
-        self.cursor.execute("SELECT * FROM sqlite_master WHERE type='table'")
+        with self.connections.reader() as cursor:
+            cursor.execute("SELECT * FROM sqlite_master WHERE type='table'")
+            results = cursor.fetchall()
         self.logger.info("Table schema")
-        results = self.cursor.fetchall()
         for row in results:
             self.logger.info(str(dict(row)))
@@ -0,0 +1,82 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from Pixiv.Source.pixiv_db import PixivDB
+
+
+# PixivDB for the discord.py event loop.
+# Every call runs on a bounded thread pool, so a slow query only occupies a worker instead of freezing the bot.
+# A call that exceeds its timeout raises asyncio.TimeoutError, the query itself still finishes on its worker.
+class AsyncPixivDB:
+    def __init__(self, database: str, max_workers: int = 4, query_timeout: float = 10, delete_timeout: float = None,
+                 use_tag_index: bool = False):
+        # one reader connection per worker, so workers never wait for each other's connection
+        self.pixiv_db = PixivDB(database, reader_pool_size=max_workers)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="PixivDB")
+
+        # the tag index loads on a worker, queries use SQLite until it is ready
+        self.tag_index_load = None
+        if use_tag_index:
+            self.tag_index_load = self.executor.submit(self.pixiv_db.load_tag_index)
+
+        self.query_timeout = query_timeout
+        # blacklisting a popular tag can delete 100k images, deletions report progress instead of timing out
+        self.delete_timeout = delete_timeout
+
+    async def run_in_executor(self, timeout: float, function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        call = loop.run_in_executor(self.executor, functools.partial(function, *args, **kwargs))
+        return await asyncio.wait_for(call, timeout=timeout)
+
+    async def insert_images(self, images_to_add: list, offsets: dict = None):
+        return await self.run_in_executor(self.query_timeout, self.pixiv_db.insert_images, images_to_add, offsets)
+
+    async def check_if_image_exists(self, pixiv_image_id: int) -> bool:
+        return await self.run_in_executor(self.query_timeout, self.pixiv_db.check_if_image_exists, pixiv_image_id)
+
+    async def return_all_tags(self) -> list:
+        return await self.run_in_executor(self.query_timeout, self.pixiv_db.return_all_tags)
+
+    async def return_top_tags(self):
+        return await self.run_in_executor(self.query_timeout, self.pixiv_db.return_top_tags)
+
+    async def return_image(self, tags: list, safety_level: int):
+        return await self.run_in_executor(self.query_timeout, self.pixiv_db.return_image, tags, safety_level)
+
+    async def sample_images(self, tags: list, safety_level: int, image_count: int) -> list:
+        return await self.run_in_executor(self.query_timeout, self.pixiv_db.sample_images, tags, safety_level,
+                                          image_count)
+
+    async def return_image_count(self, tags: list):
+        return await self.run_in_executor(self.query_timeout, self.pixiv_db.return_image_count, tags)
+
+    async def return_image_counts_by_safety(self, tags: list) -> tuple:
+        return await self.run_in_executor(self.query_timeout, self.pixiv_db.return_image_counts_by_safety, tags)
+
+    async def return_imagetags_row_count(self):
+        return await self.run_in_executor(self.query_timeout, self.pixiv_db.return_imagetags_row_count)
+
+    async def return_images_row_count(self):
+        return await self.run_in_executor(self.query_timeout, self.pixiv_db.return_images_row_count)
+
+    # progress_callback is called from the worker thread, see PixivDB.delete_images
+    async def remove_tag_and_delete_from_file_system(self, tag: str, nsfw_only: bool, progress_callback=None):
+        return await self.run_in_executor(self.delete_timeout, self.pixiv_db.remove_tag_and_delete_from_file_system,
+                                          tag, nsfw_only, progress_callback)
+
+    async def remove_artist_and_delete_from_file_system(self, artist: str, progress_callback=None):
+        return await self.run_in_executor(self.delete_timeout,
+                                          self.pixiv_db.remove_artist_and_delete_from_file_system, artist,
+                                          progress_callback)
+
+    async def remove_image_and_delete_from_file_system(self, pixiv_image_id: int, progress_callback=None):
+        return await self.run_in_executor(self.delete_timeout,
+                                          self.pixiv_db.remove_image_and_delete_from_file_system, pixiv_image_id,
+                                          progress_callback)
+
+    async def log_debug_info(self):
+        return await self.run_in_executor(self.query_timeout, self.pixiv_db.log_debug_info)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,80 @@
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+
+# The bot and the fetcher open the same pixiv.db from two processes.
+# In WAL mode readers keep reading the last committed snapshot while a writer commits,
+# so queries of the cog no longer stall behind the fetcher's inserts.
+class PixivDBConnectionManager:
+    def __init__(self, db_file_path: Path, reader_pool_size: int = 4, busy_timeout_ms: int = 5000):
+        self.db_file_path = db_file_path
+        self.busy_timeout_ms = busy_timeout_ms
+
+        # Only one connection writes, the lock serializes threads sharing it
+        self.writer = self.open_writer()
+        self.write_lock = threading.RLock()
+
+        # Readers are opened lazily and handed out one thread at a time
+        self.reader_pool_size = reader_pool_size
+        self.readers = queue.Queue()
+        self.opened_readers = 0
+        self.readers_lock = threading.Lock()
+
+    def open_writer(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(str(self.db_file_path), timeout=self.busy_timeout_ms / 1000,
+                                     check_same_thread=False)
+        connection.row_factory = sqlite3.Row
+
+        # journal_mode is stored in the database file, every later connection uses WAL as well
+        connection.execute("PRAGMA journal_mode = WAL")
+        # NORMAL only syncs on checkpoints in WAL mode, a power loss can lose the last commits but never corrupts
+        connection.execute("PRAGMA synchronous = NORMAL")
+        connection.execute(f"PRAGMA busy_timeout = {self.busy_timeout_ms}")
+        return connection
+
+    def open_reader(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(f"file:{self.db_file_path}?mode=ro", uri=True,
+                                     timeout=self.busy_timeout_ms / 1000, check_same_thread=False)
+        connection.row_factory = sqlite3.Row
+        connection.execute(f"PRAGMA busy_timeout = {self.busy_timeout_ms}")
+        return connection
+
+    # Yields a cursor of a read only connection and returns the connection to the pool afterwards.
+    # Blocks while all reader_pool_size connections are in use.
+    @contextmanager
+    def reader(self) -> sqlite3.Cursor:
+        connection = self.acquire_reader()
+        cursor = connection.cursor()
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+            # end the read transaction, otherwise the snapshot stays pinned and the WAL can't be checkpointed
+            connection.rollback()
+            self.readers.put(connection)
+
+    def acquire_reader(self) -> sqlite3.Connection:
+        try:
+            return self.readers.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.readers_lock:
+            if self.opened_readers < self.reader_pool_size:
+                self.opened_readers += 1
+                return self.open_reader()
+
+        return self.readers.get()
+
+    def close(self):
+        with self.write_lock:
+            self.writer.close()
+
+        while True:
+            try:
+                self.readers.get_nowait().close()
+            except queue.Empty:
+                break
@@ -2,11 +2,41 @@ import sqlite3
 from pathlib import Path
 
 
+# Schema changes are applied as numbered migrations.
+# PRAGMA user_version stores how many of them a database already went through,
+# so existing databases are upgraded in place and every migration runs exactly once.
 def initialize_image_table(db_file: str):
     conn = sqlite3.connect(db_file)
+    migrate(conn)
+    conn.close()
+
+
+def migrate(conn: sqlite3.Connection) -> int:
+    # transactions are handled explicitly, every migration and its version bump commit together
+    conn.isolation_level = None
     c = conn.cursor()
 
-    # Create Tables
+    c.execute("PRAGMA user_version")
+    current_version = c.fetchone()[0]
+
+    applied_migrations = 0
+    for version, migration in enumerate(MIGRATIONS[current_version:], start=current_version + 1):
+        c.execute("BEGIN")
+        migration(c)
+        c.execute(f"PRAGMA user_version = {version}")
+        c.execute("COMMIT")
+        applied_migrations += 1
+
+    # refresh the planner statistics after the schema changed
+    if applied_migrations:
+        c.execute("ANALYZE")
+
+    return applied_migrations
+
+
+# Version 1
+# Databases from before versioning have user_version 0 and already contain these tables
+def create_tables(c: sqlite3.Cursor):
     c.execute(
         """
         CREATE TABLE IF NOT EXISTS "Images" (
@@ -58,7 +88,305 @@ def initialize_image_table(db_file: str):
         """
     )
 
-    conn.commit()
+
+# Version 2
+# Random sampling probes these instead of sorting the candidates with ORDER BY RANDOM()
+def add_random_keys(c: sqlite3.Cursor):
+    # some unversioned databases already got the columns
+    add_column_if_missing(c, "Images", "random_key", "integer")
+    add_column_if_missing(c, "ImageTags", "random_key", "INTEGER")
+    backfill_random_keys(c)
+
+    c.execute(
+        """
+        CREATE INDEX IF NOT EXISTS "images_random_index" ON "Images" (
+            "safety_level",
+            "random_key"
+        );
+        """
+    )
+
+    c.execute(
+        """
+        CREATE INDEX IF NOT EXISTS "imagetags_random_index" ON "ImageTags" (
+            "tag_id",
+            "random_key"
+        );
+        """
+    )
+
+
+# Version 3
+# TagStats and ImageStats hold precomputed counts for toptags and database counts.
+# Triggers keep them current in the same transaction as every insert and delete.
+def add_stats_tables(c: sqlite3.Cursor):
+    # nsfw_count covers every safety_level above 0
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS "TagStats" (
+            "tag_id"	    INTEGER,
+            "image_count"	INTEGER NOT NULL DEFAULT 0,
+            "sfw_count"	    INTEGER NOT NULL DEFAULT 0,
+            "nsfw_count"	INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY("tag_id")
+        );
+        """
+    )
+
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS "ImageStats" (
+            "safety_level"	INTEGER,
+            "image_count"	INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY("safety_level")
+        );
+        """
+    )
+
+    c.execute(
+        """
+        CREATE INDEX IF NOT EXISTS "tagstats_count_index" ON "TagStats" (
+            "image_count"
+        );
+        """
+    )
+
+    c.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS "images_insert_stats" AFTER INSERT ON "Images"
+        BEGIN
+            INSERT OR IGNORE INTO ImageStats (safety_level) VALUES (NEW.safety_level);
+            UPDATE ImageStats
+            SET image_count = image_count + 1
+            WHERE safety_level = NEW.safety_level;
+        END;
+        """
+    )
+
+    c.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS "images_delete_stats" AFTER DELETE ON "Images"
+        BEGIN
+            UPDATE ImageStats
+            SET image_count = image_count - 1
+            WHERE safety_level = OLD.safety_level;
+        END;
+        """
+    )
+
+    # The safety_level is read from Images, so ImageTags rows have to be deleted before their image
+    c.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS "imagetags_insert_stats" AFTER INSERT ON "ImageTags"
+        BEGIN
+            INSERT OR IGNORE INTO TagStats (tag_id) VALUES (NEW.tag_id);
+            UPDATE TagStats
+            SET image_count = image_count + 1,
+                sfw_count = sfw_count + COALESCE((
+                    SELECT safety_level = 0 FROM Images WHERE pixiv_image_id = NEW.pixiv_image_id
+                ), 0),
+                nsfw_count = nsfw_count + COALESCE((
+                    SELECT safety_level != 0 FROM Images WHERE pixiv_image_id = NEW.pixiv_image_id
+                ), 0)
+            WHERE tag_id = NEW.tag_id;
+        END;
+        """
+    )
+
+    c.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS "imagetags_delete_stats" AFTER DELETE ON "ImageTags"
+        BEGIN
+            UPDATE TagStats
+            SET image_count = image_count - 1,
+                sfw_count = sfw_count - COALESCE((
+                    SELECT safety_level = 0 FROM Images WHERE pixiv_image_id = OLD.pixiv_image_id
+                ), 0),
+                nsfw_count = nsfw_count - COALESCE((
+                    SELECT safety_level != 0 FROM Images WHERE pixiv_image_id = OLD.pixiv_image_id
+                ), 0)
+            WHERE tag_id = OLD.tag_id;
+        END;
+        """
+    )
+
+    # Databases from before the stats tables existed already hold images
+    rebuild_stats(c)
+
+
+# Version 4
+# Covering indexes for the query shapes the bot runs most, see test_pixiv_db_migrations
+def add_covering_indexes(c: sqlite3.Cursor):
+    # return_image walks (tag_id, random_key) and joins on pixiv_image_id without touching the ImageTags table
+    c.execute('DROP INDEX IF EXISTS "imagetags_random_index"')
+    c.execute(
+        """
+        CREATE INDEX IF NOT EXISTS "imagetags_random_covering_index" ON "ImageTags" (
+            "tag_id",
+            "random_key",
+            "pixiv_image_id"
+        );
+        """
+    )
+
+    # remove_artist_and_delete_from_file_system, pixiv_image_id is the rowid and part of every index
+    c.execute(
+        """
+        CREATE INDEX IF NOT EXISTS "images_artist_index" ON "Images" (
+            "artist",
+            "file_path"
+        );
+        """
+    )
+
+
+# Version 5
+# Search offset of every crawled tag, replaces Resources/offsets.json.
+# The downloader writes it in the same transaction as the images it inserted.
+def add_crawl_offsets(c: sqlite3.Cursor):
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS "CrawlOffsets" (
+            "tag"	    TEXT,
+            "offset"	INTEGER NOT NULL,
+            PRIMARY KEY("tag")
+        );
+        """
+    )
+
+
+# Version 6
+# sha256 of the image file, written by the ImageStore. Images from before the store get theirs from rehome_images.
+def add_image_checksums(c: sqlite3.Cursor):
+    add_column_if_missing(c, "Images", "checksum", "TEXT")
+
+
+# Version 7
+# Re-encoded variant of the image that fits the upload budget, NULL if the original is small enough
+def add_upload_variants(c: sqlite3.Cursor):
+    add_column_if_missing(c, "Images", "upload_file_path", "TEXT")
+
+
+# Version 8
+# PixivDB.insert_images adds the TagStats of a whole batch with one UPSERT per tag instead of a trigger per row.
+# imagetags_index duplicates the leading columns of imagetags_random_covering_index, lookups by image use the
+# primary key, so every inserted ImageTags row had one B-tree more to update than needed.
+def batch_tag_stats(c: sqlite3.Cursor):
+    c.execute('DROP TRIGGER IF EXISTS "imagetags_insert_stats"')
+    c.execute('DROP INDEX IF EXISTS "imagetags_index"')
+
+
+# Version 9
+# remove_artist_and_delete_from_file_system also reads upload_file_path since version 7, the artist index covers it
+def cover_upload_variants_by_artist(c: sqlite3.Cursor):
+    c.execute('DROP INDEX IF EXISTS "images_artist_index"')
+    c.execute(
+        """
+        CREATE INDEX IF NOT EXISTS "images_artist_index" ON "Images" (
+            "artist",
+            "file_path",
+            "upload_file_path"
+        );
+        """
+    )
+
+
+# Version 10
+# The safety_level is copied from Images like the random_key, so sampling a tag at one safety level seeks straight to
+# its images instead of filtering the whole tag, which took a full walk for tags that are almost all sfw.
+def add_image_tag_safety_levels(c: sqlite3.Cursor):
+    add_column_if_missing(c, "ImageTags", "safety_level", "INTEGER")
+    c.execute(
+        """
+        UPDATE ImageTags
+        SET safety_level = (
+            SELECT safety_level
+            FROM Images
+            WHERE Images.pixiv_image_id = ImageTags.pixiv_image_id
+        )
+        WHERE safety_level IS NULL
+        """
+    )
+
+    c.execute('DROP INDEX IF EXISTS "imagetags_random_covering_index"')
+    c.execute(
+        """
+        CREATE INDEX IF NOT EXISTS "imagetags_safety_random_index" ON "ImageTags" (
+            "tag_id",
+            "safety_level",
+            "random_key",
+            "pixiv_image_id"
+        );
+        """
+    )
+
+
+def rebuild_stats(c: sqlite3.Cursor):
+    c.execute("DELETE FROM TagStats")
+    c.execute(
+        """
+        INSERT INTO TagStats (tag_id, image_count, sfw_count, nsfw_count)
+        SELECT ImageTags.tag_id, COUNT(*), SUM(Images.safety_level = 0), SUM(Images.safety_level != 0)
+        FROM ImageTags
+        INNER JOIN Images
+        ON Images.pixiv_image_id = ImageTags.pixiv_image_id
+        GROUP BY ImageTags.tag_id
+        """
+    )
+
+    c.execute("DELETE FROM ImageStats")
+    c.execute(
+        """
+        INSERT INTO ImageStats (safety_level, image_count)
+        SELECT safety_level, COUNT(*)
+        FROM Images
+        GROUP BY safety_level
+        """
+    )
+
+
+def add_column_if_missing(c: sqlite3.Cursor, table: str, column: str, column_type: str):
+    c.execute(f'PRAGMA table_info("{table}")')
+    existing_columns = [row[1] for row in c.fetchall()]
+    if column not in existing_columns:
+        c.execute(f'ALTER TABLE "{table}" ADD COLUMN "{column}" {column_type}')
+
+
+# random() is a signed 64 bit integer, masking it keeps the keys in the same range as random.getrandbits(63)
+def backfill_random_keys(c: sqlite3.Cursor):
+    c.execute(
+        """
+        UPDATE Images
+        SET random_key = random() & 9223372036854775807
+        WHERE random_key IS NULL
+        """
+    )
+
+    c.execute(
+        """
+        UPDATE ImageTags
+        SET random_key = (
+            SELECT random_key
+            FROM Images
+            WHERE Images.pixiv_image_id = ImageTags.pixiv_image_id
+        )
+        WHERE random_key IS NULL
+        """
+    )
+
+
+MIGRATIONS = [
+    create_tables,
+    add_random_keys,
+    add_stats_tables,
+    add_covering_indexes,
+    add_crawl_offsets,
+    add_image_checksums,
+    add_upload_variants,
+    batch_tag_stats,
+    cover_upload_variants_by_artist,
+    add_image_tag_safety_levels,
+]
 
 
 def print_schema(db_file: str):
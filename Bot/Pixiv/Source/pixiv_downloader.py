@@ -1,13 +1,21 @@
 import configparser
+import itertools
 import json
 import logging
-from collections import defaultdict
+import multiprocessing
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 
 import schedule
 from pixivpy3 import *
 
+from Pixiv.Source.pixiv_auth import PixivTokenManager
+from Pixiv.Source.pixiv_blacklist import BlacklistMatcher
 from Pixiv.Source.pixiv_db import PixivDB
+from Pixiv.Source.pixiv_http import ConnectionStats, mount_pooled_adapter, raise_for_image_errors
+from Pixiv.Source.pixiv_image_variants import encode_upload_variant
+from Pixiv.Source.pixiv_rate_limiter import PixivRateLimiter
 
 
 def list_to_file(file_path: str, line_list: list):
@@ -16,32 +24,31 @@ def list_to_file(file_path: str, line_list: list):
             file.write(line + "\n")
 
 
-def file_to_list(file_path: str) -> list:
-    line_list = []
-    with open(file_path, "r") as file:
-        lines = file.readlines()
-        for line in lines:
-            line_list.append(line.rstrip())
-
-    return line_list
-
-
-# pixiv tags_list are kv pairs of tag:translated_tag
-# return True if any tag in the tags_list is part of the blacklist
-def tags_in_blacklist(tags: list, blacklist: list) -> bool:
-    contains_banned_word = False
-    for tag_pair in tags:
-        if "name" in tag_pair:
-            if tag_pair["name"] in blacklist:
-                contains_banned_word = True
-        if "translated_name" in tag_pair:
-            if tag_pair["translated_name"] in blacklist:
-                contains_banned_word = True
-    return contains_banned_word
-
-
+# add a seperate entry for all tags
+# both englisch and japanese version
+# we only append, non NULL tags
+def illustration_to_entries(illustration, file_path: str, checksum: str = None, upload_file_path: str = None) -> list:
+    entries = []
+    for tag_kv in illustration.tags:
+        for name in ["name", "translated_name"]:
+            if tag_kv[name] is not None:
+                entries.append({"file_path": file_path, "tag": tag_kv[name].lower(),
+                                "pixiv_image_id": illustration.id,
+                                "safety_level": illustration.x_restrict, "artist": illustration.user.id,
+                                "checksum": checksum, "upload_file_path": upload_file_path})
+    return entries
+
+
+# api is an AppPixivAPI by default. Any client with the same auth, set_auth, search_illust, parse_qs and download
+# methods and a requests session can replace it, like the offline FakePixivAPI of pixiv_fake_api.
+# Clients other than the default should get their own credentials_path, the real one belongs to the pixiv account.
+#
+# refresh_token logs into another account than the one of the config.ini, see PixivFetcherPool.
+# writer receives the inserts and offsets with the insert_images(images_to_add, offsets) and save_offsets(offsets)
+# methods of PixivDB, by default the downloader writes into its own PixivDB.
 class PixivDownloader:
-    def __init__(self, database: str):
+    def __init__(self, database: str, api=None, credentials_path: Path = None, refresh_token: str = None,
+                 writer=None):
         self.logger = logging.getLogger()
         logging.basicConfig(
             level=logging.INFO,
@@ -55,190 +62,394 @@ class PixivDownloader:
         config.read(str(config_path))
 
         # Login to API
-        self.refresh_token = config["pixiv"]["refresh_token"]
-        self.api = AppPixivAPI()
-        self.api.auth(refresh_token=self.refresh_token)
+        self.refresh_token = refresh_token if refresh_token is not None else config["pixiv"]["refresh_token"]
+        self.api = api if api is not None else AppPixivAPI()
+
+        # Search, downloads and fetch_single_image_link share one pool of keep-alive connections.
+        # One connection per download worker, plus a few for the API requests.
+        download_workers = config.getint("pixiv", "download_workers", fallback=8)
+        self.http_stats = ConnectionStats()
+        # Every request takes a token, search and images have separate budgets that back off when pixiv throttles
+        self.rate_limiter = PixivRateLimiter(
+            search_rate=config.getfloat("pixiv", "search_requests_per_second", fallback=1.0),
+            download_rate=config.getfloat("pixiv", "image_requests_per_second", fallback=10.0)
+        )
+        mount_pooled_adapter(self.api.requests, self.http_stats, pool_maxsize=download_workers + 4,
+                             rate_limiter=self.rate_limiter)
+        self.api.requests.hooks["response"].append(raise_for_image_errors)
+
+        # The access token is refreshed before it expires, the bot and the fetcher share it through credentials.json
+        pixiv_dir = Path(__file__).parent.parent.resolve()
+        if credentials_path is None:
+            credentials_path = (pixiv_dir / 'Resources' / 'credentials.json').resolve()
+        self.tokens = PixivTokenManager(self.api, self.refresh_token, credentials_path=credentials_path)
+        self.tokens.ensure_token()
+        self.tokens.start()
 
         # Create Database
-        discordbot_dir = Path(__file__).parent.parent.parent.parent.resolve()
-        self.images_directory_path = (discordbot_dir / 'DB' / database / 'Images').resolve()
         self.db = PixivDB(database)
+        self.image_store = self.db.image_store
+        self.writer = writer if writer is not None else self.db
+
+        # Images of a page are downloaded in parallel, a batch takes about one round trip instead of one per image
+        self.download_workers = download_workers
+        self.download_executor = ThreadPoolExecutor(max_workers=download_workers, thread_name_prefix="Download")
+
+        # Images above upload_variant_bytes get a re-encoded variant for uploads, see encode_variants.
+        # Encoding is CPU bound, it runs on processes so it neither holds the GIL nor blocks the crawl.
+        # spawn instead of fork, the downloader already runs threads when the pool starts its workers.
+        self.upload_variant_bytes = config.getint("pixiv", "upload_variant_bytes", fallback=262144)
+        self.variant_workers = config.getint("pixiv", "variant_workers", fallback=2)
+        self.variant_executor = ProcessPoolExecutor(max_workers=self.variant_workers,
+                                                    mp_context=multiprocessing.get_context("spawn"))
+
+        # Streaming crawl, see add_new_images_to_db
+        # tag -> {"illustrations": rest of the last search page, "next_page": parse_qs of its next_url,
+        #         "last_page": whether the search results end after the illustrations}
+        self.crawls = OrderedDict()
+        self.max_crawls = 200
+        self.pages_per_download = config.getint("pixiv", "pages_per_download", fallback=3)
+        self.insert_batch_size = 10
 
         # Setup blacklists
         bot_dir = Path(__file__).parent.parent.parent.resolve()
-
-        self.blacklisted_tags_path = (bot_dir / 'Cogs' / 'Resources' / 'blacklist.txt').resolve()
-        self.blacklisted_tags = file_to_list(self.blacklisted_tags_path)
-
-        self.blacklisted_tags_path_nsfw = (bot_dir / 'Cogs' / 'Resources' / 'blacklist-nsfw.txt').resolve()
-        self.blacklisted_tags_nsfw = file_to_list(self.blacklisted_tags_path_nsfw)
-
-        self.blacklisted_artists_path = (bot_dir / 'Cogs' / 'Resources' / 'artist-blacklist.txt').resolve()
-        self.blacklisted_artists = file_to_list(self.blacklisted_artists_path)
+        self.blacklists = BlacklistMatcher(
+            tags_path=(bot_dir / 'Cogs' / 'Resources' / 'blacklist.txt').resolve(),
+            nsfw_tags_path=(bot_dir / 'Cogs' / 'Resources' / 'blacklist-nsfw.txt').resolve(),
+            artists_path=(bot_dir / 'Cogs' / 'Resources' / 'artist-blacklist.txt').resolve()
+        )
 
         # Setup offsets
-        pixiv_dir = Path(__file__).parent.parent.resolve()
-        self.offsets_file_path = (pixiv_dir / 'Resources' / 'offsets.json').resolve()
-        with open(self.offsets_file_path) as f:
-            self.offsets = defaultdict(int, json.loads(f.read()))
+        # They are stored in the CrawlOffsets table, saved_offsets holds what is stored so only changed tags are written
+        self.saved_offsets = self.db.return_offsets()
+        if not self.saved_offsets:
+            self.import_offsets_file((pixiv_dir / 'Resources' / 'offsets.json').resolve())
+        self.offsets = defaultdict(int, self.saved_offsets)
 
         # schedule events
-        schedule.every(1).minutes.do(self.dump_offsets_to_file)  # development
         schedule.every(1).minutes.do(self.update_blacklists)  # development
-
+        schedule.every(10).minutes.do(self.log_http_stats)
+
+    # The crawl is a chain of generators, every stage only pulls from the previous one when it needs the next item:
+    #   crawl_pages -> filter_illustrations -> download_illustrations -> encode_variants -> insert_illustrations
+    # so a fetched search page is used up before the next one is requested, and no more illustrations are taken
+    # from a page than free download slots. The rest of a page is kept for the next call with the same tag.
+    # Every illustration travels with the offset right after it, insert_illustrations stores the offset of the last
+    # illustration it handled together with the images, so a crash never skips illustrations that were still in flight.
+    # An error in the middle of the crawl discards the files of everything that wasn't inserted and goes back to the
+    # last stored offset, the discarded illustrations are crawled again by the next call.
     def add_new_images_to_db(self, tag: str, amount_of_images_to_download: int):
+        start_offset = self.offsets[tag]
+        self.logger.info("Offset " + str(start_offset))
 
+        downloads = None
+        encodings = None
         try:
-            self.logger.info("Offset " + str(self.offsets[tag]))
-            response = self.api.search_illust(word=tag, search_target="exact_match_for_tags", offset=self.offsets[tag])
+            illustrations = self.filter_illustrations(tag, self.crawl_pages(tag))
+            downloads = self.download_illustrations(itertools.islice(illustrations, amount_of_images_to_download))
+            encodings = self.encode_variants(downloads)
+            attempted_count, inserted_count = self.insert_illustrations(tag, encodings)
 
-            if "error" in response:
-                self.logger.info("Error in response")
-                self.logger.info(str(response))
+            self.logger.info("Downloaded " + str(inserted_count) + "/" + str(attempted_count) + " images")
 
-                # refresh login just in case
-                self.api.auth(refresh_token=self.refresh_token)
-
-                # offset limit is 5000, just reset it when reached
-                if self.offsets[tag] >= 5000:
-                    self.logger.info("Reset offset")
-                    self.offsets[tag] = 0
+            # A single failed image is skipped, it comes around again once the offset is reset.
+            # If every download failed pixiv is probably unreachable, so the same illustrations are requested again.
+            if attempted_count and not inserted_count:
+                self.logger.info("All downloads failed, resetting offset to " + str(start_offset))
+                self.offsets[tag] = start_offset
+                self.crawls.pop(tag, None)
 
+        except Exception as e:
+            self.logger.exception(e)
+            self.logger.info("Error when requesting illustrations")
+            # the stages discard their pending downloads and encodings when they are closed
+            for stage in [encodings, downloads]:
+                if stage is not None:
+                    stage.close()
+            # the next call starts over from the offset of the last inserted illustration
+            self.offsets[tag] = self.saved_offsets.get(tag, start_offset)
+            self.crawls.pop(tag, None)
+
+        # skipped illustrations and resets at the end of the results aren't part of an insert
+        self.save_offset(tag)
+
+    # Yields (offset, illustration) for the search results of tag, starting at offsets[tag].
+    # Illustrations which aren't consumed in this call stay in the crawl state for the next call.
+    # At most pages_per_download new pages are requested per call, a tag whose results are all known already
+    # shouldn't use up the API budget.
+    def crawl_pages(self, tag: str):
+        crawl = self.crawls.pop(tag, None)
+        if crawl is None:
+            crawl = {"illustrations": deque(), "next_page": None, "last_page": False}
+        # most recently used last, only the newest max_crawls tags keep a page
+        self.crawls[tag] = crawl
+        while len(self.crawls) > self.max_crawls:
+            self.crawls.popitem(last=False)
+
+        requested_pages = 0
+        while True:
+            while crawl["illustrations"]:
+                # the offset always points at the first illustration that wasn't consumed yet
+                self.offsets[tag] += 1
+                yield self.offsets[tag], crawl["illustrations"].popleft()
+
+            if crawl["last_page"]:
+                # end of the search results, new uploads show up at the start again
+                self.logger.info("Reached the end of " + tag + ", resetting offset")
+                self.offsets[tag] = 0
+                crawl["last_page"] = False
                 return
 
-            if "illusts" not in response:
-                self.logger.info("illusts not in response")
-                self.logger.info(str(response))
+            if requested_pages == self.pages_per_download:
                 return
 
-            illustrations_to_insert = []
-            illustration_number = 0
-
-            for illustration in response.illusts:
-
-                # Only download a certain amount of images
-                if illustration_number == amount_of_images_to_download:
-                    break
-
-                # get relevant info
-                pixiv_image_id: str = str(illustration.id)
-                safety_level: int = illustration.x_restrict  # 0 -> sfw, 1 -> nsfw, 2 -> nsfl
-                artist: str = str(illustration.user.id)
-
-                # check blacklists
-                tags: list = illustration.tags
+            response = self.request_page(tag, crawl["next_page"])
+            requested_pages += 1
+            if response is None:
+                return
 
-                # blacklisted artists
-                if artist in self.blacklisted_artists:
-                    self.logger.info("Skipped download " + pixiv_image_id + " due to blacklisted artist.")
-                    continue
+            crawl["illustrations"].extend(response.illusts)
+            if response.next_url:
+                crawl["next_page"] = self.api.parse_qs(response.next_url)
+            else:
+                crawl["next_page"] = None
+                crawl["last_page"] = True
+
+    # Returns the next search page, or None if there is nothing to crawl right now
+    def request_page(self, tag: str, next_page):
+        self.tokens.ensure_token()
+        if next_page is not None:
+            response = self.api.search_illust(**next_page)
+        else:
+            response = self.api.search_illust(word=tag, search_target="exact_match_for_tags",
+                                              offset=self.offsets[tag])
+
+        if "error" in response:
+            self.logger.info("Error in response")
+            self.logger.info(str(response))
+
+            # refresh login just in case
+            self.tokens.refresh_after_error()
+
+            # offset limit is 5000, just reset it when reached
+            if self.offsets[tag] >= 5000:
+                self.logger.info("Reset offset")
+                self.offsets[tag] = 0
+
+            self.crawls.pop(tag, None)
+            return None
+
+        if "illusts" not in response:
+            self.logger.info("illusts not in response")
+            self.logger.info(str(response))
+            return None
+
+        return response
+
+    # Yields the (offset, illustration) pairs which pass the blacklists and aren't in the database yet
+    def filter_illustrations(self, tag: str, illustrations):
+        for offset, illustration in illustrations:
+            pixiv_image_id: str = str(illustration.id)
+
+            # check blacklists
+            blocked_reason = self.blacklists.blocked_reason(illustration)
+            if blocked_reason is not None:
+                self.logger.info("Skipped download " + pixiv_image_id + " due to " + blocked_reason + ".")
+                continue
+
+            # Check if it is a multiimage
+            # Ignored for now, we only download the first post of a multimage
+            # if illustration.metapages:
+
+            # Check if image is already in DB
+            if self.db.check_if_image_exists(illustration.id):
+                self.logger.info("Illustration " + pixiv_image_id + " already in DB. Skipping.")
+                continue
+
+            yield offset, illustration
+
+    # Downloads the medium size of the illustrations in parallel, with at most download_workers in flight.
+    # Yields (offset, illustration, stored_file) for every illustration, stored_file is the (file_path, checksum)
+    # of the image in the image_store or None if the download failed.
+    def download_illustrations(self, illustrations):
+        downloads = deque()
+        try:
+            for offset, illustration in illustrations:
+                download = self.download_executor.submit(self.download_illustration, illustration)
+                downloads.append((offset, illustration, download))
+
+                # backpressure, only take the next illustration once a download slot is free
+                if len(downloads) >= self.download_workers:
+                    yield self.finished_download(downloads.popleft())
+
+            while downloads:
+                yield self.finished_download(downloads.popleft())
+        finally:
+            # only left if the crawl failed or was closed early
+            for _, _, download in downloads:
+                if not download.cancel() and download.result() is not None:
+                    self.image_store.delete(download.result()[0])
+
+    @staticmethod
+    def finished_download(download: tuple) -> tuple:
+        offset, illustration, future = download
+        return offset, illustration, future.result()
+
+    # Encodes upload variants of the downloaded images on the variant_executor, with at most variant_workers
+    # images per worker in flight. Yields (offset, illustration, stored_file, upload_file_path) in download order,
+    # upload_file_path is None if the original is small enough or the encoding failed.
+    def encode_variants(self, downloads):
+        encodings = deque()
+        try:
+            for offset, illustration, stored_file in downloads:
+                encoding = None
+                if stored_file is not None:
+                    encoding = self.variant_executor.submit(encode_upload_variant, stored_file[0],
+                                                            self.upload_variant_bytes)
+                encodings.append((offset, illustration, stored_file, encoding))
+
+                if len(encodings) >= 2 * self.variant_workers:
+                    yield self.finished_encoding(encodings.popleft())
+
+            while encodings:
+                yield self.finished_encoding(encodings.popleft())
+        finally:
+            # only left if the crawl failed or was closed early, the variants are written after the encoding so the
+            # originals are the only files
+            for _, _, stored_file, encoding in encodings:
+                if encoding is not None:
+                    encoding.cancel()
+                if stored_file is not None:
+                    self.image_store.delete(stored_file[0])
+
+    def finished_encoding(self, encoding: tuple) -> tuple:
+        offset, illustration, stored_file, future = encoding
+        if future is None:
+            return offset, illustration, stored_file, None
 
-                # blacklist tags
-                if tags_in_blacklist(tags, self.blacklisted_tags):
-                    self.logger.info("Skipped download " + pixiv_image_id + " due to completly banned tag.")
-                    continue
+        try:
+            variant = future.result()
+            if variant is None:
+                return offset, illustration, stored_file, None
+
+            upload_file_path, _ = self.image_store.write(illustration.id, "webp", lambda file: file.write(variant),
+                                                         variant="upload")
+            self.logger.info("Encoded upload variant of " + str(illustration.id) + ", " + str(len(variant))
+                             + " bytes")
+            return offset, illustration, stored_file, upload_file_path
+        except Exception as e:
+            # the original is uploaded instead
+            self.logger.exception(e)
+            self.logger.info("Error when encoding the upload variant of " + str(illustration.id))
+            return offset, illustration, stored_file, None
+
+    # Inserts downloaded illustrations in batches of insert_batch_size, returns (attempted, inserted) counts.
+    # Every batch stores the offset of tag after its last illustration in the same transaction.
+    # If the crawl or an insert fails, the files of the batch that wasn't inserted are deleted.
+    def insert_illustrations(self, tag: str, downloads) -> tuple:
+        attempted_count = 0
+        inserted_count = 0
+        illustrations_to_insert = []
+        batch_file_paths = []
+        batch_offset = None
 
-                # blacklisted tags for nsfw art
-                if tags_in_blacklist(tags, self.blacklisted_tags_nsfw) and safety_level == 1:
-                    self.logger.info("Skipped download " + pixiv_image_id + " due to nsfw banned tag.")
+        try:
+            for offset, illustration, stored_file, upload_file_path in downloads:
+                attempted_count += 1
+                batch_offset = offset
+                if stored_file is None:
                     continue
 
-                # Check if it is a multiimage
-                # Ignored for now, we only download the first post of a multimage
-                # if illustration.metapages:
-
-                fileformat: str = illustration.image_urls.medium.split(".")[-1]
-                file_save_name: str = pixiv_image_id + "." + fileformat
-                file_path_medium = str(self.images_directory_path) + "/" + pixiv_image_id + "." + fileformat
-
-                # Check if image is already in DB
-                in_db = self.db.check_if_image_exists(illustration.id)
-                if not in_db:
-                    # Download medium
-                    try:
-                        self.api.download(
-                            url=illustration.image_urls.medium,
-                            path=self.images_directory_path,
-                            name=file_save_name
-                        )
-                        self.logger.info("Downloaded " + file_save_name)
-                    except Exception as e:
-                        self.logger.exception(e)
-                        self.logger.info("Error when downloading illustration " + file_save_name)
-                        break
-
-                    # add a seperate entry for all tags
-                    # both englisch and japanese version
-                    # we only append, non NULL tags
-                    for tag_kv in tags:
-                        new_entry_english = {"file_path": file_path_medium, "tag": "",
-                                             "pixiv_image_id": illustration.id,
-                                             "safety_level": safety_level, "artist": illustration.user.id}
-
-                        new_entry_japanese = {"file_path": file_path_medium, "tag": "",
-                                              "pixiv_image_id": illustration.id,
-                                              "safety_level": safety_level, "artist": illustration.user.id}
-
-                        if tag_kv["name"] is not None:
-                            new_entry_english["tag"] = tag_kv["name"].lower()
-                            illustrations_to_insert.append(new_entry_english)
-
-                        if tag_kv["translated_name"] is not None:
-                            new_entry_japanese["tag"] = tag_kv["translated_name"].lower()
-                            illustrations_to_insert.append(new_entry_japanese)
-
-                else:
-                    self.logger.info("Illustration " + file_save_name + " already in DB. Skipping.")
-
-                illustration_number += 1
-
-            # insert all collected entries at once
-            self.db.insert_images(illustrations_to_insert)
-            self.offsets[tag] += illustration_number
-            self.logger.info("Committed downloaded images.")
-
+                # the order of the entries doesn't matter, insert_images sorts them out by pixiv_image_id
+                file_path, checksum = stored_file
+                illustrations_to_insert += illustration_to_entries(illustration, file_path, checksum,
+                                                                   upload_file_path)
+                batch_file_paths += [file_path] if upload_file_path is None else [file_path, upload_file_path]
+                inserted_count += 1
+
+                if inserted_count % self.insert_batch_size == 0:
+                    self.insert_batch(tag, illustrations_to_insert, batch_offset)
+                    illustrations_to_insert = []
+                    batch_file_paths = []
+
+            if illustrations_to_insert:
+                self.insert_batch(tag, illustrations_to_insert, batch_offset)
+                batch_file_paths = []
+        except BaseException:
+            for file_path in batch_file_paths:
+                self.image_store.delete(file_path)
+            raise
+
+        return attempted_count, inserted_count
+
+    def insert_batch(self, tag: str, illustrations_to_insert: list, offset: int):
+        self.writer.insert_images(illustrations_to_insert, offsets={tag: offset})
+        self.saved_offsets[tag] = offset
+        self.logger.info("Committed downloaded images.")
+
+    # Runs on the download_executor, an error only affects this one illustration.
+    # Returns (file_path, checksum), or None if the download failed. A failed download leaves no file behind.
+    def download_illustration(self, illustration):
+        url = illustration.image_urls.medium
+        fileformat: str = url.split(".")[-1]
+        try:
+            stored_file = self.image_store.write(illustration.id, fileformat,
+                                                 lambda file: self.api.download(url=url, fname=file))
+            self.logger.info("Downloaded " + str(illustration.id) + "." + fileformat)
+            return stored_file
         except Exception as e:
             self.logger.exception(e)
-            self.logger.info("Error when requesting illustrations")
+            self.logger.info("Error when downloading illustration " + str(illustration.id) + "." + fileformat)
+            return None
 
-    def dump_offsets_to_file(self):
-        self.logger.info("Dumping offsets to file")
-        with open(self.offsets_file_path, 'w') as f:
-            json.dump(self.offsets, f)
+    # Only writes if the offset changed since it was stored
+    def save_offset(self, tag: str):
+        if self.saved_offsets.get(tag) != self.offsets[tag]:
+            self.writer.save_offsets({tag: self.offsets[tag]})
+            self.saved_offsets[tag] = self.offsets[tag]
 
-    def update_blacklists(self):
-        self.logger.info("Updated blacklisted tags")
-        self.blacklisted_tags = file_to_list(self.blacklisted_tags_path)
-        self.blacklisted_tags_nsfw = file_to_list(self.blacklisted_tags_path_nsfw)
-        self.blacklisted_artists = file_to_list(self.blacklisted_artists_path)
-        self.logger.info(str(self.blacklisted_tags))
-        self.logger.info(str(self.blacklisted_tags_nsfw))
-        self.logger.info(str(self.blacklisted_artists))
-
-    def fetch_single_image_link(self, tag: str, safety_level: int) -> str:
+    # Databases from before the CrawlOffsets table start with the offsets of the old offsets.json
+    def import_offsets_file(self, offsets_file_path: Path):
         try:
+            with open(offsets_file_path) as f:
+                offsets = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        if offsets:
+            self.writer.save_offsets(offsets)
+            self.saved_offsets = dict(offsets)
+            self.logger.info("Imported " + str(len(offsets)) + " offsets from " + str(offsets_file_path))
+
+    def log_http_stats(self):
+        self.logger.info("HTTP " + self.http_stats.summary() + ", search "
+                         + f"{self.rate_limiter.search.rate:.2f}" + "/s, images "
+                         + f"{self.rate_limiter.download.rate:.2f}" + "/s")
+
+    # the cog writes the blacklist files, they are only parsed again after a change
+    def update_blacklists(self):
+        if self.blacklists.reload():
+            self.logger.info("Updated blacklists: " + str(len(self.blacklists.tags)) + " tags, "
+                             + str(len(self.blacklists.nsfw_tags)) + " nsfw tags, "
+                             + str(len(self.blacklists.artists)) + " artists")
+
+    # Links to the artworks of the first search page of tag with the given safety_level, in search order.
+    # Raises PixivError if pixiv still answers with an error after three retries.
+    # Blocks for a live search, the bot calls it through ImageLinkFetcher.
+    def search_image_links(self, tag: str, safety_level: int) -> list:
+        self.tokens.ensure_token()
+        response = self.api.search_illust(word=tag, search_target="exact_match_for_tags")
+
+        attempt = 0
+        while "error" in response and attempt < 3:
+            attempt += 1
+            self.logger.info("Error in response")
+            self.logger.info(str(response))
+            self.tokens.refresh_after_error()
             response = self.api.search_illust(word=tag, search_target="exact_match_for_tags")
 
-            attempt = 0
-            while "error" in response and attempt < 3:
-                attempt += 1
-                self.logger.info("Error in response")
-                self.logger.info(str(response))
-                self.api.auth(refresh_token=self.refresh_token)
-                response = self.api.search_illust(word=tag, search_target="exact_match_for_tags")
-
-            for illustration in response.illusts:
-                if illustration.x_restrict == safety_level:
-                    pixiv_image_id: str = str(illustration.id)
-                    return "https://www.pixiv.net/en/artworks/" + pixiv_image_id
+        if "error" in response:
+            raise PixivError("Searching " + tag + " failed: " + str(response.error))
 
-            else:
-                if safety_level == 1:
-                    safety_level_text = "nsfw"
-                else:
-                    safety_level_text = "sfw"
-                return "No " + safety_level_text + " images with this tag exist currently."
-
-        except Exception as e:
-            self.logger.exception(e)
-            self.logger.info("Error when requesting illustrations")
+        return ["https://www.pixiv.net/en/artworks/" + str(illustration.id)
+                for illustration in response.illusts if illustration.x_restrict == safety_level]
@@ -0,0 +1,137 @@
+import io
+import json
+import random
+import threading
+import time
+from urllib.parse import urlencode
+
+import requests
+from PIL import Image
+from pixivpy3 import AppPixivAPI, PixivError
+from pixivpy3.utils import JsonDict
+
+
+# Offline stand-in for AppPixivAPI, pass it to PixivDownloader(api=...).
+#
+# It implements the part of AppPixivAPI the downloader uses:
+#   auth, set_auth, access_token, refresh_token, user_id, search_illust, parse_qs, download, requests
+# search_illust replays recorded search results, see record_search_pages, and download serves image_bytes.
+# Every call waits search_latency or download_latency seconds and fails with search_error_rate or
+# download_error_rate, failures look like those of pixiv: an error json for searches and an exception for downloads.
+#
+# search_results maps a tag to the illustrations of its search, in the order pixiv returned them. They are served in
+# pages of page_size from the requested offset, with a next_url as long as there are more.
+class FakePixivAPI:
+    def __init__(self, search_results: dict, page_size: int = 30, image_bytes: bytes = None,
+                 search_latency: float = 0.0, download_latency: float = 0.0,
+                 search_error_rate: float = 0.0, download_error_rate: float = 0.0, seed: int = 0):
+        self.search_results = search_results
+        self.page_size = page_size
+        self.image_bytes = image_bytes if image_bytes is not None else noise_jpeg()
+        self.search_latency = search_latency
+        self.download_latency = download_latency
+        self.search_error_rate = search_error_rate
+        self.download_error_rate = download_error_rate
+
+        # the downloader mounts its adapter and hooks on the session, the fake never sends anything through it
+        self.requests = requests.Session()
+        self.access_token = None
+        self.refresh_token = None
+        self.user_id = 0
+
+        # downloads run on several threads
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+        self.search_calls = 0
+        self.download_calls = 0
+
+    parse_qs = staticmethod(AppPixivAPI.parse_qs)
+
+    def failed(self, error_rate: float) -> bool:
+        with self.lock:
+            return self.random.random() < error_rate
+
+    def auth(self, refresh_token: str = None):
+        self.access_token = "fake-access-token"
+        self.refresh_token = refresh_token
+        return to_json_dict({"response": {"access_token": self.access_token, "refresh_token": refresh_token,
+                                          "expires_in": 3600, "user": {"id": self.user_id}}})
+
+    def set_auth(self, access_token: str, refresh_token: str = None):
+        self.access_token = access_token
+        self.refresh_token = refresh_token
+
+    def search_illust(self, word: str, search_target: str = "partial_match_for_tags", offset=None, **kwargs):
+        with self.lock:
+            self.search_calls += 1
+        time.sleep(self.search_latency)
+
+        if self.failed(self.search_error_rate):
+            return to_json_dict({"error": {"user_message": "", "message": "Rate Limit", "reason": "",
+                                           "user_message_details": {}}})
+
+        # offsets of a next_url come back as strings from parse_qs
+        offset = int(offset or 0)
+        if offset >= 5000:
+            return to_json_dict({"error": {"user_message": "", "message": "{\"offset\":[\"offset must be no more "
+                                                                          "than 5000\"]}", "reason": "",
+                                           "user_message_details": {}}})
+
+        illustrations = self.search_results.get(word, [])
+        page = illustrations[offset:offset + self.page_size]
+        next_url = None
+        if offset + self.page_size < len(illustrations):
+            query = urlencode({"word": word, "search_target": search_target, "offset": offset + self.page_size})
+            next_url = "https://app-api.pixiv.net/v1/search/illust?" + query
+
+        return to_json_dict({"illusts": page, "next_url": next_url, "search_span_limit": 31536000})
+
+    def download(self, url: str, fname=None, **kwargs):
+        with self.lock:
+            self.download_calls += 1
+        time.sleep(self.download_latency)
+
+        if self.failed(self.download_error_rate):
+            raise PixivError("requests GET " + url + " error: 503 Server Error")
+
+        fname.write(self.image_bytes)
+        return True
+
+
+# pixivpy parses every response into nested JsonDicts
+def to_json_dict(response: dict) -> JsonDict:
+    return json.loads(json.dumps(response), object_hook=JsonDict)
+
+
+# A medium sized noise jpeg, about as large as the medium images of pixiv
+def noise_jpeg(size: int = 540, seed: int = 0) -> bytes:
+    noise = random.Random(seed)
+    image = Image.frombytes("RGB", (size, size), bytes(noise.getrandbits(8) for _ in range(size * size * 3)))
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=70)
+    return buffer.getvalue()
+
+
+def load_search_results(fixture_path) -> dict:
+    with open(fixture_path) as f:
+        return json.load(f)
+
+
+# Records the search results of tags from a logged in AppPixivAPI into a fixture for FakePixivAPI
+def record_search_pages(api, tags: list, pages_per_tag: int, fixture_path):
+    search_results = {}
+    for tag in tags:
+        illustrations = []
+        next_page = {"word": tag, "search_target": "exact_match_for_tags"}
+        for _ in range(pages_per_tag):
+            response = api.search_illust(**next_page)
+            if "illusts" not in response:
+                break
+            illustrations += response.illusts
+            next_page = api.parse_qs(response.next_url)
+            if next_page is None:
+                break
+        search_results[tag] = illustrations
+
+    with open(fixture_path, "w") as f:
+        json.dump(search_results, f, indent=1, ensure_ascii=False)
@@ -0,0 +1,231 @@
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from pathlib import Path
+
+import schedule
+
+from Pixiv.Source.pixiv_db import PixivDB
+
+
+# Writer of a worker's PixivDownloader, hands the inserts and offsets to the writer thread of the pool
+class QueueWriter:
+    def __init__(self, results):
+        self.results = results
+
+    def insert_images(self, images_to_add: list, offsets: dict = None):
+        self.results.put(("insert", images_to_add, offsets))
+
+    def save_offsets(self, offsets: dict):
+        self.results.put(("offsets", offsets))
+
+
+# Runs in a worker process, a PixivDownloader of its own account crawls the jobs of the pool.
+# Messages of one process arrive in the order they were put, so the inserts of a job are committed before its "done".
+def run_worker(worker_number: int, database: str, refresh_token: str, credentials_path: Path, api_factory,
+               jobs, results):
+    from Pixiv.Source.pixiv_downloader import PixivDownloader
+
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s][Worker ' + str(worker_number) + '] %(message)s',
+                        datefmt='%H:%M:%S')
+
+    api = api_factory() if api_factory is not None else None
+    downloader = PixivDownloader(database=database, api=api, credentials_path=credentials_path,
+                                 refresh_token=refresh_token, writer=QueueWriter(results))
+
+    while True:
+        try:
+            job = jobs.get(timeout=1)
+        except queue.Empty:
+            schedule.run_pending()
+            continue
+        if job is None:
+            break
+
+        tag, offset, amount_of_images_to_download = job
+        # another worker crawled the tag since, its rest of a page doesn't start at the offset anymore
+        if downloader.offsets[tag] != offset:
+            downloader.offsets[tag] = offset
+            downloader.saved_offsets[tag] = offset
+            downloader.crawls.pop(tag, None)
+
+        downloader.add_new_images_to_db(tag, amount_of_images_to_download)
+        results.put(("done", worker_number, tag, downloader.offsets[tag]))
+        schedule.run_pending()
+
+    downloader.tokens.stop()
+    downloader.download_executor.shutdown()
+    downloader.variant_executor.shutdown()
+    downloader.db.connections.close()
+
+
+# Crawls with one worker process per pixiv account, every account has its own login, rate limits and downloads,
+# so the throughput grows with the number of accounts.
+#
+# Workers only read the database. Their inserts and offsets come back through one queue and are committed by the
+# single writer thread of the pool, like a PixivDownloader would commit them itself.
+# Every job carries the committed offset of its tag, so any worker can continue the crawl of any tag.
+# A tag must not be crawled by two workers at the same time.
+# If an insert fails, its files are deleted and the offset of its tag stays at the last committed one until the job is
+# done, so the next job crawls the lost illustrations again.
+#
+# api_factory creates the api of a worker inside its process, for example a functools.partial of FakePixivAPI.
+# It has to be picklable, workers are spawned.
+class PixivFetcherPool:
+    def __init__(self, database: str, refresh_tokens: list, credentials_directory: Path, api_factory=None):
+        self.logger = logging.getLogger()
+
+        self.database = database
+        self.refresh_tokens = refresh_tokens
+        self.credentials_directory = Path(credentials_directory)
+        self.api_factory = api_factory
+
+        self.db = PixivDB(database)
+        # tag -> committed offset
+        self.offsets = self.db.return_offsets()
+        # tags whose running job had an insert fail, only the writer thread uses them
+        self.failed_tags = set()
+
+        # spawn, the fetcher already runs threads. Workers aren't daemons, their downloaders start process pools.
+        self.context = multiprocessing.get_context("spawn")
+        self.results = self.context.Queue()
+        self.processes = [None] * len(refresh_tokens)
+        self.jobs = [None] * len(refresh_tokens)
+        # worker number -> (tag, future) of the running job
+        self.running_jobs = {}
+        # a worker that keeps dying is restarted after 1, 2, 4, ... up to 300 seconds
+        self.restart_delays = [1.0] * len(refresh_tokens)
+        self.restart_at = [0.0] * len(refresh_tokens)
+        self.lock = threading.Lock()
+
+        for worker_number in range(len(refresh_tokens)):
+            self.start_worker(worker_number)
+
+        self.closing = threading.Event()
+        self.stopped = threading.Event()
+        self.writer_thread = threading.Thread(target=self.write, name="PixivWriter", daemon=True)
+        self.writer_thread.start()
+
+    def __len__(self) -> int:
+        return len(self.processes)
+
+    def start_worker(self, worker_number: int):
+        self.jobs[worker_number] = self.context.Queue()
+        credentials_path = self.credentials_directory / ("credentials-worker" + str(worker_number) + ".json")
+        self.processes[worker_number] = self.context.Process(
+            target=run_worker, name="PixivWorker" + str(worker_number),
+            args=(worker_number, self.database, self.refresh_tokens[worker_number], credentials_path,
+                  self.api_factory, self.jobs[worker_number], self.results)
+        )
+        self.processes[worker_number].start()
+        self.logger.info("Started pixiv worker " + str(worker_number))
+
+    # Hands a crawl of tag to a worker, which has to be idle.
+    # The future is resolved with the offset of tag once its images are committed.
+    def submit(self, worker_number: int, tag: str, amount_of_images_to_download: int) -> Future:
+        future = Future()
+        with self.lock:
+            self.running_jobs[worker_number] = (tag, future)
+            self.jobs[worker_number].put((tag, self.offsets.get(tag, 0), amount_of_images_to_download))
+        return future
+
+    # The writer thread, the only one that writes results of the workers into the database
+    def write(self):
+        last_check = time.monotonic()
+        while not self.stopped.is_set():
+            try:
+                self.handle(self.results.get(timeout=1))
+            except queue.Empty:
+                pass
+            except Exception as e:
+                self.logger.exception(e)
+
+            if time.monotonic() - last_check >= 1:
+                self.check_workers()
+                last_check = time.monotonic()
+
+    def handle(self, message: tuple):
+        kind = message[0]
+        if kind == "insert":
+            _, images_to_add, offsets = message
+            offsets = self.committable_offsets(offsets)
+            try:
+                self.db.insert_images(images_to_add, offsets)
+            except Exception:
+                self.failed_tags.update(offsets)
+                self.delete_files(images_to_add)
+                raise
+            self.offsets.update(offsets)
+
+        elif kind == "offsets":
+            _, offsets = message
+            offsets = self.committable_offsets(offsets)
+            if offsets:
+                self.db.save_offsets(offsets)
+                self.offsets.update(offsets)
+
+        elif kind == "done":
+            # the offset of the job is already committed by its messages before, unless an insert failed
+            _, worker_number, tag, _ = message
+            self.restart_delays[worker_number] = 1.0
+            with self.lock:
+                running_job = self.running_jobs.pop(worker_number, None)
+            if tag in self.failed_tags:
+                self.failed_tags.discard(tag)
+                if running_job is not None:
+                    running_job[1].set_exception(RuntimeError("Inserting the images of " + tag + " failed"))
+            elif running_job is not None:
+                running_job[1].set_result(self.offsets.get(tag, 0))
+
+    # After a failed insert the next images of the job are still inserted, but its tag keeps the committed offset
+    def committable_offsets(self, offsets: dict) -> dict:
+        if not offsets:
+            return {}
+        return {tag: offset for tag, offset in offsets.items() if tag not in self.failed_tags}
+
+    def delete_files(self, images_to_add: list):
+        file_paths = {image[key] for image in images_to_add for key in ["file_path", "upload_file_path"]}
+        for file_path in file_paths:
+            if file_path is not None:
+                self.db.image_store.delete(file_path)
+
+    # Fails the job of a worker that died and restarts it with a fresh job queue
+    def check_workers(self):
+        for worker_number, process in enumerate(self.processes):
+            if self.closing.is_set():
+                return
+            if process.is_alive() or time.monotonic() < self.restart_at[worker_number]:
+                continue
+
+            self.logger.info("Pixiv worker " + str(worker_number) + " exited with " + str(process.exitcode))
+            with self.lock:
+                running_job = self.running_jobs.pop(worker_number, None)
+                if running_job is not None:
+                    self.failed_tags.discard(running_job[0])
+                    running_job[1].set_exception(RuntimeError("Pixiv worker " + str(worker_number) + " exited "
+                                                              "while crawling " + running_job[0]))
+                self.start_worker(worker_number)
+
+            self.restart_at[worker_number] = time.monotonic() + self.restart_delays[worker_number]
+            self.restart_delays[worker_number] = min(2 * self.restart_delays[worker_number], 300.0)
+
+    # Lets the workers finish their jobs and commits what they sent
+    def close(self):
+        self.closing.set()
+        for jobs in self.jobs:
+            jobs.put(None)
+        for process in self.processes:
+            process.join()
+
+        self.stopped.set()
+        self.writer_thread.join()
+        while True:
+            try:
+                self.handle(self.results.get(timeout=0.1))
+            except queue.Empty:
+                break
+
+        self.db.connections.close()
@@ -0,0 +1,151 @@
+import socket
+import ssl
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+
+# Counts requests and newly opened connections of a PooledAdapter.
+# Every request that didn't open a connection reused a pooled one.
+class ConnectionStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+        # TCP connect and TLS handshake of new connections
+        self.connect_seconds = 0.0
+
+    def add_request(self):
+        with self.lock:
+            self.requests += 1
+
+    def add_connection(self, connect_seconds: float):
+        with self.lock:
+            self.connections += 1
+            self.connect_seconds += connect_seconds
+
+    def reuse_ratio(self) -> float:
+        with self.lock:
+            if self.requests == 0:
+                return 0.0
+            return max(0, self.requests - self.connections) / self.requests
+
+    def summary(self) -> str:
+        reuse_ratio = self.reuse_ratio()
+        with self.lock:
+            return (str(self.requests) + " requests, " + str(self.connections) + " connections, "
+                    + f"{reuse_ratio:.1%}" + " reused, " + f"{self.connect_seconds:.2f}" + " s connecting")
+
+
+# urllib3 pool classes whose connections report to stats
+def counting_pool_classes(stats: ConnectionStats) -> dict:
+    class CountingHTTPConnection(HTTPConnection):
+        def connect(self):
+            start = time.perf_counter()
+            super().connect()
+            stats.add_connection(time.perf_counter() - start)
+
+    class CountingHTTPSConnection(HTTPSConnection):
+        def connect(self):
+            start = time.perf_counter()
+            super().connect()
+            stats.add_connection(time.perf_counter() - start)
+
+    class CountingHTTPConnectionPool(HTTPConnectionPool):
+        ConnectionCls = CountingHTTPConnection
+
+    class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+        ConnectionCls = CountingHTTPSConnection
+
+    return {"http": CountingHTTPConnectionPool, "https": CountingHTTPSConnectionPool}
+
+
+# pixivpy talks to pixiv through a cloudscraper session, whose adapter pins the TLS ciphers pixiv accepts in its
+# ssl_context. PooledAdapter uses the same ssl_context and adds
+# - a blocking pool of pool_maxsize keep-alive connections per host, parallel downloads wait for a free connection
+#   instead of opening throwaway connections that pay a new TLS handshake
+# - TCP keep-alive, so idle pooled connections survive NAT timeouts between download cycles
+# - retries with backoff for connection errors, and for 429/5xx of idempotent requests
+# - optionally a PixivRateLimiter, every request waits for a token and its response adjusts the rate
+#
+# 429/5xx are retried here and not by urllib3, so every retry takes a token and a throttled bucket delays it.
+class PooledAdapter(HTTPAdapter):
+    retry_statuses = (429, 500, 502, 503, 504)
+    retry_methods = ("GET", "HEAD")
+
+    def __init__(self, stats: ConnectionStats, pool_maxsize: int, retries: int, rate_limiter=None,
+                 ssl_context: ssl.SSLContext = None):
+        self.stats = stats
+        self.rate_limiter = rate_limiter
+        self.retries = retries
+        self.backoff_factor = 0.5
+        # read by init_poolmanager, which HTTPAdapter.__init__ already calls
+        self.ssl_context = ssl_context
+        # connection errors only, responses with an error status are retried in send
+        max_retries = Retry(
+            total=retries,
+            backoff_factor=self.backoff_factor,
+            status_forcelist=[],
+            allowed_methods=list(self.retry_methods),
+            raise_on_status=False
+        )
+        super().__init__(pool_connections=10, pool_maxsize=pool_maxsize, pool_block=True, max_retries=max_retries)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = (HTTPConnection.default_socket_options
+                                    + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)])
+        if self.ssl_context is not None:
+            kwargs["ssl_context"] = self.ssl_context
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = counting_pool_classes(self.stats)
+
+    def proxy_manager_for(self, *args, **kwargs):
+        if self.ssl_context is not None:
+            kwargs["ssl_context"] = self.ssl_context
+        return super().proxy_manager_for(*args, **kwargs)
+
+    # pixivpy reads the error json of the last response itself, so it is returned instead of raising
+    def send(self, request, **kwargs):
+        for attempt in range(self.retries + 1):
+            self.stats.add_request()
+            bucket = None
+            if self.rate_limiter is not None:
+                bucket = self.rate_limiter.bucket_for(request.url)
+                bucket.acquire()
+
+            response = super().send(request, **kwargs)
+            if bucket is not None:
+                self.rate_limiter.record_response(bucket, response)
+
+            if (response.status_code not in self.retry_statuses or request.method not in self.retry_methods
+                    or attempt == self.retries):
+                return response
+
+            # reading the body returns the connection to the pool
+            response.content
+            response.close()
+            time.sleep(self.backoff_factor * 2 ** attempt)
+
+
+# Session response hook, pixivpy's download() saves whatever i.pximg.net answers.
+# A throttled or failed image request has to raise instead of leaving its error page behind as the image.
+def raise_for_image_errors(response, *args, **kwargs):
+    if urlparse(response.url).hostname == "i.pximg.net":
+        response.raise_for_status()
+
+
+# Mounts a PooledAdapter on session, search, auth and downloads of an AppPixivAPI all go through api.requests
+def mount_pooled_adapter(session: requests.Session, stats: ConnectionStats, pool_maxsize: int = 16,
+                         retries: int = 3, rate_limiter=None) -> PooledAdapter:
+    # a plain requests.Session has no cloudscraper TLS setup to keep, urllib3 creates its default context then
+    ssl_context = getattr(session.get_adapter("https://"), "ssl_context", None)
+    adapter = PooledAdapter(stats, pool_maxsize, retries, rate_limiter=rate_limiter, ssl_context=ssl_context)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return adapter
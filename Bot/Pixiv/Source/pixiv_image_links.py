@@ -0,0 +1,98 @@
+import asyncio
+import logging
+import random
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Answers .p and .pn for tags that have no images in the database yet with a link to a pixiv artwork.
+#
+# The live search runs on a thread pool, so a slow search or re-login never blocks the event loop.
+# Results are cached for ttl seconds per (tags, safety_level), empty results too, only the least recently used
+# max_keys stay. Concurrent misses of the same key wait for one search.
+# Failed searches aren't cached, the next request searches again.
+class ImageLinkFetcher:
+    def __init__(self, pixiv_downloader, ttl: float = 600, max_keys: int = 256, max_workers: int = 2):
+        self.logger = logging.getLogger()
+
+        self.pixiv_downloader = pixiv_downloader
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="PixivSearch")
+
+        # (tags, safety_level) -> (expires_at, links), least recently used first
+        self.links = OrderedDict()
+        # (tags, safety_level) -> running search task
+        self.searches = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    # Returns a random link of the cached results, or a message if there are none
+    async def fetch_single_image_link(self, tag: str, safety_level: int) -> str:
+        key = (tag, safety_level)
+
+        links = self.cached_links(key)
+        if links is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            try:
+                links = await asyncio.shield(self.start_search(key))
+            except Exception as e:
+                self.logger.info("Searching " + tag + " failed: " + repr(e))
+                return "Pixiv can't be reached right now, please try again later."
+
+        if links:
+            return random.choice(links)
+
+        if safety_level == 1:
+            safety_level_text = "nsfw"
+        else:
+            safety_level_text = "sfw"
+        return "No " + safety_level_text + " images with this tag exist currently."
+
+    def cached_links(self, key: tuple):
+        cached = self.links.get(key)
+        if cached is None:
+            return None
+
+        expires_at, links = cached
+        if time.monotonic() >= expires_at:
+            del self.links[key]
+            return None
+
+        self.links.move_to_end(key)
+        return links
+
+    def start_search(self, key: tuple) -> asyncio.Task:
+        if key not in self.searches:
+            search = asyncio.create_task(self.search(key))
+            # nobody awaits a search whose callers were all cancelled
+            search.add_done_callback(lambda task: task.cancelled() or task.exception())
+            self.searches[key] = search
+        return self.searches[key]
+
+    async def search(self, key: tuple) -> list:
+        tag, safety_level = key
+        loop = asyncio.get_running_loop()
+        try:
+            links = await loop.run_in_executor(self.executor, self.pixiv_downloader.search_image_links, tag,
+                                               safety_level)
+        finally:
+            if self.searches.get(key) is asyncio.current_task():
+                del self.searches[key]
+
+        self.links[key] = (time.monotonic() + self.ttl, links)
+        self.links.move_to_end(key)
+        while len(self.links) > self.max_keys:
+            self.links.popitem(last=False)
+
+        return links
+
+    def close(self):
+        for search in self.searches.values():
+            search.cancel()
+        self.searches.clear()
+        self.executor.shutdown(wait=False)
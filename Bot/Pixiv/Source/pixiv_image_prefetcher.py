@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import os
+from collections import OrderedDict, deque
+
+from Pixiv.Source.pixiv_db_async import AsyncPixivDB
+
+
+# Keeps a small shuffled buffer of images for every (tags, safety_level) that was requested recently,
+# so repeated .p and .pn requests are answered from memory instead of querying SQLite each time.
+#
+# A buffer that runs low is refilled in the background with one sample_images query.
+# Only the least recently used max_keys keys keep a buffer.
+# Deletions can hit any buffer, invalidate() drops all of them and discards refills that are still running.
+class ImagePrefetcher:
+    def __init__(self, pixiv_db: AsyncPixivDB, max_keys: int = 256, buffer_size: int = 20,
+                 refill_threshold: int = 5):
+        self.logger = logging.getLogger()
+
+        self.pixiv_db = pixiv_db
+        self.max_keys = max_keys
+        self.buffer_size = buffer_size
+        self.refill_threshold = refill_threshold
+
+        # (tags, safety_level) -> deque of image rows, least recently used first
+        self.buffers = OrderedDict()
+        # (tags, safety_level) -> running refill task
+        self.refills = {}
+        # incremented by invalidate(), refills started before that are thrown away
+        self.generation = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    # tag order and repeated tags don't change the result, so they share one buffer
+    @staticmethod
+    def buffer_key(tags: list, safety_level: int) -> tuple:
+        return tuple(sorted(set(tags))), safety_level
+
+    # Same result as PixivDB.return_image
+    async def return_image(self, tags: list, safety_level: int):
+        key = self.buffer_key(tags, safety_level)
+
+        image = await self.pop_image(key)
+        if image is not None:
+            self.hits += 1
+        else:
+            # a cold key costs a single query, which fills the buffer for the following requests
+            self.misses += 1
+            await asyncio.shield(self.start_refill(key))
+            image = await self.pop_image(key)
+
+        if key in self.buffers and len(self.buffers[key]) <= self.refill_threshold:
+            self.start_refill(key)
+
+        if image is not None:
+            return image
+        else:
+            return {}
+
+    # The fetcher or another bot can delete files without going through invalidate(), so every image is checked
+    # before it is served. The check runs on the executor of the database, a slow disk must not stall the event loop.
+    async def pop_image(self, key: tuple):
+        buffer = self.buffers.get(key)
+        if buffer is None:
+            return None
+
+        self.buffers.move_to_end(key)
+        while buffer:
+            image = buffer.popleft()
+            if await self.pixiv_db.run_in_executor(self.pixiv_db.query_timeout, os.path.isfile,
+                                                   image["upload_file_path"]):
+                return image
+
+        return None
+
+    # At most one refill runs per key, concurrent misses wait for the same one.
+    # A miss gets the error of its refill, like a direct query, background refills only log it.
+    def start_refill(self, key: tuple) -> asyncio.Task:
+        if key not in self.refills:
+            refill = asyncio.create_task(self.refill(key))
+            refill.add_done_callback(self.log_refill_error)
+            self.refills[key] = refill
+        return self.refills[key]
+
+    def log_refill_error(self, refill: asyncio.Task):
+        if not refill.cancelled() and refill.exception() is not None:
+            self.logger.info("Prefetching images failed: " + repr(refill.exception()))
+
+    async def refill(self, key: tuple):
+        generation = self.generation
+        tags, safety_level = key
+        try:
+            images = await self.pixiv_db.sample_images(list(tags), safety_level, self.buffer_size)
+        finally:
+            if self.refills.get(key) is asyncio.current_task():
+                del self.refills[key]
+
+        if generation != self.generation or not images:
+            return
+
+        buffer = self.buffers.setdefault(key, deque())
+        self.buffers.move_to_end(key)
+
+        # a new sample can overlap the images that are still queued
+        queued_ids = {image["pixiv_image_id"] for image in buffer}
+        buffer.extend(image for image in images if image["pixiv_image_id"] not in queued_ids)
+
+        while len(self.buffers) > self.max_keys:
+            self.buffers.popitem(last=False)
+
+    def invalidate(self):
+        self.generation += 1
+        self.buffers.clear()
+        self.logger.info("Cleared prefetched images")
+
+    def close(self):
+        for refill in self.refills.values():
+            refill.cancel()
+        self.refills.clear()
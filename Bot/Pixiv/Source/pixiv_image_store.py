@@ -0,0 +1,168 @@
+import argparse
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+from pathlib import Path
+
+
+# Passes writes through to file and hashes them on the way
+class HashingWriter:
+    def __init__(self, file):
+        self.file = file
+        self.hash = hashlib.sha256()
+
+    def write(self, data: bytes) -> int:
+        self.hash.update(data)
+        return self.file.write(data)
+
+
+# Image files of one database, spread over shard_count subdirectories of DB/<database>/Images.
+#
+# An image lives at Images/<shard>/<pixiv_image_id>.<format>, the shard is the pixiv_image_id modulo shard_count in hex.
+# Variants of an image, like the upload variant, lie next to it as <pixiv_image_id>.<variant>.<format>.
+# pixiv ids are dense, so every shard holds about the same number of files.
+# Files are written to a temporary file in their shard and renamed, a file that exists is always complete.
+class ImageStore:
+    def __init__(self, images_directory_path: Path, shard_count: int = 4096):
+        self.logger = logging.getLogger()
+        self.images_directory_path = Path(images_directory_path)
+        self.shard_count = shard_count
+        self.shard_digits = len(format(shard_count - 1, "x"))
+
+    def shard(self, pixiv_image_id: int) -> str:
+        return format(int(pixiv_image_id) % self.shard_count, "0" + str(self.shard_digits) + "x")
+
+    def path(self, pixiv_image_id: int, file_format: str, variant: str = None) -> Path:
+        if variant is None:
+            file_name = str(pixiv_image_id) + "." + file_format
+        else:
+            file_name = str(pixiv_image_id) + "." + variant + "." + file_format
+        return self.images_directory_path / self.shard(pixiv_image_id) / file_name
+
+    # write_content(file) writes the image into a binary file object.
+    # Returns (file_path, checksum), the checksum is the sha256 hex digest of the content.
+    # If write_content raises nothing is left behind and an existing file stays as it was.
+    def write(self, pixiv_image_id: int, file_format: str, write_content, variant: str = None) -> tuple:
+        file_path = self.path(pixiv_image_id, file_format, variant)
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+
+        # same directory, so the rename never crosses a file system
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=file_path.parent, prefix=".", suffix=".tmp")
+        try:
+            with os.fdopen(file_descriptor, "wb") as f:
+                writer = HashingWriter(f)
+                write_content(writer)
+            os.replace(temporary_path, file_path)
+        except BaseException:
+            os.unlink(temporary_path)
+            raise
+
+        return str(file_path), writer.hash.hexdigest()
+
+    # Moves a file which isn't in its shard yet, like the flat files from before the store, into its shard.
+    # Returns (file_path, checksum) of the moved file.
+    def adopt(self, pixiv_image_id: int, old_file_path: str) -> tuple:
+        file_format = Path(old_file_path).suffix[1:]
+        file_path = self.path(pixiv_image_id, file_format)
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+
+        checksum = self.checksum(old_file_path)
+        if Path(old_file_path) != file_path:
+            os.replace(old_file_path, file_path)
+        return str(file_path), checksum
+
+    @staticmethod
+    def checksum(file_path: str) -> str:
+        file_hash = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 16), b""):
+                file_hash.update(block)
+        return file_hash.hexdigest()
+
+    # Returns False if the file is missing or its content doesn't match the checksum
+    def verify(self, file_path: str, checksum: str) -> bool:
+        try:
+            return self.checksum(file_path) == checksum
+        except FileNotFoundError:
+            return False
+
+    # Returns True if the file was deleted
+    def delete(self, file_path: str) -> bool:
+        try:
+            Path(file_path).unlink()
+            return True
+        except FileNotFoundError:
+            self.logger.info("Failed deleting " + file_path)
+            return False
+
+
+# Moves the images of a database into their shards and stores their checksums.
+# Images which already have a checksum were written by the store and are skipped, so the tool can be run again
+# after an interruption. Rows whose file is missing are left as they are.
+# Returns (moved, missing) counts.
+def rehome_images(db_file_path: Path, image_store: ImageStore, batch_size: int = 1000) -> tuple:
+    logger = logging.getLogger()
+    conn = sqlite3.connect(str(db_file_path))
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+
+    c.execute(
+        """
+        SELECT pixiv_image_id, file_path
+        FROM Images
+        WHERE checksum IS NULL
+        """
+    )
+    rows = c.fetchall()
+
+    moved_count = 0
+    missing_count = 0
+    updates = []
+    for row in rows:
+        try:
+            file_path, checksum = image_store.adopt(row["pixiv_image_id"], row["file_path"])
+        except FileNotFoundError:
+            missing_count += 1
+            continue
+
+        updates.append((file_path, checksum, row["pixiv_image_id"]))
+        moved_count += 1
+
+        # a file that was moved but whose row wasn't updated yet can't be found by the bot, keep that window short
+        if len(updates) == batch_size:
+            update_file_paths(conn, updates)
+            logger.info("Rehomed " + str(moved_count) + "/" + str(len(rows)) + " images")
+            updates = []
+
+    if updates:
+        update_file_paths(conn, updates)
+
+    conn.close()
+    logger.info("Rehomed " + str(moved_count) + " images, " + str(missing_count) + " files were missing")
+    return moved_count, missing_count
+
+
+def update_file_paths(conn: sqlite3.Connection, updates: list):
+    conn.executemany(
+        """
+        UPDATE Images
+        SET file_path = ?, checksum = ?
+        WHERE pixiv_image_id = ?
+        """,
+        updates
+    )
+    conn.commit()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Moves the images of a database into the sharded image store.")
+    parser.add_argument("database", nargs="?", default="Main")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s][ImageStore] %(message)s', datefmt='%H:%M:%S')
+
+    discordbot_dir = Path(__file__).parent.parent.parent.parent.resolve()
+    rehome_images((discordbot_dir / 'DB' / args.database / 'pixiv.db').resolve(),
+                  ImageStore((discordbot_dir / 'DB' / args.database / 'Images').resolve()))
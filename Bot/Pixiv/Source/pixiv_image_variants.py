@@ -0,0 +1,37 @@
+import io
+import os
+
+from PIL import Image
+
+# WebP qualities tried in order before the image is scaled down
+QUALITY_STEPS = [85, 70, 55, 40]
+SCALE_STEP = 0.75
+MIN_SIDE = 64
+
+
+# Encodes the image at file_path as a WebP of at most byte_budget bytes.
+# Tries lower qualities first and scales the image down only if the lowest quality is still too large.
+# Returns the encoded bytes, or None if the original is already within byte_budget or the variant isn't smaller.
+#
+# Runs in the variant process pool of the downloader, so it must stay a module level function of picklable arguments.
+def encode_upload_variant(file_path: str, byte_budget: int):
+    original_size = os.path.getsize(file_path)
+    if original_size <= byte_budget:
+        return None
+
+    with Image.open(file_path) as image:
+        has_alpha = image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+        image = image.convert("RGBA" if has_alpha else "RGB")
+
+    while True:
+        for quality in QUALITY_STEPS:
+            buffer = io.BytesIO()
+            image.save(buffer, "WEBP", quality=quality, method=4)
+            if buffer.tell() <= byte_budget:
+                return buffer.getvalue() if buffer.tell() < original_size else None
+
+        width, height = image.size
+        if min(width, height) * SCALE_STEP < MIN_SIDE:
+            # keep the smallest encoding, even above the budget it beats the original
+            return buffer.getvalue() if buffer.tell() < original_size else None
+        image = image.resize((int(width * SCALE_STEP), int(height * SCALE_STEP)), Image.LANCZOS)
@@ -0,0 +1,85 @@
+import logging
+import threading
+import time
+from urllib.parse import urlparse
+
+
+# Token bucket whose rate adapts to the server with AIMD.
+# Every success raises the rate so it grows by additive_increase per second of traffic,
+# a throttled response multiplies it by decrease_factor and drops the saved up burst.
+class AdaptiveTokenBucket:
+    def __init__(self, name: str, rate: float, capacity: float, min_rate: float, max_rate: float,
+                 additive_increase: float, decrease_factor: float = 0.5, clock=time.monotonic, sleep=time.sleep):
+        self.logger = logging.getLogger()
+
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.additive_increase = additive_increase
+        self.decrease_factor = decrease_factor
+
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.tokens = capacity
+        self.last_refill = clock()
+        # several throttled responses of one burst only count once
+        self.last_decrease = float("-inf")
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    # Blocks until the request may be sent.
+    # The token is taken right away, so waiting callers are served in order.
+    def acquire(self):
+        with self.lock:
+            self.refill(self.clock())
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait > 0:
+            self.sleep(wait)
+
+    def on_success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.additive_increase / self.rate)
+
+    def on_throttle(self, retry_after: float = 0):
+        with self.lock:
+            now = self.clock()
+            self.refill(now)
+
+            if now - self.last_decrease >= 1 / self.rate:
+                self.last_decrease = now
+                self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+                self.logger.info("Throttled, " + self.name + " rate is now " + f"{self.rate:.2f}" + "/s")
+
+            # no burst right after being throttled, and nothing at all until Retry-After passed
+            self.tokens = min(self.tokens, -retry_after * self.rate)
+
+
+# Separate budgets for the pixiv API (search, auth) and the image CDN, every request takes a token of its host.
+# Throttling shows up as 429, as 403 with a "Rate Limit" error on app-api, or as 5xx under load.
+class PixivRateLimiter:
+    def __init__(self, search_rate: float, download_rate: float):
+        self.search = AdaptiveTokenBucket("search", rate=search_rate, capacity=3, min_rate=search_rate / 10,
+                                          max_rate=search_rate * 2, additive_increase=search_rate / 10)
+        self.download = AdaptiveTokenBucket("download", rate=download_rate, capacity=download_rate,
+                                            min_rate=download_rate / 10, max_rate=download_rate * 2,
+                                            additive_increase=download_rate / 10)
+
+    def bucket_for(self, url: str) -> AdaptiveTokenBucket:
+        if urlparse(url).hostname == "i.pximg.net":
+            return self.download
+        else:
+            return self.search
+
+    def record_response(self, bucket: AdaptiveTokenBucket, response):
+        if response.status_code in (403, 429) or response.status_code >= 500:
+            retry_after = response.headers.get("Retry-After", "0")
+            bucket.on_throttle(float(retry_after) if retry_after.isdigit() else 0)
+        elif response.ok:
+            bucket.on_success()
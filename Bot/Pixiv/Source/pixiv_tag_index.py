@@ -0,0 +1,147 @@
+import random
+import sqlite3
+import threading
+from array import array
+from bisect import bisect_left
+
+
+# A sorted posting list of image ids, 8 bytes per id.
+# Lookups are a binary search, random members are picked by position.
+class ImageIdSet:
+    def __init__(self, pixiv_image_ids=()):
+        self.ids = array("q", sorted(pixiv_image_ids))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, pixiv_image_id: int):
+        position = bisect_left(self.ids, pixiv_image_id)
+        return position < len(self.ids) and self.ids[position] == pixiv_image_id
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    # new pixiv ids are the highest ones, so inserts mostly land at the end and barely shift the array
+    def add(self, pixiv_image_id: int):
+        position = bisect_left(self.ids, pixiv_image_id)
+        if position == len(self.ids) or self.ids[position] != pixiv_image_id:
+            self.ids.insert(position, pixiv_image_id)
+
+    def discard(self, pixiv_image_id: int):
+        position = bisect_left(self.ids, pixiv_image_id)
+        if position < len(self.ids) and self.ids[position] == pixiv_image_id:
+            del self.ids[position]
+
+    def random_choice(self) -> int:
+        return random.choice(self.ids)
+
+
+# In-memory copy of ImageTags, partitioned by safety level: (tag_id, safety_level) -> ImageIdSet
+# Multi-tag lookups intersect the sets starting with the smallest one instead of grouping ImageTags in SQLite.
+#
+# The fetcher inserts from another process, so the index keeps the highest ImageTags rowid it has seen
+# and refresh() loads everything above it before each lookup.
+class TagIndex:
+    def __init__(self):
+        self.image_sets = {}
+        self.last_rowid = 0
+        self.lock = threading.Lock()
+
+        # random picks from the smallest set that are tried before computing the whole intersection
+        self.sample_attempts = 32
+
+    # Reads all of ImageTags, the rows are streamed into plain arrays and sorted once per set
+    def load(self, cursor: sqlite3.Cursor):
+        query = """
+                SELECT rowid, tag_id, pixiv_image_id, safety_level
+                FROM ImageTags
+                """
+        unsorted_ids = {}
+        last_rowid = 0
+        cursor.execute(query)
+        for rowid, tag_id, pixiv_image_id, safety_level in cursor:
+            key = (tag_id, safety_level)
+            if key not in unsorted_ids:
+                unsorted_ids[key] = array("q")
+            unsorted_ids[key].append(pixiv_image_id)
+            last_rowid = max(last_rowid, rowid)
+
+        image_sets = {}
+        while unsorted_ids:
+            key, pixiv_image_ids = unsorted_ids.popitem()
+            image_sets[key] = ImageIdSet(pixiv_image_ids)
+
+        with self.lock:
+            self.image_sets = image_sets
+            self.last_rowid = last_rowid
+
+    def refresh(self, cursor: sqlite3.Cursor):
+        query = """
+                SELECT rowid, tag_id, pixiv_image_id, safety_level
+                FROM ImageTags
+                WHERE rowid > ?
+                ORDER BY rowid
+                """
+        with self.lock:
+            cursor.execute(query, [self.last_rowid])
+            for rowid, tag_id, pixiv_image_id, safety_level in cursor.fetchall():
+                self.add(tag_id, pixiv_image_id, safety_level)
+                self.last_rowid = rowid
+
+    # rows is a list of (tag_id, pixiv_image_id, safety_level)
+    def remove_rows(self, rows: list, cursor: sqlite3.Cursor):
+        with self.lock:
+            for tag_id, pixiv_image_id, safety_level in rows:
+                image_set = self.image_sets.get((tag_id, safety_level))
+                if image_set is not None:
+                    image_set.discard(pixiv_image_id)
+
+            # SQLite hands out max(rowid) + 1, after deleting the newest rows it reuses rowids below last_rowid
+            cursor.execute("SELECT COALESCE(MAX(rowid), 0) FROM ImageTags")
+            self.last_rowid = min(self.last_rowid, cursor.fetchone()[0])
+
+    def add(self, tag_id: int, pixiv_image_id: int, safety_level: int):
+        key = (tag_id, safety_level)
+        if key not in self.image_sets:
+            self.image_sets[key] = ImageIdSet()
+        self.image_sets[key].add(pixiv_image_id)
+
+    def image_sets_by_size(self, tag_ids: list, safety_level: int) -> list:
+        image_sets = [self.image_sets.get((tag_id, safety_level), ImageIdSet()) for tag_id in set(tag_ids)]
+        return sorted(image_sets, key=len)
+
+    # Returns a random pixiv_image_id tagged with all tag_ids, or None
+    def random_image_id(self, tag_ids: list, safety_level: int):
+        with self.lock:
+            smallest_set, *other_sets = self.image_sets_by_size(tag_ids, safety_level)
+            if not smallest_set:
+                return None
+
+            # tags which are requested together usually overlap a lot, a few random picks are enough
+            for _ in range(self.sample_attempts):
+                pixiv_image_id = smallest_set.random_choice()
+                if all(pixiv_image_id in image_set for image_set in other_sets):
+                    return pixiv_image_id
+
+            matching_ids = [pixiv_image_id for pixiv_image_id in smallest_set
+                            if all(pixiv_image_id in image_set for image_set in other_sets)]
+
+        if matching_ids:
+            return random.choice(matching_ids)
+        else:
+            return None
+
+    def count(self, tag_ids: list, safety_levels: list) -> int:
+        count = 0
+        with self.lock:
+            for safety_level in safety_levels:
+                smallest_set, *other_sets = self.image_sets_by_size(tag_ids, safety_level)
+                for pixiv_image_id in smallest_set:
+                    if all(pixiv_image_id in image_set for image_set in other_sets):
+                        count += 1
+
+        return count
+
+    def safety_levels(self) -> list:
+        with self.lock:
+            return sorted({safety_level for _, safety_level in self.image_sets})
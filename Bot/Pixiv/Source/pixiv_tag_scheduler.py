@@ -0,0 +1,323 @@
+import heapq
+import math
+import random
+import time
+
+
+# Weights of a growing list of items, sampled proportional to their weight.
+# Setting a weight and sampling take O(log n), appending is amortized O(1).
+class FenwickTree:
+    def __init__(self):
+        self.weights = []
+        # 1-based, node i holds the sum of the weights (i - lowbit(i), i], the last node holds the total
+        self.capacity = 1
+        self.tree = [0.0, 0.0]
+
+    def __len__(self) -> int:
+        return len(self.weights)
+
+    def append(self, weight: float):
+        if len(self.weights) == self.capacity:
+            self.capacity *= 2
+            self.weights.append(0.0)
+            self.rebuild()
+        else:
+            self.weights.append(0.0)
+        self.set(len(self.weights) - 1, weight)
+
+    def set(self, index: int, weight: float):
+        delta = weight - self.weights[index]
+        self.weights[index] = weight
+        node = index + 1
+        while node <= self.capacity:
+            self.tree[node] += delta
+            node += node & -node
+
+    def total(self) -> float:
+        return self.tree[self.capacity]
+
+    # Returns the index whose range of the prefix sums contains value, for 0 <= value < total()
+    def find(self, value: float) -> int:
+        node = 0
+        step = self.capacity
+        while step:
+            if node + step <= self.capacity and self.tree[node + step] <= value:
+                node += step
+                value -= self.tree[node]
+            step //= 2
+        return node
+
+    # Recomputes every node from the weights in O(n), which also drops the rounding errors the updates accumulated
+    def rebuild(self):
+        self.tree = [0.0] * (self.capacity + 1)
+        for index, weight in enumerate(self.weights):
+            self.tree[index + 1] = weight
+        for node in range(1, self.capacity + 1):
+            parent = node + (node & -node)
+            if parent <= self.capacity:
+                self.tree[parent] += self.tree[node]
+
+    # Returns a random index, weighted, or None if all weights are 0
+    def sample(self, generator: random.Random):
+        for _ in range(2):
+            if self.total() <= 0:
+                return None
+            index = self.find(generator.random() * self.total())
+            if index < len(self.weights) and self.weights[index] > 0:
+                return index
+            # the rounding errors of many updates pointed past the weights
+            self.rebuild()
+        return None
+
+
+# Decides which tag the image fetcher downloads next.
+#
+# A tag is the search word of a download, its tags are the database tags it was requested with. A tag of the database
+# stands for itself.
+# Demand and stock are kept per (tag, safety_level), safety level 1 stands for every nsfw level like in TagStats.
+# Demand counts requests and halves every half_life seconds, its current value times ln 2 / half_life estimates the
+# requests per second. Stock is the number of images of the tag and safety level in the database.
+#
+# Every (tag, safety_level) with demand has two watermarks, the images the requests of the next low_watermark_hours
+# and high_watermark_hours would use up, never below min_stock and at least stock_scale apart.
+# Tags below the low watermark of a requested safety level wait in a heap and are downloaded first, by score.
+# Tags above the high watermark of all requested safety levels aren't downloaded at all.
+# All other tags are sampled proportional to their score from a Fenwick tree. The score is the demand divided by the
+# stock, summed over the safety levels below their high watermark, a stock of stock_scale images halves it.
+# A tag that was downloaded is left alone for recrawl_interval seconds.
+#
+# Requests, downloads and stock updates change one tag in O(log n), nothing is recomputed for all tags, so scheduling
+# stays as fast with hundreds of thousands of tags. Watermarks sink as demand decays without anything happening,
+# so picked tags are checked against their current watermarks before they are handed out.
+#
+# Decayed demand is stored scaled by 2 ** ((t - epoch) / half_life) at the time of the request, so older requests
+# weigh less without ever touching them. The scale is reset to 1 after 64 half lives, which costs O(n) once.
+class TagScheduler:
+    safety_levels = (0, 1)
+
+    def __init__(self, half_life: float = 24 * 60 * 60, recrawl_interval: float = 5 * 60, stock_scale: int = 30,
+                 min_stock: int = 30, low_watermark_hours: float = 24, high_watermark_hours: float = 7 * 24,
+                 clock=time.monotonic, seed: int = None):
+        self.half_life = half_life
+        self.recrawl_interval = recrawl_interval
+        self.stock_scale = stock_scale
+        self.min_stock = min_stock
+        self.low_watermark_seconds = low_watermark_hours * 60 * 60
+        self.high_watermark_seconds = high_watermark_hours * 60 * 60
+        self.clock = clock
+        self.random = random.Random(seed)
+        self.epoch = clock()
+
+        # per tag, in the order the tags were added, its tags, demand, stock and requests per safety level
+        self.tag_indices = {}
+        self.tags = []
+        self.tag_lists = []
+        self.demand = tuple([] for _ in self.safety_levels)
+        self.stock = tuple([] for _ in self.safety_levels)
+        self.requests = tuple([] for _ in self.safety_levels)
+        self.downloads = []
+        self.ready_at = []
+
+        self.sampler = FenwickTree()
+        # (-score, entry, tag index), entries that don't match priority_entries are stale
+        self.priority = []
+        self.priority_entries = {}
+        self.entry_counter = 0
+        # (ready_at, tag index) of the tags that were downloaded recently
+        self.cooldowns = []
+
+    def index(self, tag: str) -> int:
+        index = self.tag_indices.get(tag)
+        if index is None:
+            index = len(self.tags)
+            self.tag_indices[tag] = index
+            self.tags.append(tag)
+            self.tag_lists.append([tag])
+            for safety_level in self.safety_levels:
+                self.demand[safety_level].append(0.0)
+                self.stock[safety_level].append(0)
+                self.requests[safety_level].append(0)
+            self.downloads.append(0)
+            self.ready_at.append(0.0)
+            self.sampler.append(0.0)
+        return index
+
+    # Adds the tags of the database, tag_stock maps a tag to its (sfw_count, nsfw_count)
+    def add_tags(self, tag_stock: dict):
+        for tag, stock in tag_stock.items():
+            index = self.index(tag)
+            for safety_level in self.safety_levels:
+                self.stock[safety_level][index] = stock[safety_level]
+
+    def request_rate(self, index: int, safety_level: int) -> float:
+        demand = self.demand[safety_level][index] * 2 ** ((self.epoch - self.clock()) / self.half_life)
+        return demand * math.log(2) / self.half_life
+
+    # Returns the (low, high) watermark of a tag and safety level in images
+    def watermarks(self, index: int, safety_level: int) -> tuple:
+        request_rate = self.request_rate(index, safety_level)
+        low = max(self.min_stock, request_rate * self.low_watermark_seconds)
+        high = max(low + self.stock_scale, request_rate * self.high_watermark_seconds)
+        return low, high
+
+    def is_below_low_watermark(self, index: int) -> bool:
+        for safety_level in self.safety_levels:
+            if self.demand[safety_level][index] > 0:
+                low, _ = self.watermarks(index, safety_level)
+                if self.stock[safety_level][index] < low:
+                    return True
+        return False
+
+    def score(self, index: int) -> float:
+        score = 0.0
+        for safety_level in self.safety_levels:
+            demand = self.demand[safety_level][index]
+            if demand > 0:
+                _, high = self.watermarks(index, safety_level)
+                stock = self.stock[safety_level][index]
+                if stock < high:
+                    score += demand / (1 + stock / self.stock_scale)
+        return score
+
+    def is_cooling(self, tag: str) -> bool:
+        index = self.tag_indices.get(tag)
+        return index is not None and self.ready_at[index] > self.clock()
+
+    # Whether a requested tag should be downloaded for safety_level right now
+    def is_due(self, tag: str, safety_level: int) -> bool:
+        index = self.index(tag)
+        if self.ready_at[index] > self.clock():
+            return False
+        _, high = self.watermarks(index, safety_level)
+        return self.stock[safety_level][index] < high
+
+    # Returns the database tags tag was requested with, the stock of tag counts the images with all of them
+    def tags_of(self, tag: str) -> list:
+        index = self.tag_indices.get(tag)
+        return [tag] if index is None else self.tag_lists[index]
+
+    def request_count(self, tag: str) -> int:
+        index = self.tag_indices.get(tag)
+        return 0 if index is None else sum(requests[index] for requests in self.requests)
+
+    def download_count(self, tag: str) -> int:
+        index = self.tag_indices.get(tag)
+        return 0 if index is None else self.downloads[index]
+
+    def priority_count(self) -> int:
+        return len(self.priority_entries)
+
+    # tags are the database tags tag was requested with, tag alone if they aren't given
+    def request(self, tag: str, safety_level: int, tags: list = None):
+        now = self.clock()
+        if now - self.epoch > 64 * self.half_life:
+            self.renormalize(now)
+
+        index = self.index(tag)
+        if tags is not None:
+            self.tag_lists[index] = list(tags)
+        self.requests[safety_level][index] += 1
+        self.demand[safety_level][index] += 2 ** ((now - self.epoch) / self.half_life)
+        self.update(index)
+
+    # stock is the (sfw_count, nsfw_count) of tag
+    def update_stock(self, tag: str, stock: tuple):
+        index = self.index(tag)
+        for safety_level in self.safety_levels:
+            self.stock[safety_level][index] = stock[safety_level]
+        self.update(index)
+
+    def update(self, index: int):
+        # cooling tags are updated when they are released
+        if self.ready_at[index] > self.clock():
+            return
+
+        score = self.score(index)
+        self.sampler.set(index, score)
+
+        if self.is_below_low_watermark(index):
+            self.entry_counter += 1
+            self.priority_entries[index] = self.entry_counter
+            heapq.heappush(self.priority, (-score, self.entry_counter, index))
+            # stale entries pile up with every request, drop them once they are the majority
+            if len(self.priority) > 2 * len(self.priority_entries) + 64:
+                self.rebuild_priority()
+        else:
+            self.priority_entries.pop(index, None)
+
+    # Returns the tag below its low watermark with the highest score, or None
+    def pop_priority(self):
+        self.release_cooldowns()
+        while self.priority:
+            _, entry, index = heapq.heappop(self.priority)
+            if self.priority_entries.get(index) != entry:
+                continue
+
+            # the watermarks sank since the tag was pushed
+            if not self.is_below_low_watermark(index):
+                del self.priority_entries[index]
+                continue
+
+            tag = self.tags[index]
+            self.scheduled(tag)
+            return tag
+        return None
+
+    # Returns a tag weighted by score, or None if no tag below its high watermark has demand
+    def sample(self):
+        self.release_cooldowns()
+        for _ in range(8):
+            index = self.sampler.sample(self.random)
+            if index is None:
+                return None
+
+            # the watermarks sank since the weight was set
+            score = self.score(index)
+            if score <= 0:
+                self.sampler.set(index, score)
+                continue
+
+            tag = self.tags[index]
+            self.scheduled(tag)
+            return tag
+        return None
+
+    def next_tag(self):
+        tag = self.pop_priority()
+        if tag is None:
+            tag = self.sample()
+        return tag
+
+    # Marks tag as downloaded, it isn't picked again for recrawl_interval seconds
+    def scheduled(self, tag: str):
+        index = self.index(tag)
+        self.downloads[index] += 1
+        self.priority_entries.pop(index, None)
+
+        self.ready_at[index] = self.clock() + self.recrawl_interval
+        heapq.heappush(self.cooldowns, (self.ready_at[index], index))
+        self.sampler.set(index, 0.0)
+
+    def release_cooldowns(self):
+        now = self.clock()
+        while self.cooldowns and self.cooldowns[0][0] <= now:
+            ready_at, index = heapq.heappop(self.cooldowns)
+            # a tag that was downloaded again has a later entry
+            if self.ready_at[index] == ready_at:
+                self.update(index)
+
+    def rebuild_priority(self):
+        self.priority = [(-self.score(index), entry, index) for index, entry in self.priority_entries.items()]
+        heapq.heapify(self.priority)
+
+    def renormalize(self, now: float):
+        half_lives = (now - self.epoch) // self.half_life
+        factor = 2 ** -half_lives
+        for demand in self.demand:
+            demand[:] = [tag_demand * factor for tag_demand in demand]
+        self.epoch += half_lives * self.half_life
+
+        for index in range(len(self.tags)):
+            self.sampler.weights[index] = self.score(index) if self.ready_at[index] <= now else 0.0
+        self.sampler.rebuild()
+        self.rebuild_priority()
@@ -0,0 +1,23 @@
+from Bot.Pixiv.Source.pixiv_db import PixivDB
+from Bot.Pixiv.Source.pixiv_db_initializer import initialize_image_table
+
+
+# Drops every table of the test database and migrates it again from version 0.
+# Tables are read from sqlite_master, so tables of new migrations are dropped without listing them here.
+# Without db a PixivDB of the Tests database is opened and closed again.
+def reset_test_db(db: PixivDB = None):
+    close_db = db is None
+    if close_db:
+        db = PixivDB(database="Tests")
+
+    db.cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")
+    for row in db.cursor.fetchall():
+        db.cursor.execute(f'DROP TABLE IF EXISTS "{row["name"]}"')
+    db.cursor.execute("PRAGMA user_version = 0")
+    db.connection.commit()
+    db.tag_id_cache.clear()
+
+    initialize_image_table(str(db.db_file_path))
+
+    if close_db:
+        db.connections.close()
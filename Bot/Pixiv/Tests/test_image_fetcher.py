@@ -0,0 +1,119 @@
+import asyncio
+import configparser
+import tempfile
+from multiprocessing.connection import Client
+from pathlib import Path
+from unittest import IsolatedAsyncioTestCase
+
+import schedule
+
+from Bot.Pixiv.Source.pixiv_fake_api import FakePixivAPI, load_search_results
+from Bot.Pixiv.Tests.pixiv_test_db import reset_test_db
+from Bot.image_fetcher import ImageFetcherService
+
+fixture_path = Path(__file__).parent / "Fixtures" / "search_illust.json"
+config_path = Path(__file__).parent.parent.parent / "config.ini"
+
+
+class TestImageFetcherService(IsolatedAsyncioTestCase):
+    def setUp(self):
+        reset_test_db()
+
+        config = configparser.ConfigParser()
+        config.read(str(config_path))
+        self.authkey = config["process-communication"]["authkey"].encode()
+
+        self.credentials_directory = tempfile.TemporaryDirectory()
+        api = FakePixivAPI(load_search_results(fixture_path), page_size=2, download_latency=0.2)
+        self.service = ImageFetcherService(database="Tests", api=api, address=('localhost', 0),
+                                           credentials_path=Path(self.credentials_directory.name) / "credentials.json")
+
+    async def asyncTearDown(self):
+        self.service_task.cancel()
+        await asyncio.gather(self.service_task, return_exceptions=True)
+        self.client.close()
+        self.service.listener.close()
+
+    def tearDown(self):
+        downloader = self.service.pixiv_downloader
+        downloader.db.cursor.execute("SELECT file_path, upload_file_path FROM Images")
+        for row in downloader.db.cursor.fetchall():
+            for file_path in [row["file_path"], row["upload_file_path"]]:
+                if file_path is not None:
+                    Path(file_path).unlink(missing_ok=True)
+        for shard in downloader.image_store.images_directory_path.iterdir():
+            if shard.is_dir() and not any(shard.iterdir()):
+                shard.rmdir()
+
+        downloader.tokens.stop()
+        downloader.download_executor.shutdown()
+        downloader.variant_executor.shutdown()
+        downloader.db.connections.close()
+
+        schedule.clear()
+        self.credentials_directory.cleanup()
+
+    async def connect(self):
+        loop = asyncio.get_running_loop()
+        self.service_task = asyncio.create_task(self.service.run())
+        self.client = await loop.run_in_executor(None, lambda: Client(self.service.listener.address,
+                                                                      authkey=self.authkey))
+
+    async def wait_for(self, condition, timeout: float = 10):
+        deadline = asyncio.get_running_loop().time() + timeout
+        while not condition():
+            self.assertTrue(asyncio.get_running_loop().time() < deadline)
+            await asyncio.sleep(0.01)
+
+    async def test_tags_are_received_during_a_download(self):
+        await self.connect()
+        downloader = self.service.pixiv_downloader
+
+        self.client.send((["猫"], 0))
+        await self.wait_for(lambda: downloader.api.download_calls > 0)
+
+        # the download of 猫 is still running
+        self.client.send((["犬"], 0))
+        self.client.send((["犬"], 0))
+        await self.wait_for(lambda: self.service.scheduler.request_count("犬") == 2)
+        self.assertTrue(downloader.db.return_images_row_count() == 0)
+        # the second request doesn't queue a second download
+        self.assertTrue(self.service.download_queue.qsize() == 1)
+
+        await self.wait_for(lambda: self.service.scheduler.download_count("犬") == 1 and
+                            self.service.download_queue.empty() and
+                            downloader.db.return_image_count(tags=["dog"]) > 0)
+
+    async def test_the_bot_can_reconnect(self):
+        await self.connect()
+        self.client.close()
+
+        loop = asyncio.get_running_loop()
+        self.client = await loop.run_in_executor(None, lambda: Client(self.service.listener.address,
+                                                                      authkey=self.authkey))
+        self.client.send((["犬"], 0))
+        await self.wait_for(lambda: self.service.scheduler.request_count("犬") == 1)
+
+    async def test_stock_of_tags_with_spaces(self):
+        await self.connect()
+        downloader = self.service.pixiv_downloader
+        # a search for two tags, one of them contains a space
+        downloader.api.search_results["black cat 猫"] = downloader.api.search_results["猫"]
+
+        self.client.send((["black cat", "猫"], 0))
+        await self.wait_for(lambda: self.service.scheduler.download_count("black cat 猫") == 1 and
+                            self.service.download_queue.empty() and not self.service.queued_tags)
+
+        index = self.service.scheduler.index("black cat 猫")
+        stock = tuple(self.service.scheduler.stock[safety_level][index] for safety_level in (0, 1))
+        self.assertTrue(stock == downloader.db.return_image_counts_by_safety(["black cat", "猫"]))
+        self.assertTrue(sum(stock) > 0)
+
+    async def test_malformed_messages_are_dropped(self):
+        await self.connect()
+        for message in ["犬", ("犬", 0), (["犬"],), (["犬"], 2), (["犬"], "0"), ([], 0), ([None], 0)]:
+            self.client.send(message)
+        self.client.send((["犬"], 1))
+
+        await self.wait_for(lambda: self.service.scheduler.request_count("犬") == 1)
+        self.assertTrue(not self.service_task.done())
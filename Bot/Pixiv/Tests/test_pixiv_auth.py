@@ -0,0 +1,105 @@
+import tempfile
+import threading
+import time
+from pathlib import Path
+from unittest import TestCase
+
+from pixivpy3.utils import JsonDict
+
+from Bot.Pixiv.Source.pixiv_auth import PixivTokenManager
+
+
+# Stands in for AppPixivAPI, every auth call hands out a new token
+class FakeApi:
+    def __init__(self, expires_in: int = 3600):
+        self.expires_in = expires_in
+        self.auth_calls = 0
+        self.access_token = None
+        self.refresh_token = None
+        self.user_id = 0
+
+    def auth(self, refresh_token=None):
+        # slow enough for concurrent callers to overlap
+        time.sleep(0.05)
+        self.auth_calls += 1
+        self.access_token = "access" + str(self.auth_calls)
+        self.refresh_token = refresh_token
+        self.user_id = 7
+        return JsonDict({"response": JsonDict({"expires_in": self.expires_in})})
+
+    def set_auth(self, access_token, refresh_token=None):
+        self.access_token = access_token
+        self.refresh_token = refresh_token
+
+
+class TestPixivTokenManager(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.credentials_path = Path(self.directory.name) / "credentials.json"
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_concurrent_callers_refresh_once(self):
+        api = FakeApi()
+        tokens = PixivTokenManager(api, "refresh", self.credentials_path)
+
+        threads = [threading.Thread(target=tokens.ensure_token) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertTrue(api.auth_calls == 1)
+        self.assertTrue(tokens.token_is_fresh())
+
+    def test_second_instance_uses_cached_credentials(self):
+        first_api = FakeApi()
+        PixivTokenManager(first_api, "refresh", self.credentials_path).ensure_token()
+
+        second_api = FakeApi()
+        PixivTokenManager(second_api, "refresh", self.credentials_path).ensure_token()
+
+        self.assertTrue(second_api.auth_calls == 0)
+        self.assertTrue(second_api.access_token == "access1")
+        self.assertTrue(second_api.user_id == 7)
+
+        # another account doesn't get the cached token
+        third_api = FakeApi()
+        PixivTokenManager(third_api, "other refresh", self.credentials_path).ensure_token()
+        self.assertTrue(third_api.auth_calls == 1)
+
+    def test_token_is_refreshed_before_expiry(self):
+        # expires in 2 seconds, which is inside the refresh margin
+        api = FakeApi(expires_in=2)
+        tokens = PixivTokenManager(api, "refresh", self.credentials_path, refresh_margin=1.5)
+        tokens.ensure_token()
+        tokens.ensure_token()
+        self.assertTrue(api.auth_calls == 1)
+
+        time.sleep(0.6)
+        tokens.ensure_token()
+        self.assertTrue(api.auth_calls == 2)
+
+    def test_refresh_after_error_is_rate_limited(self):
+        api = FakeApi()
+        tokens = PixivTokenManager(api, "refresh", self.credentials_path)
+        tokens.ensure_token()
+
+        tokens.refresh_after_error()
+        tokens.refresh_after_error()
+        self.assertTrue(api.auth_calls == 2)
+
+    def test_instances_refresh_one_at_a_time(self):
+        # like the bot and the fetcher, only the lock file keeps them apart
+        apis = [FakeApi(), FakeApi()]
+        threads = [threading.Thread(target=PixivTokenManager(api, "refresh", self.credentials_path).ensure_token)
+                   for api in apis]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # the instance that waited for the lock found the token of the other one
+        self.assertTrue(sum(api.auth_calls for api in apis) == 1)
+        self.assertTrue(apis[0].access_token == apis[1].access_token == "access1")
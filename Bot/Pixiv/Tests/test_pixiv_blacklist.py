@@ -0,0 +1,57 @@
+import os
+import tempfile
+import time
+from pathlib import Path
+from unittest import TestCase
+
+from pixivpy3.utils import JsonDict
+
+from Bot.Pixiv.Source.pixiv_blacklist import Blacklist, BlacklistMatcher
+
+
+def illustration(tags: list, artist: int = 1, x_restrict: int = 0) -> JsonDict:
+    return JsonDict({"id": 1, "x_restrict": x_restrict, "user": JsonDict({"id": artist}),
+                     "tags": [JsonDict({"name": name, "translated_name": translated_name})
+                              for name, translated_name in tags]})
+
+
+class TestPixivBlacklist(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.paths = {}
+        for name, lines in [("tags", ["gore", "Spider"]), ("nsfw_tags", ["nsfw only"]), ("artists", ["42"])]:
+            self.paths[name] = Path(self.directory.name) / (name + ".txt")
+            self.paths[name].write_text("\n".join(lines) + "\n\n")
+
+        self.matcher = BlacklistMatcher(self.paths["tags"], self.paths["nsfw_tags"], self.paths["artists"])
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_blocked_reason(self):
+        self.assertTrue(self.matcher.blocked_reason(illustration([("cat", None)])) is None)
+        self.assertTrue(self.matcher.blocked_reason(illustration([("cat", None)], artist=42)) == "blacklisted artist")
+        # case insensitive, translated names count too
+        self.assertTrue(self.matcher.blocked_reason(illustration([("cat", "SPIDER")])) == "completly banned tag")
+        self.assertTrue(self.matcher.blocked_reason(illustration([("GORE", None)])) == "completly banned tag")
+
+        self.assertTrue(self.matcher.blocked_reason(illustration([("nsfw only", None)])) is None)
+        self.assertTrue(self.matcher.blocked_reason(illustration([("nsfw only", None)], x_restrict=1))
+                        == "nsfw banned tag")
+
+    def test_reload_only_after_change(self):
+        self.assertTrue(not self.matcher.reload())
+        self.assertTrue(len(self.matcher.tags) == 2)
+
+        self.paths["tags"].write_text("gore\nspider\nblood\n")
+        # make sure the modification time differs on file systems with coarse timestamps
+        modification_time = time.time() + 5
+        os.utime(self.paths["tags"], (modification_time, modification_time))
+
+        self.assertTrue(self.matcher.reload())
+        self.assertTrue("blood" in self.matcher.tags)
+        self.assertTrue(not self.matcher.reload())
+
+    def test_empty_lines_are_ignored(self):
+        blacklist = Blacklist(self.paths["artists"])
+        self.assertTrue(blacklist.entries == frozenset(["42"]))
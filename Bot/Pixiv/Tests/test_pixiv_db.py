@@ -1,6 +1,9 @@
+import sqlite3
 from unittest import TestCase
 
 from Bot.Pixiv.Source.pixiv_db import PixivDB
+from Bot.Pixiv.Source.pixiv_db_initializer import initialize_image_table
+from Bot.Pixiv.Tests.pixiv_test_db import reset_test_db
 
 
 class TestPixivDB(TestCase):
@@ -8,55 +11,7 @@ class TestPixivDB(TestCase):
         self.db = PixivDB(database="Tests")
 
     def cleanDBInbetweenTests(self):
-        # Delete the tables
-        query1 = """
-                DROP TABLE Images
-                """
-
-        query2 = """
-                DROP TABLE Tags
-                """
-
-        query3 = """
-                DROP TABLE ImageTags
-                """
-
-        self.db.cursor.execute(query1)
-        self.db.cursor.execute(query2)
-        self.db.cursor.execute(query3)
-        self.db.connection.commit()
-
-        # Create them again
-        query1 = """
-                CREATE TABLE IF NOT EXISTS "Images" (
-                    "pixiv_image_id"	integer,
-                    "file_path"	TEXT NOT NULL,
-                    "safety_level"	integer NOT NULL,
-                    "artist"	integer NOT NULL,
-                    PRIMARY KEY("pixiv_image_id")
-                );    
-                """
-
-        query2 = """
-                CREATE TABLE IF NOT EXISTS "Tags" (
-                    "tag_id"	INTEGER,
-                    "tag"	TEXT NOT NULL UNIQUE,
-                    PRIMARY KEY("tag_id")
-                );    
-                """
-
-        query3 = """
-                CREATE TABLE "ImageTags" (
-                    "pixiv_image_id"	INTEGER,
-                    "tag_id"	INTEGER,
-                    PRIMARY KEY("pixiv_image_id","tag_id")
-                );        
-                """
-
-        self.db.cursor.execute(query1)
-        self.db.cursor.execute(query2)
-        self.db.cursor.execute(query3)
-        self.db.connection.commit()
+        reset_test_db(self.db)
 
     # 3 images
     # image 1: red blue     sfw
@@ -171,6 +126,16 @@ class TestPixivDB(TestCase):
         self.assertTrue(image_count_green == 1)
         self.assertTrue(image_count_red_blue == 2)
 
+    def test_return_image_counts_by_safety(self):
+        self.cleanDBInbetweenTests()
+        self.insertExampleEntries()
+
+        self.assertTrue(self.db.return_image_counts_by_safety(["green"]) == (0, 1))
+        self.assertTrue(self.db.return_image_counts_by_safety(["red", "blue"]) == (1, 1))
+        self.assertTrue(self.db.return_image_counts_by_safety(["green", "blue"]) == (0, 0))
+        self.assertTrue(self.db.return_image_counts_by_safety(["yellow"]) == (0, 0))
+        self.assertTrue(self.db.return_tag_image_counts() == {"red": (1, 1), "blue": (1, 1), "green": (0, 1)})
+
     def test_return_imagetags_row_count(self):
         self.cleanDBInbetweenTests()
         self.insertExampleEntries()
@@ -243,3 +208,203 @@ class TestPixivDB(TestCase):
         images_row_count = self.db.return_images_row_count()
         self.assertTrue(imagetags_row_count == 2)
         self.assertTrue(images_row_count == 1)
+
+    def test_return_image_without_tags(self):
+        self.cleanDBInbetweenTests()
+        self.insertExampleEntries()
+
+        sfw_image: dict = self.db.return_image(tags=[], safety_level=0)
+        nsfw_image: dict = self.db.return_image(tags=[], safety_level=1)
+
+        self.assertTrue(sfw_image["pixiv_image_id"] == 1)
+        self.assertTrue(nsfw_image["safety_level"] == 1)
+
+    def test_return_image_samples_all_candidates(self):
+        self.cleanDBInbetweenTests()
+        self.insertExampleEntries()
+
+        sampled_ids = set()
+        for _ in range(200):
+            sampled_ids.add(self.db.return_image(tags=["red", "blue"], safety_level=1)["pixiv_image_id"])
+            sampled_ids.add(self.db.return_image(tags=[], safety_level=1)["pixiv_image_id"])
+
+        self.assertTrue(sampled_ids == {2, 3})
+
+    def test_sample_images_returns_distinct_images(self):
+        self.cleanDBInbetweenTests()
+        self.insertExampleEntries()
+
+        # more images requested than there are, the wrap around must not return an image twice
+        for _ in range(20):
+            nsfw_images = self.db.sample_images(tags=[], safety_level=1, image_count=5)
+            tagged_images = self.db.sample_images(tags=["blue", "red"], safety_level=1, image_count=5)
+
+            self.assertTrue(sorted(image["pixiv_image_id"] for image in nsfw_images) == [2, 3])
+            self.assertTrue([image["pixiv_image_id"] for image in tagged_images] == [3])
+
+        self.assertTrue(self.db.sample_images(tags=["unknown"], safety_level=0, image_count=5) == [])
+
+    def test_initializer_backfills_random_keys(self):
+        self.cleanDBInbetweenTests()
+        self.insertExampleEntries()
+
+        # simulate a database from before random keys existed
+        self.db.cursor.execute("UPDATE Images SET random_key = NULL")
+        self.db.cursor.execute("UPDATE ImageTags SET random_key = NULL")
+        self.db.cursor.execute("PRAGMA user_version = 1")
+        self.db.connection.commit()
+
+        initialize_image_table(str(self.db.db_file_path))
+
+        self.db.cursor.execute("SELECT COUNT(*) as count FROM Images WHERE random_key IS NULL")
+        self.assertTrue(self.db.cursor.fetchone()["count"] == 0)
+
+        self.db.cursor.execute("""
+                               SELECT COUNT(*) as count
+                               FROM ImageTags
+                               INNER JOIN Images
+                               ON Images.pixiv_image_id = ImageTags.pixiv_image_id
+                               WHERE ImageTags.random_key IS NOT Images.random_key
+                               """)
+        self.assertTrue(self.db.cursor.fetchone()["count"] == 0)
+
+    def test_insert_images_adds_tags_to_existing_images(self):
+        self.cleanDBInbetweenTests()
+        self.insertExampleEntries()
+
+        image1 = {
+            "file_path": "filepath1",
+            "pixiv_image_id": 1,
+            "safety_level": 0,
+            "artist": 123401,
+            "tag": "yellow"
+        }
+        self.db.insert_images([image1, image1])
+
+        self.assertTrue(self.db.return_images_row_count() == 3)
+        self.assertTrue(self.db.return_imagetags_row_count() == 6)
+        self.assertTrue(self.db.return_image(tags=["yellow", "red"], safety_level=0)["pixiv_image_id"] == 1)
+        self.assertTrue("yellow" in self.db.tag_id_cache)
+
+    def test_insert_images_counts_only_new_pairs_into_stats(self):
+        self.cleanDBInbetweenTests()
+        self.insertExampleEntries()
+
+        # image 3 keeps its nsfw safety level and random key, red is already stored for it
+        image3 = {"file_path": "filepath3", "pixiv_image_id": 3, "safety_level": 0, "artist": 123403}
+        self.db.insert_images([dict(image3, tag="red"), dict(image3, tag="yellow"), dict(image3, tag="yellow")])
+
+        self.assertTrue(self.db.check_stats())
+        self.assertTrue(self.db.return_top_tags() == {"red": 2, "blue": 2, "green": 1, "yellow": 1})
+        self.assertTrue(self.db.return_image_counts_by_safety(["yellow"]) == (0, 1))
+        self.db.cursor.execute("""
+                               SELECT COUNT(*) AS count
+                               FROM ImageTags
+                               INNER JOIN Images
+                               ON Images.pixiv_image_id = ImageTags.pixiv_image_id
+                               WHERE Images.random_key != ImageTags.random_key
+                               """)
+        self.assertTrue(self.db.cursor.fetchone()["count"] == 0)
+
+    def test_failed_insert_is_rolled_back(self):
+        self.cleanDBInbetweenTests()
+        self.insertExampleEntries()
+
+        image = {"file_path": "filepath4", "pixiv_image_id": 4, "safety_level": 0, "artist": 1, "tag": "purple"}
+        # offsets can't be NULL, the images of the same transaction go with them
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.db.insert_images([image], offsets={"purple": None})
+
+        self.assertTrue("purple" not in self.db.tag_id_cache)
+        self.assertTrue(self.db.return_images_row_count() == 3)
+        self.assertTrue("purple" not in self.db.return_all_tags())
+        self.assertTrue(self.db.check_stats())
+
+        self.db.insert_images([image])
+        self.assertTrue(self.db.return_image_count(tags=["purple"]) == 1)
+
+    def test_return_image_count_with_duplicate_tags(self):
+        self.cleanDBInbetweenTests()
+        self.insertExampleEntries()
+
+        self.assertTrue(self.db.return_image_count(tags=["red", "red"]) == 2)
+        self.assertTrue(self.db.return_image(tags=["green", "green"], safety_level=1)["pixiv_image_id"] == 2)
+
+    def test_stats_follow_inserts_and_deletes(self):
+        self.cleanDBInbetweenTests()
+        self.insertExampleEntries()
+
+        self.assertTrue(self.db.check_stats())
+
+        self.db.remove_tag_and_delete_from_file_system(tag="red", nsfw_only=True)
+        self.assertTrue(self.db.check_stats())
+        self.assertTrue(self.db.return_top_tags() == {"red": 1, "blue": 1, "green": 1})
+        self.assertTrue(self.db.return_image_count(tags=["red"]) == 1)
+        self.assertTrue(self.db.return_image_count(tags=[]) == 2)
+
+        self.db.remove_image_and_delete_from_file_system(pixiv_image_id=1)
+        self.assertTrue(self.db.check_stats())
+        self.assertTrue(self.db.return_top_tags() == {"green": 1})
+
+    def test_check_stats_rebuilds_drifted_stats(self):
+        self.cleanDBInbetweenTests()
+        self.insertExampleEntries()
+
+        self.db.cursor.execute("UPDATE TagStats SET image_count = 7, sfw_count = 7")
+        self.db.cursor.execute("DELETE FROM ImageStats WHERE safety_level = 1")
+        self.db.connection.commit()
+
+        self.assertFalse(self.db.check_stats())
+        self.assertTrue(self.db.check_stats())
+        self.assertTrue(self.db.return_top_tags() == {"red": 2, "blue": 2, "green": 1})
+        self.assertTrue(self.db.return_image_count(tags=[]) == 3)
+
+    def test_check_stats_holds_the_write_lock_while_comparing(self):
+        self.cleanDBInbetweenTests()
+        self.insertExampleEntries()
+
+        self.db.cursor.execute("UPDATE TagStats SET image_count = 7")
+        self.db.connection.commit()
+
+        # another process, like the cog deleting images, tries to commit while the stats are compared
+        other_connection = sqlite3.connect(str(self.db.db_file_path), timeout=0)
+        other_writes = []
+
+        def write_from_other_process(statement: str):
+            if "EXCEPT" in statement and not other_writes:
+                try:
+                    other_connection.execute("DELETE FROM Images WHERE pixiv_image_id = 2")
+                    other_connection.commit()
+                    other_writes.append("committed")
+                except sqlite3.OperationalError:
+                    other_connection.rollback()
+                    other_writes.append("locked")
+
+        self.db.connection.set_trace_callback(write_from_other_process)
+        try:
+            self.assertFalse(self.db.check_stats())
+        finally:
+            self.db.connection.set_trace_callback(None)
+            other_connection.close()
+
+        self.assertTrue(other_writes == ["locked"])
+        self.assertTrue(self.db.check_stats())
+
+    def test_offsets_are_stored_with_the_images(self):
+        self.cleanDBInbetweenTests()
+        self.assertTrue(self.db.return_offsets() == {})
+
+        image = {"file_path": "filepath4", "pixiv_image_id": 4, "safety_level": 0, "tag": "red", "artist": 1}
+        self.db.insert_images([image], offsets={"red": 31})
+        self.db.save_offsets({"blue": 5})
+        self.assertTrue(self.db.return_offsets() == {"red": 31, "blue": 5})
+
+        self.db.save_offsets({"red": 0})
+        self.assertTrue(self.db.return_offsets() == {"red": 0, "blue": 5})
+
+    def test_return_image_falls_back_to_the_original_for_uploads(self):
+        self.cleanDBInbetweenTests()
+        self.insertExampleEntries()
+
+        image_data = self.db.return_image(tags=["green"], safety_level=1)
+        self.assertTrue(image_data["upload_file_path"] == image_data["file_path"] == "filepath2")
@@ -0,0 +1,70 @@
+import asyncio
+import time
+from unittest import IsolatedAsyncioTestCase
+
+from Bot.Pixiv.Source.pixiv_db_async import AsyncPixivDB
+from Bot.Pixiv.Tests.pixiv_test_db import reset_test_db
+
+
+class TestAsyncPixivDB(IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.async_db = AsyncPixivDB(database="Tests", max_workers=2, query_timeout=0.5)
+
+        db = self.async_db.pixiv_db
+        reset_test_db(db)
+
+        db.insert_images([
+            {"file_path": "filepath1", "pixiv_image_id": 1, "safety_level": 0, "artist": 123401, "tag": "red"},
+            {"file_path": "filepath2", "pixiv_image_id": 2, "safety_level": 1, "artist": 123402, "tag": "red"},
+        ])
+
+    def tearDown(self):
+        self.async_db.close()
+
+    async def test_same_results_as_pixiv_db(self):
+        image = await self.async_db.return_image(tags=["red"], safety_level=0)
+        image_count = await self.async_db.return_image_count(["red"])
+        top_tags = await self.async_db.return_top_tags()
+
+        self.assertTrue(image["pixiv_image_id"] == 1)
+        self.assertTrue(image_count == 2)
+        self.assertTrue(top_tags["red"] == 2)
+
+        await self.async_db.remove_image_and_delete_from_file_system(1)
+        self.assertTrue(await self.async_db.return_images_row_count() == 1)
+
+    async def test_insert_images_stores_offsets(self):
+        await self.async_db.insert_images([{"file_path": "filepath3", "pixiv_image_id": 3, "safety_level": 1,
+                                            "artist": 123403, "tag": "red"}], offsets={"red": 30})
+
+        self.assertTrue(self.async_db.pixiv_db.return_offsets() == {"red": 30})
+        self.assertTrue(await self.async_db.return_image_counts_by_safety(["red"]) == (1, 2))
+
+    async def test_slow_query_does_not_block_event_loop(self):
+        ticks = 0
+
+        async def heartbeat():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        heartbeat_task = asyncio.create_task(heartbeat())
+        await self.async_db.run_in_executor(1, time.sleep, 0.3)
+        heartbeat_task.cancel()
+
+        self.assertTrue(ticks > 10)
+
+    async def test_query_timeout(self):
+        with self.assertRaises(asyncio.TimeoutError):
+            await self.async_db.run_in_executor(self.async_db.query_timeout, time.sleep, 1)
+
+    async def test_tag_index_loads_in_the_background(self):
+        async_db = AsyncPixivDB(database="Tests", max_workers=2, use_tag_index=True)
+        try:
+            await asyncio.wrap_future(async_db.tag_index_load)
+            self.assertTrue(async_db.pixiv_db.tag_index is not None)
+            self.assertTrue((await async_db.return_image(tags=["red"], safety_level=1))["pixiv_image_id"] == 2)
+        finally:
+            async_db.close()
+            async_db.pixiv_db.connections.close()
@@ -0,0 +1,77 @@
+import threading
+import time
+from unittest import TestCase
+
+from Bot.Pixiv.Source.pixiv_db import PixivDB
+from Bot.Pixiv.Tests.pixiv_test_db import reset_test_db
+
+
+def example_batch(first_pixiv_image_id: int, image_count: int) -> list:
+    batch = []
+    for pixiv_image_id in range(first_pixiv_image_id, first_pixiv_image_id + image_count):
+        for tag in ["red", "blue", "tag" + str(pixiv_image_id % 50)]:
+            batch.append({"file_path": "filepath" + str(pixiv_image_id), "pixiv_image_id": pixiv_image_id,
+                          "safety_level": pixiv_image_id % 2, "artist": 123400 + pixiv_image_id, "tag": tag})
+    return batch
+
+
+class TestPixivDBConnection(TestCase):
+    def setUp(self):
+        # the fetcher writes, the cog reads, both from their own PixivDB like in production
+        self.writer_db = PixivDB(database="Tests")
+        self.reader_db = PixivDB(database="Tests")
+
+        reset_test_db(self.writer_db)
+
+        self.writer_db.insert_images(example_batch(1, 10))
+
+    def test_journal_mode_is_wal(self):
+        self.writer_db.cursor.execute("PRAGMA journal_mode")
+        self.assertTrue(self.writer_db.cursor.fetchone()[0] == "wal")
+
+    def test_reads_are_not_blocked_by_exclusive_write_transaction(self):
+        # with a rollback journal an exclusive lock makes every reader fail with "database is locked"
+        self.writer_db.cursor.execute("BEGIN EXCLUSIVE")
+        self.writer_db.cursor.executemany(
+            "INSERT INTO Images (pixiv_image_id, file_path, safety_level, artist) VALUES (?,?,?,?)",
+            [(pixiv_image_id, "filepath", 0, 1) for pixiv_image_id in range(1000, 2000)]
+        )
+
+        start = time.perf_counter()
+        image_count = self.reader_db.return_image_count([])
+        image = self.reader_db.return_image(["red"], safety_level=0)
+        read_seconds = time.perf_counter() - start
+
+        self.writer_db.connection.commit()
+
+        # readers see the last committed snapshot right away instead of waiting for the busy timeout
+        self.assertTrue(image_count == 10)
+        self.assertTrue(image)
+        self.assertTrue(read_seconds < 1)
+        self.assertTrue(self.reader_db.return_image_count([]) == 1010)
+
+    def test_reads_during_bulk_ingest(self):
+        ingest_finished = threading.Event()
+
+        def ingest():
+            for batch_number in range(50):
+                self.writer_db.insert_images(example_batch(100 + batch_number * 100, 100))
+            ingest_finished.set()
+
+        ingest_thread = threading.Thread(target=ingest)
+        ingest_thread.start()
+
+        reads_during_ingest = 0
+        slowest_read_seconds = 0
+        while not ingest_finished.is_set():
+            start = time.perf_counter()
+            self.reader_db.return_image(["red", "blue"], safety_level=1)
+            self.reader_db.return_image_count(["red"])
+            slowest_read_seconds = max(slowest_read_seconds, time.perf_counter() - start)
+            reads_during_ingest += 1
+
+        ingest_thread.join()
+
+        self.assertTrue(reads_during_ingest > 0)
+        self.assertTrue(slowest_read_seconds < 1)
+        self.assertTrue(self.reader_db.return_image_count([]) == 5010)
@@ -0,0 +1,106 @@
+import tempfile
+import threading
+from pathlib import Path
+from unittest import TestCase
+
+from Bot.Pixiv.Source.pixiv_db import PixivDB
+from Bot.Pixiv.Tests.pixiv_test_db import reset_test_db
+
+
+class TestPixivDBDelete(TestCase):
+    def setUp(self):
+        self.db = PixivDB(database="Tests")
+        reset_test_db(self.db)
+
+        self.images_directory = tempfile.TemporaryDirectory()
+        self.db.delete_chunk_size = 100
+
+    def tearDown(self):
+        self.images_directory.cleanup()
+
+    def insert_images_with_files(self, first_pixiv_image_id: int, image_count: int, tag: str):
+        images_to_add = []
+        for pixiv_image_id in range(first_pixiv_image_id, first_pixiv_image_id + image_count):
+            file_path = Path(self.images_directory.name) / (str(pixiv_image_id) + ".jpg")
+            file_path.touch()
+            for image_tag in [tag, "shared"]:
+                images_to_add.append({"file_path": str(file_path), "pixiv_image_id": pixiv_image_id,
+                                      "safety_level": pixiv_image_id % 2, "artist": 1, "tag": image_tag})
+        self.db.insert_images(images_to_add)
+
+    def test_purge_deletes_in_chunks(self):
+        # more images than SQLite allows bound variables in one statement
+        self.insert_images_with_files(1, 1500, "blacklisted")
+        self.insert_images_with_files(5000, 10, "kept")
+
+        progress = []
+        deleted_count = self.db.remove_tag_and_delete_from_file_system(
+            tag="blacklisted", nsfw_only=False,
+            progress_callback=lambda deleted, total: progress.append((deleted, total))
+        )
+
+        self.assertTrue(deleted_count == 1500)
+        self.assertTrue(len(progress) == 15)
+        self.assertTrue(progress[-1] == (1500, 1500))
+        self.assertTrue(self.db.return_images_row_count() == 10)
+        self.assertTrue(self.db.return_imagetags_row_count() == 20)
+        self.assertTrue(len(list(Path(self.images_directory.name).iterdir())) == 10)
+        self.assertTrue(self.db.check_stats())
+
+    def test_empty_deletion_reports_progress_once(self):
+        self.insert_images_with_files(1, 10, "kept")
+
+        progress = []
+        deleted_count = self.db.remove_tag_and_delete_from_file_system(
+            tag="unknown", nsfw_only=False,
+            progress_callback=lambda deleted, total: progress.append((deleted, total))
+        )
+        self.assertTrue(self.db.delete_images_from_database(
+            [], progress_callback=lambda deleted, total: progress.append((deleted, total))
+        ) == 0)
+
+        self.assertTrue(deleted_count == 0)
+        self.assertTrue(progress == [(0, 0), (0, 0)])
+
+    def test_writes_interleave_with_purge(self):
+        self.insert_images_with_files(1, 1000, "blacklisted")
+
+        inserted_during_purge = []
+
+        def insert_during_purge(deleted_count: int, total_count: int):
+            # runs in between two chunks, the write lock must be free
+            insert_thread = threading.Thread(
+                target=self.insert_images_with_files, args=(10000 + deleted_count, 1, "kept")
+            )
+            insert_thread.start()
+            insert_thread.join(timeout=5)
+            inserted_during_purge.append(not insert_thread.is_alive())
+
+        self.db.remove_tag_and_delete_from_file_system(tag="blacklisted", nsfw_only=False,
+                                                       progress_callback=insert_during_purge)
+
+        self.assertTrue(all(inserted_during_purge))
+        self.assertTrue(self.db.return_image_count(["kept"]) == 10)
+
+    def test_delete_images_from_database(self):
+        self.insert_images_with_files(1, 300, "red")
+
+        deleted_count = self.db.delete_images_from_database(list(range(1, 251)) + [99999])
+
+        self.assertTrue(deleted_count == 250)
+        self.assertTrue(self.db.return_images_row_count() == 50)
+        self.assertTrue(self.db.delete_images_from_database([]) == 0)
+
+    def test_upload_variants_are_deleted_with_their_image(self):
+        file_path = Path(self.images_directory.name) / "1.png"
+        upload_file_path = Path(self.images_directory.name) / "1.upload.webp"
+        file_path.touch()
+        upload_file_path.touch()
+        self.db.insert_images([{"file_path": str(file_path), "upload_file_path": str(upload_file_path),
+                                "pixiv_image_id": 1, "safety_level": 0, "artist": 1, "tag": "variant"}])
+
+        self.assertTrue(self.db.return_image(tags=["variant"], safety_level=0)["upload_file_path"]
+                        == str(upload_file_path))
+        self.db.remove_image_and_delete_from_file_system(pixiv_image_id=1)
+        self.assertFalse(file_path.exists())
+        self.assertFalse(upload_file_path.exists())
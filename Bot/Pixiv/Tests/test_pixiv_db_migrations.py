@@ -0,0 +1,132 @@
+import re
+import sqlite3
+import tempfile
+from pathlib import Path
+from unittest import TestCase
+
+from Bot.Pixiv.Source.pixiv_db_initializer import initialize_image_table, MIGRATIONS
+from Bot.Pixiv.Source.pixiv_db import PixivDB
+from Bot.Pixiv.Tests.pixiv_test_db import reset_test_db
+
+# Tables whose size grows with the database, a plain SCAN of any of them is a full scan
+LARGE_TABLES = ["Images", "ImageTags", "Tags", "TagStats"]
+
+
+class TestPixivDBMigrations(TestCase):
+    def test_legacy_database_is_upgraded_in_place(self):
+        with tempfile.TemporaryDirectory() as directory:
+            db_file = str(Path(directory) / "pixiv.db")
+
+            # schema from before versioning, user_version is still 0
+            conn = sqlite3.connect(db_file)
+            conn.executescript(
+                """
+                CREATE TABLE "Images" ("pixiv_image_id" integer, "file_path" TEXT NOT NULL,
+                    "safety_level" integer NOT NULL, "artist" integer NOT NULL, PRIMARY KEY("pixiv_image_id"));
+                CREATE TABLE "Tags" ("tag_id" INTEGER, "tag" TEXT NOT NULL UNIQUE, PRIMARY KEY("tag_id"));
+                CREATE TABLE "ImageTags" ("pixiv_image_id" INTEGER, "tag_id" INTEGER,
+                    PRIMARY KEY("pixiv_image_id","tag_id"));
+                INSERT INTO Images VALUES (1, '1.jpg', 0, 10), (2, '2.jpg', 1, 10);
+                INSERT INTO Tags VALUES (1, 'cat'), (2, 'dog');
+                INSERT INTO ImageTags VALUES (1, 1), (1, 2), (2, 1);
+                """
+            )
+            conn.commit()
+            conn.close()
+
+            initialize_image_table(db_file)
+            # running it again must not apply anything twice
+            initialize_image_table(db_file)
+
+            conn = sqlite3.connect(db_file)
+            c = conn.cursor()
+
+            c.execute("PRAGMA user_version")
+            self.assertTrue(c.fetchone()[0] == len(MIGRATIONS))
+
+            c.execute("SELECT COUNT(*) FROM Images WHERE random_key IS NOT NULL")
+            self.assertTrue(c.fetchone()[0] == 2)
+            c.execute("SELECT COUNT(*) FROM ImageTags WHERE random_key IS NOT NULL")
+            self.assertTrue(c.fetchone()[0] == 3)
+            c.execute("SELECT pixiv_image_id, tag_id, safety_level FROM ImageTags ORDER BY pixiv_image_id, tag_id")
+            self.assertTrue(c.fetchall() == [(1, 1, 0), (1, 2, 0), (2, 1, 1)])
+
+            c.execute("SELECT tag_id, image_count, sfw_count, nsfw_count FROM TagStats ORDER BY tag_id")
+            self.assertTrue(c.fetchall() == [(1, 2, 1, 1), (2, 1, 1, 0)])
+
+            c.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+            indexes = [row[0] for row in c.fetchall()]
+            self.assertTrue("imagetags_safety_random_index" in indexes)
+            self.assertTrue("imagetags_random_covering_index" not in indexes)
+            self.assertTrue("images_artist_index" in indexes)
+            self.assertTrue("imagetags_random_index" not in indexes)
+
+            # ANALYZE ran after the migrations
+            c.execute("SELECT COUNT(*) FROM sqlite_stat1")
+            self.assertTrue(c.fetchone()[0] > 0)
+            conn.close()
+
+    def test_hot_queries_use_indexes(self):
+        db = PixivDB(database="Tests", reader_pool_size=1)
+        reset_test_db(db)
+
+        images_to_add = []
+        for pixiv_image_id in range(1, 201):
+            for tag in ["tag" + str(pixiv_image_id % 10), "tag" + str(pixiv_image_id % 7), "common"]:
+                images_to_add.append({"file_path": "missing/" + str(pixiv_image_id) + ".jpg",
+                                      "pixiv_image_id": pixiv_image_id,
+                                      "safety_level": pixiv_image_id % 2, "artist": pixiv_image_id % 5,
+                                      "tag": tag})
+        db.insert_images(images_to_add)
+        db.cursor.execute("ANALYZE")
+        db.connection.commit()
+
+        # record every statement the hot methods send to SQLite
+        statements = []
+        db.connection.set_trace_callback(statements.append)
+        with db.connections.reader() as cursor:
+            cursor.connection.set_trace_callback(statements.append)
+
+        db.return_image(["tag1"], 0)
+        db.return_image(["tag1", "tag2"], 1)
+        db.return_image([], 0)
+        db.return_image_count(["tag1"])
+        db.return_image_count(["tag1", "tag2"])
+        db.return_image_count([])
+        db.return_top_tags()
+        db.check_if_image_exists(1)
+        db.remove_tag_and_delete_from_file_system("tag3", nsfw_only=True)
+        db.remove_tag_and_delete_from_file_system("tag4", nsfw_only=False)
+        db.remove_artist_and_delete_from_file_system("2")
+        db.remove_image_and_delete_from_file_system(1)
+
+        db.connection.set_trace_callback(None)
+
+        # trigger bodies are traced as comments
+        queries = [statement for statement in statements
+                   if re.match(r"\s*(SELECT|INSERT|UPDATE|DELETE)", statement, re.IGNORECASE)]
+        self.assertTrue(len(queries) > 10)
+
+        full_scans = []
+        for query in queries:
+            db.cursor.execute("EXPLAIN QUERY PLAN " + query)
+            for row in db.cursor.fetchall():
+                detail = row["detail"]
+                for table in LARGE_TABLES:
+                    if re.match(rf"SCAN {table}\b", detail):
+                        full_scans.append((detail, query))
+
+        self.assertTrue(full_scans == [], full_scans)
+
+        # artist deletes read their file paths from the index alone
+        db.cursor.execute("EXPLAIN QUERY PLAN SELECT pixiv_image_id, file_path, upload_file_path FROM Images "
+                          "WHERE artist = 2")
+        self.assertTrue(any("COVERING INDEX images_artist_index" in row["detail"] for row in db.cursor.fetchall()))
+
+        # sampling by tag seeks to the images of one safety level, a tag that is almost all sfw isn't walked for nsfw
+        tag_samples = [query for query in queries if "ImageTags.random_key >=" in query]
+        self.assertTrue(len(tag_samples) > 0)
+        for query in tag_samples:
+            db.cursor.execute("EXPLAIN QUERY PLAN " + query)
+            self.assertTrue(any("imagetags_safety_random_index (tag_id=? AND safety_level=? AND random_key>?)"
+                                in row["detail"] for row in db.cursor.fetchall()))
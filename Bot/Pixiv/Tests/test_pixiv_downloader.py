@@ -0,0 +1,187 @@
+import tempfile
+import threading
+from pathlib import Path
+from unittest import TestCase
+
+import schedule
+from pixivpy3 import PixivError
+
+from Bot.Pixiv.Source.pixiv_downloader import PixivDownloader
+from Bot.Pixiv.Source.pixiv_fake_api import FakePixivAPI, load_search_results
+from Bot.Pixiv.Tests.pixiv_test_db import reset_test_db
+
+fixture_path = Path(__file__).parent / "Fixtures" / "search_illust.json"
+
+
+# Records how many downloads run at the same time, downloads of failing_ids raise like a failed request
+class TrackingPixivAPI(FakePixivAPI):
+    def __init__(self, search_results: dict, failing_ids: tuple = (), **kwargs):
+        super().__init__(search_results, **kwargs)
+        self.failing_ids = failing_ids
+        self.running_downloads = 0
+        self.max_running_downloads = 0
+        self.tracking_lock = threading.Lock()
+
+    def download(self, url: str, fname=None, **kwargs):
+        with self.tracking_lock:
+            self.running_downloads += 1
+            self.max_running_downloads = max(self.max_running_downloads, self.running_downloads)
+        try:
+            if any(str(pixiv_image_id) in url for pixiv_image_id in self.failing_ids):
+                raise PixivError("requests GET " + url + " error: 404 Not Found")
+            return super().download(url, fname=fname, **kwargs)
+        finally:
+            with self.tracking_lock:
+                self.running_downloads -= 1
+
+
+# Searches after the first successful_search_calls raise, like a request that fails in the middle of a crawl
+class FailingSearchPixivAPI(FakePixivAPI):
+    def __init__(self, search_results: dict, successful_search_calls: int = 1, **kwargs):
+        super().__init__(search_results, **kwargs)
+        self.successful_search_calls = successful_search_calls
+
+    def search_illust(self, word: str, **kwargs):
+        if self.search_calls >= self.successful_search_calls:
+            raise PixivError("requests GET search_illust error: 503 Server Error")
+        return super().search_illust(word, **kwargs)
+
+
+class TestPixivDownloader(TestCase):
+    def setUp(self):
+        reset_test_db()
+
+        self.credentials_directory = tempfile.TemporaryDirectory()
+        self.downloaders = []
+
+    def tearDown(self):
+        for downloader in self.downloaders:
+            downloader.db.cursor.execute("SELECT file_path, upload_file_path FROM Images")
+            for row in downloader.db.cursor.fetchall():
+                for file_path in [row["file_path"], row["upload_file_path"]]:
+                    if file_path is not None:
+                        Path(file_path).unlink(missing_ok=True)
+            for shard in downloader.image_store.images_directory_path.iterdir():
+                if shard.is_dir() and not any(shard.iterdir()):
+                    shard.rmdir()
+
+            downloader.tokens.stop()
+            downloader.download_executor.shutdown()
+            downloader.variant_executor.shutdown()
+            downloader.db.connections.close()
+
+        schedule.clear()
+        self.credentials_directory.cleanup()
+
+    def create_downloader(self, api_class=FakePixivAPI, **fake_api_arguments) -> PixivDownloader:
+        fake_api_arguments.setdefault("page_size", 2)
+        api = api_class(load_search_results(fixture_path), **fake_api_arguments)
+        downloader = PixivDownloader(database="Tests", api=api,
+                                     credentials_path=Path(self.credentials_directory.name) / "credentials.json")
+        self.downloaders.append(downloader)
+        return downloader
+
+    def test_crawl_continues_where_it_stopped(self):
+        downloader = self.create_downloader()
+
+        downloader.add_new_images_to_db("猫", 3)
+        self.assertTrue(downloader.db.return_images_row_count() == 3)
+        self.assertTrue(downloader.db.return_offsets() == {"猫": 3})
+        self.assertTrue(downloader.db.return_image_count(tags=["black cat"]) == 1)
+
+        # the rest of the second page is kept, only the third page is requested
+        downloader.add_new_images_to_db("猫", 3)
+        self.assertTrue(downloader.api.search_calls == 3)
+        self.assertTrue(downloader.db.return_images_row_count() == 5)
+        # the end of the results resets the offset
+        self.assertTrue(downloader.db.return_offsets() == {"猫": 0})
+
+        image_data = downloader.db.return_image(tags=["cat"], safety_level=1)
+        self.assertTrue(image_data["pixiv_image_id"] == 88233902)
+        self.assertTrue(Path(image_data["upload_file_path"]).read_bytes() == downloader.api.image_bytes)
+
+    def test_one_page_feeds_several_downloads(self):
+        downloader = self.create_downloader(page_size=30)
+        downloader.add_new_images_to_db("猫", 2)
+        downloader.add_new_images_to_db("猫", 2)
+
+        self.assertTrue(downloader.api.search_calls == 1)
+        self.assertTrue(downloader.db.return_images_row_count() == 4)
+        self.assertTrue(downloader.db.return_offsets() == {"猫": 4})
+
+    def test_pages_are_followed_up_to_pages_per_download(self):
+        downloader = self.create_downloader(page_size=1)
+        downloader.add_new_images_to_db("猫", 5)
+
+        # the next_url of every page is followed, but no more than pages_per_download pages per call
+        self.assertTrue(downloader.api.search_calls == downloader.pages_per_download)
+        self.assertTrue(downloader.db.return_images_row_count() == downloader.pages_per_download)
+        self.assertTrue(downloader.db.return_offsets() == {"猫": downloader.pages_per_download})
+
+    def test_known_images_are_skipped(self):
+        downloader = self.create_downloader()
+        downloader.add_new_images_to_db("犬", 5)
+        downloader.add_new_images_to_db("猫", 5)
+
+        self.assertTrue(downloader.api.download_calls == 7)
+        self.assertTrue(downloader.db.return_image_count(tags=["dog", "cat"]) == 1)
+
+    def test_images_of_a_batch_download_concurrently(self):
+        downloader = self.create_downloader(api_class=TrackingPixivAPI, download_latency=0.2)
+        downloader.add_new_images_to_db("猫", 5)
+
+        self.assertTrue(downloader.db.return_images_row_count() == 5)
+        self.assertTrue(downloader.api.max_running_downloads > 1)
+        self.assertTrue(downloader.api.max_running_downloads <= downloader.download_workers)
+
+    def test_a_failed_download_skips_only_its_image(self):
+        # the first illustration of the search fails, the ones after it are still downloaded and inserted
+        downloader = self.create_downloader(api_class=TrackingPixivAPI, failing_ids=(88234101,))
+        downloader.add_new_images_to_db("猫", 3)
+
+        self.assertTrue(not downloader.db.check_if_image_exists(88234101))
+        self.assertTrue(downloader.db.check_if_image_exists(88234087))
+        self.assertTrue(downloader.db.check_if_image_exists(88233950))
+        self.assertTrue(downloader.db.return_offsets() == {"猫": 3})
+
+    def test_failed_downloads_restore_the_offset(self):
+        downloader = self.create_downloader(download_error_rate=1.0)
+        downloader.add_new_images_to_db("猫", 3)
+
+        self.assertTrue(downloader.db.return_images_row_count() == 0)
+        self.assertTrue(downloader.offsets["猫"] == 0)
+        self.assertTrue(list(Path(downloader.image_store.images_directory_path).rglob(".*.tmp")) == [])
+
+    def test_a_failed_crawl_keeps_the_offset_of_the_inserted_images(self):
+        downloader = self.create_downloader(api_class=FailingSearchPixivAPI)
+        downloader.add_new_images_to_db("猫", 3)
+
+        # the illustrations of the first page were downloaded, but never inserted
+        self.assertTrue(downloader.db.return_images_row_count() == 0)
+        self.assertTrue(downloader.db.return_offsets() == {"猫": 0})
+        for pixiv_image_id in [88234101, 88234087]:
+            self.assertTrue(list(downloader.image_store.images_directory_path.rglob(str(pixiv_image_id) + ".*")) == [])
+
+        # the next call crawls them again
+        downloader.api.successful_search_calls = 3
+        downloader.add_new_images_to_db("猫", 3)
+        self.assertTrue(downloader.db.check_if_image_exists(88234101))
+        self.assertTrue(downloader.db.return_offsets() == {"猫": 3})
+
+    def test_search_errors_download_nothing(self):
+        downloader = self.create_downloader(search_error_rate=1.0)
+        downloader.add_new_images_to_db("猫", 3)
+
+        self.assertTrue(downloader.api.download_calls == 0)
+        self.assertTrue(downloader.db.return_images_row_count() == 0)
+
+    def test_search_image_links(self):
+        downloader = self.create_downloader()
+        # only the first page is searched
+        self.assertTrue(downloader.search_image_links("猫", 0) == ["https://www.pixiv.net/en/artworks/88234101",
+                                                                  "https://www.pixiv.net/en/artworks/88234087"])
+        self.assertTrue(downloader.search_image_links("犬", 1) == [])
+
+        downloader.api.search_error_rate = 1.0
+        with self.assertRaises(PixivError):
+            downloader.search_image_links("猫", 0)
@@ -0,0 +1,77 @@
+import functools
+import sqlite3
+import tempfile
+from pathlib import Path
+from unittest import TestCase
+
+from Bot.Pixiv.Source.pixiv_db import PixivDB
+from Bot.Pixiv.Source.pixiv_fake_api import FakePixivAPI, load_search_results
+from Bot.Pixiv.Source.pixiv_fetcher_pool import PixivFetcherPool
+from Bot.Pixiv.Tests.pixiv_test_db import reset_test_db
+
+fixture_path = Path(__file__).parent / "Fixtures" / "search_illust.json"
+
+
+class TestPixivFetcherPool(TestCase):
+    def setUp(self):
+        reset_test_db()
+
+        self.credentials_directory = tempfile.TemporaryDirectory()
+        api_factory = functools.partial(FakePixivAPI, load_search_results(fixture_path), page_size=2)
+        self.pool = PixivFetcherPool("Tests", ["token0", "token1"], Path(self.credentials_directory.name),
+                                     api_factory=api_factory)
+
+    def tearDown(self):
+        self.pool.close()
+
+        db = PixivDB(database="Tests")
+        db.cursor.execute("SELECT file_path, upload_file_path FROM Images")
+        for row in db.cursor.fetchall():
+            for file_path in [row["file_path"], row["upload_file_path"]]:
+                if file_path is not None:
+                    Path(file_path).unlink(missing_ok=True)
+        for shard in db.image_store.images_directory_path.iterdir():
+            if shard.is_dir() and not any(shard.iterdir()):
+                shard.rmdir()
+        db.connections.close()
+
+        self.credentials_directory.cleanup()
+
+    def test_workers_commit_through_the_pool(self):
+        cats = self.pool.submit(0, "猫", 3)
+        dogs = self.pool.submit(1, "犬", 5)
+        self.assertTrue(cats.result(timeout=60) == 3)
+        self.assertTrue(dogs.result(timeout=60) == 0)
+
+        self.assertTrue(self.pool.db.return_image_count(tags=["black cat"]) == 1)
+        self.assertTrue(self.pool.db.return_image_count(tags=["dog"]) == 2)
+        self.assertTrue(self.pool.db.return_offsets() == {"猫": 3, "犬": 0})
+
+        # the other worker continues the crawl of 猫 from the committed offset
+        self.assertTrue(self.pool.submit(1, "猫", 3).result(timeout=60) == 0)
+        self.assertTrue(self.pool.db.return_images_row_count() == 7)
+        self.assertTrue(Path(self.credentials_directory.name, "credentials-worker1.json").exists())
+
+    def test_a_failed_insert_keeps_the_committed_offset(self):
+        insert_images = self.pool.db.insert_images
+        insert_calls = []
+
+        def fail_first_insert(images_to_add: list, offsets: dict = None):
+            insert_calls.append(offsets)
+            if len(insert_calls) == 1:
+                raise sqlite3.OperationalError("disk I/O error")
+            insert_images(images_to_add, offsets)
+
+        self.pool.db.insert_images = fail_first_insert
+        with self.assertRaises(RuntimeError):
+            self.pool.submit(0, "猫", 3).result(timeout=60)
+
+        # the files of the failed insert are gone and the offset wasn't advanced past its images
+        self.assertTrue(self.pool.db.return_images_row_count() == 0)
+        self.assertTrue(self.pool.db.return_offsets() == {})
+        self.assertTrue(list(self.pool.db.image_store.images_directory_path.rglob("88234101.*")) == [])
+
+        # the next job crawls them again
+        self.assertTrue(self.pool.submit(1, "猫", 3).result(timeout=60) == 3)
+        self.assertTrue(self.pool.db.check_if_image_exists(88234101))
+        self.assertTrue(self.pool.db.return_offsets() == {"猫": 3})
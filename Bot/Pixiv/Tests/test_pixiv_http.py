@@ -0,0 +1,126 @@
+import ssl
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import TestCase
+
+import requests
+
+from Bot.Pixiv.Source.pixiv_http import ConnectionStats, mount_pooled_adapter, raise_for_image_errors
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    # keep-alive needs HTTP/1.1
+    protocol_version = "HTTP/1.1"
+    failures_left = 0
+
+    def do_GET(self):
+        if ImageHandler.failures_left > 0:
+            ImageHandler.failures_left -= 1
+            status, body = 503, b"busy"
+        else:
+            status, body = 200, b"image"
+
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Records the statuses the adapter reports, every request has to take a token first
+class RecordingRateLimiter:
+    def __init__(self):
+        self.tokens = 0
+        self.statuses = []
+
+    def bucket_for(self, url: str):
+        return self
+
+    def acquire(self):
+        self.tokens += 1
+
+    def record_response(self, bucket, response):
+        self.statuses.append(response.status_code)
+
+
+class TestPixivHttp(TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), ImageHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:" + str(self.server.server_address[1]) + "/img.jpg"
+
+        self.stats = ConnectionStats()
+        self.session = requests.Session()
+        self.adapter = mount_pooled_adapter(self.session, self.stats, pool_maxsize=2, retries=2)
+        # don't wait in between retries
+        self.adapter.backoff_factor = 0
+
+    def tearDown(self):
+        self.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+        ImageHandler.failures_left = 0
+
+    def test_connections_are_reused(self):
+        for _ in range(10):
+            self.assertTrue(self.session.get(self.url).content == b"image")
+
+        self.assertTrue(self.stats.requests == 10)
+        self.assertTrue(self.stats.connections == 1)
+        self.assertTrue(self.stats.reuse_ratio() == 0.9)
+
+    def test_parallel_requests_share_the_pool(self):
+        threads = [threading.Thread(target=lambda: [self.session.get(self.url) for _ in range(5)]) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # the pool blocks instead of opening more than pool_maxsize connections
+        self.assertTrue(self.stats.requests == 20)
+        self.assertTrue(self.stats.connections <= 2)
+
+    def test_server_errors_are_retried(self):
+        ImageHandler.failures_left = 2
+        self.assertTrue(self.session.get(self.url).status_code == 200)
+
+        ImageHandler.failures_left = 5
+        # the last response is returned instead of raising
+        self.assertTrue(self.session.get(self.url).status_code == 503)
+
+    def test_retries_go_through_the_rate_limiter(self):
+        rate_limiter = RecordingRateLimiter()
+        self.adapter.rate_limiter = rate_limiter
+        ImageHandler.failures_left = 2
+
+        self.assertTrue(self.session.get(self.url).status_code == 200)
+        self.assertTrue(rate_limiter.tokens == 3)
+        self.assertTrue(rate_limiter.statuses == [503, 503, 200])
+        # the failed responses gave their connection back
+        self.assertTrue(self.stats.connections == 1)
+
+    def test_the_tls_setup_of_the_session_is_kept(self):
+        # cloudscraper's adapter carries the pinned ciphers in its ssl_context
+        session = requests.Session()
+        ssl_context = ssl.create_default_context()
+        adapter = requests.adapters.HTTPAdapter()
+        adapter.ssl_context = ssl_context
+        session.mount("https://", adapter)
+
+        pooled_adapter = mount_pooled_adapter(session, ConnectionStats())
+        self.assertTrue(pooled_adapter.poolmanager.connection_pool_kw["ssl_context"] is ssl_context)
+        session.close()
+
+    def test_image_errors_raise(self):
+        self.session.hooks["response"].append(raise_for_image_errors)
+        ImageHandler.failures_left = 5
+        # only i.pximg.net responses are checked, pixivpy reads the API errors itself
+        self.assertTrue(self.session.get(self.url).status_code == 503)
+
+        response = requests.Response()
+        response.status_code = 403
+        response.url = "https://i.pximg.net/c/540x540_70/img.jpg"
+        with self.assertRaises(requests.HTTPError):
+            raise_for_image_errors(response)
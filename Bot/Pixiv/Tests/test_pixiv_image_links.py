@@ -0,0 +1,87 @@
+import asyncio
+import threading
+import time
+from unittest import IsolatedAsyncioTestCase
+
+from Bot.Pixiv.Source.pixiv_image_links import ImageLinkFetcher
+
+
+# Stands in for PixivDownloader.search_image_links, a search blocks for latency seconds
+class SlowSearch:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.fail = False
+
+    def search_image_links(self, tag: str, safety_level: int) -> list:
+        with self.lock:
+            self.calls += 1
+        time.sleep(self.latency)
+        if self.fail:
+            raise ConnectionError()
+        if tag == "unknown":
+            return []
+        return ["https://www.pixiv.net/en/artworks/" + str(safety_level)]
+
+
+class TestImageLinkFetcher(IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.search = SlowSearch(latency=0.2)
+        self.fetcher = ImageLinkFetcher(self.search, ttl=60)
+
+    async def asyncTearDown(self):
+        self.fetcher.close()
+
+    async def test_concurrent_misses_share_one_search(self):
+        links = await asyncio.gather(*[self.fetcher.fetch_single_image_link("cat", 1) for _ in range(5)])
+
+        self.assertTrue(links == ["https://www.pixiv.net/en/artworks/1"] * 5)
+        self.assertTrue(self.search.calls == 1)
+
+    async def test_search_does_not_block_the_event_loop(self):
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        ticker = asyncio.create_task(tick())
+        await self.fetcher.fetch_single_image_link("cat", 0)
+        ticker.cancel()
+
+        self.assertTrue(ticks >= 10)
+
+    async def test_results_are_cached_until_ttl(self):
+        await self.fetcher.fetch_single_image_link("cat", 0)
+        await self.fetcher.fetch_single_image_link("cat", 0)
+        self.assertTrue(self.search.calls == 1)
+        self.assertTrue(self.fetcher.hits == 1)
+
+        # the safety level is part of the key
+        await self.fetcher.fetch_single_image_link("cat", 1)
+        self.assertTrue(self.search.calls == 2)
+
+        self.fetcher.ttl = 0
+        await self.fetcher.fetch_single_image_link("dog", 0)
+        await self.fetcher.fetch_single_image_link("dog", 0)
+        self.assertTrue(self.search.calls == 4)
+
+    async def test_empty_results_are_cached(self):
+        link = await self.fetcher.fetch_single_image_link("unknown", 1)
+        self.assertTrue(link == "No nsfw images with this tag exist currently.")
+
+        await self.fetcher.fetch_single_image_link("unknown", 1)
+        self.assertTrue(self.search.calls == 1)
+
+    async def test_failures_are_not_cached(self):
+        self.search.fail = True
+        link = await self.fetcher.fetch_single_image_link("cat", 0)
+        self.assertTrue(link == "Pixiv can't be reached right now, please try again later.")
+
+        self.search.fail = False
+        link = await self.fetcher.fetch_single_image_link("cat", 0)
+        self.assertTrue(link == "https://www.pixiv.net/en/artworks/0")
+        self.assertTrue(self.search.calls == 2)
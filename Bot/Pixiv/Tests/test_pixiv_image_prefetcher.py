@@ -0,0 +1,98 @@
+import asyncio
+import tempfile
+import threading
+from pathlib import Path
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import patch
+
+from Bot.Pixiv.Source.pixiv_db_async import AsyncPixivDB
+from Bot.Pixiv.Source.pixiv_image_prefetcher import ImagePrefetcher
+from Bot.Pixiv.Tests.pixiv_test_db import reset_test_db
+
+
+class TestImagePrefetcher(IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.async_db = AsyncPixivDB(database="Tests", max_workers=2)
+
+        db = self.async_db.pixiv_db
+        reset_test_db(db)
+
+        self.images_directory = tempfile.TemporaryDirectory()
+        images_to_add = []
+        for pixiv_image_id in range(1, 41):
+            file_path = Path(self.images_directory.name) / (str(pixiv_image_id) + ".jpg")
+            file_path.touch()
+            for tag in ["red", "blue" if pixiv_image_id <= 10 else "green"]:
+                images_to_add.append({"file_path": str(file_path), "pixiv_image_id": pixiv_image_id,
+                                      "safety_level": 0, "artist": 1, "tag": tag})
+        db.insert_images(images_to_add)
+
+        self.prefetcher = ImagePrefetcher(self.async_db, max_keys=2, buffer_size=8, refill_threshold=3)
+
+    async def asyncTearDown(self):
+        self.prefetcher.close()
+        self.async_db.close()
+        self.images_directory.cleanup()
+
+    async def test_hot_key_is_served_from_buffer(self):
+        first_image = await self.prefetcher.return_image(["blue", "red"], 0)
+        self.assertTrue(first_image["pixiv_image_id"] <= 10)
+        self.assertTrue(self.prefetcher.misses == 1)
+
+        # tag order doesn't matter
+        for _ in range(30):
+            image = await self.prefetcher.return_image(["red", "blue", "red"], 0)
+            self.assertTrue(image["pixiv_image_id"] <= 10)
+            # let background refills run
+            await asyncio.sleep(0.01)
+
+        self.assertTrue(self.prefetcher.misses == 1)
+        self.assertTrue(self.prefetcher.hits == 30)
+
+    async def test_unknown_tag_returns_empty(self):
+        self.assertTrue(await self.prefetcher.return_image(["unknown"], 0) == {})
+        self.assertTrue(await self.prefetcher.return_image(["red"], 1) == {})
+        self.assertTrue(len(self.prefetcher.buffers) == 0)
+
+    async def test_least_recently_used_key_is_evicted(self):
+        await self.prefetcher.return_image(["red"], 0)
+        await self.prefetcher.return_image(["blue"], 0)
+        await self.prefetcher.return_image(["red"], 0)
+        await self.prefetcher.return_image(["green"], 0)
+
+        self.assertTrue(list(self.prefetcher.buffers) == [(("red",), 0), (("green",), 0)])
+
+    async def test_deleted_images_are_not_served(self):
+        await self.prefetcher.return_image(["blue"], 0)
+
+        await self.async_db.remove_tag_and_delete_from_file_system("blue", nsfw_only=False)
+        self.prefetcher.invalidate()
+
+        self.assertTrue(await self.prefetcher.return_image(["blue"], 0) == {})
+        self.assertTrue((await self.prefetcher.return_image(["red"], 0))["pixiv_image_id"] > 10)
+
+    async def test_missing_files_are_skipped(self):
+        # every refill holds all blue images
+        self.prefetcher.buffer_size = 20
+        await self.prefetcher.return_image(["blue"], 0)
+        for pixiv_image_id in range(1, 10):
+            (Path(self.images_directory.name) / (str(pixiv_image_id) + ".jpg")).unlink()
+
+        for _ in range(5):
+            image = await self.prefetcher.return_image(["blue"], 0)
+            self.assertTrue(image["pixiv_image_id"] == 10)
+            await asyncio.sleep(0.01)
+
+    async def test_files_are_checked_off_the_event_loop(self):
+        checking_threads = []
+
+        def is_file(file_path: str) -> bool:
+            checking_threads.append(threading.current_thread())
+            return Path(file_path).is_file()
+
+        with patch("os.path.isfile", is_file):
+            for _ in range(5):
+                await self.prefetcher.return_image(["red"], 0)
+
+        self.assertTrue(len(checking_threads) == 5)
+        self.assertTrue(threading.current_thread() not in checking_threads)
@@ -0,0 +1,82 @@
+import hashlib
+import sqlite3
+import tempfile
+from pathlib import Path
+from unittest import TestCase
+
+from Bot.Pixiv.Source.pixiv_db_initializer import initialize_image_table
+from Bot.Pixiv.Source.pixiv_image_store import ImageStore, rehome_images
+
+
+class TestImageStore(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.images_directory_path = Path(self.directory.name) / "Images"
+        self.store = ImageStore(self.images_directory_path, shard_count=256)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_images_are_sharded_by_id(self):
+        self.assertTrue(self.store.path(1234, "jpg") == self.images_directory_path / "d2" / "1234.jpg")
+        self.assertTrue(self.store.path(1234 + 256, "png").parent.name == "d2")
+        self.assertTrue(ImageStore(self.images_directory_path).shard(4095) == "fff")
+
+    def test_write_stores_file_and_checksum(self):
+        file_path, checksum = self.store.write(1234, "jpg", lambda file: file.write(b"image"))
+
+        self.assertTrue(Path(file_path).read_bytes() == b"image")
+        self.assertTrue(checksum == hashlib.sha256(b"image").hexdigest())
+        self.assertTrue(self.store.verify(file_path, checksum))
+        self.assertFalse(self.store.verify(file_path, hashlib.sha256(b"other").hexdigest()))
+
+    def test_failed_write_leaves_nothing_behind(self):
+        file_path, _ = self.store.write(1234, "jpg", lambda file: file.write(b"image"))
+
+        def fail(file):
+            file.write(b"partial")
+            raise ConnectionError()
+
+        with self.assertRaises(ConnectionError):
+            self.store.write(1234, "jpg", fail)
+        with self.assertRaises(ConnectionError):
+            self.store.write(5678, "jpg", fail)
+
+        # the old file is untouched and no temporary files are left
+        self.assertTrue(Path(file_path).read_bytes() == b"image")
+        self.assertTrue([path.name for path in self.images_directory_path.rglob("*") if path.is_file()]
+                        == ["1234.jpg"])
+
+    def test_delete(self):
+        file_path, _ = self.store.write(1234, "jpg", lambda file: file.write(b"image"))
+        self.assertTrue(self.store.delete(file_path))
+        self.assertFalse(self.store.delete(file_path))
+
+    def test_rehome_images_moves_flat_files(self):
+        db_file_path = Path(self.directory.name) / "pixiv.db"
+        initialize_image_table(str(db_file_path))
+
+        self.images_directory_path.mkdir()
+        flat_file_path = self.images_directory_path / "1234.jpg"
+        flat_file_path.write_bytes(b"image")
+        stored_file_path, stored_checksum = self.store.write(5678, "png", lambda file: file.write(b"new"))
+
+        conn = sqlite3.connect(str(db_file_path))
+        conn.executemany(
+            "INSERT INTO Images (pixiv_image_id, file_path, safety_level, artist, checksum) VALUES (?,?,?,?,?)",
+            [(1234, str(flat_file_path), 0, 1, None),
+             (5678, stored_file_path, 0, 1, stored_checksum),
+             (9999, str(self.images_directory_path / "9999.jpg"), 0, 1, None)]
+        )
+        conn.commit()
+
+        self.assertTrue(rehome_images(db_file_path, self.store) == (1, 1))
+        # a second run has nothing left to move
+        self.assertTrue(rehome_images(db_file_path, self.store) == (0, 1))
+
+        rows = dict(conn.execute("SELECT pixiv_image_id, file_path FROM Images").fetchall())
+        conn.close()
+        self.assertFalse(flat_file_path.exists())
+        self.assertTrue(rows[1234] == str(self.store.path(1234, "jpg")))
+        self.assertTrue(Path(rows[1234]).read_bytes() == b"image")
+        self.assertTrue(rows[5678] == stored_file_path)
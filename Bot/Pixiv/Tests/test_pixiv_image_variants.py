@@ -0,0 +1,47 @@
+import os
+import random
+import tempfile
+from pathlib import Path
+from unittest import TestCase
+
+from PIL import Image
+
+from Bot.Pixiv.Source.pixiv_image_variants import encode_upload_variant
+
+
+class TestImageVariants(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+        # noise doesn't compress, so the png is far above any small budget
+        random.seed(0)
+        self.png_path = str(Path(self.directory.name) / "1.png")
+        image = Image.frombytes("RGB", (540, 540), bytes(random.getrandbits(8) for _ in range(540 * 540 * 3)))
+        image.save(self.png_path)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_large_images_are_reencoded_within_budget(self):
+        byte_budget = 64 * 1024
+        variant = encode_upload_variant(self.png_path, byte_budget)
+
+        self.assertTrue(variant is not None)
+        self.assertTrue(len(variant) <= byte_budget)
+        variant_path = Path(self.directory.name) / "1.upload.webp"
+        variant_path.write_bytes(variant)
+        with Image.open(variant_path) as image:
+            self.assertTrue(image.format == "WEBP")
+
+    def test_small_images_keep_the_original(self):
+        self.assertTrue(encode_upload_variant(self.png_path, os.path.getsize(self.png_path)) is None)
+
+    def test_transparency_is_kept(self):
+        rgba_path = str(Path(self.directory.name) / "2.png")
+        Image.new("RGBA", (540, 540), (255, 0, 0, 0)).save(rgba_path)
+
+        variant = encode_upload_variant(rgba_path, 1)
+        variant_path = Path(self.directory.name) / "2.upload.webp"
+        variant_path.write_bytes(variant)
+        with Image.open(variant_path) as image:
+            self.assertTrue(image.mode == "RGBA")
@@ -0,0 +1,92 @@
+from types import SimpleNamespace
+from unittest import TestCase
+
+from Bot.Pixiv.Source.pixiv_rate_limiter import AdaptiveTokenBucket, PixivRateLimiter
+
+
+# Time only moves when the bucket sleeps or the test advances it
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.now += seconds
+
+
+def response(status_code: int, headers: dict = None):
+    return SimpleNamespace(status_code=status_code, ok=status_code < 400, headers=headers or {})
+
+
+class TestPixivRateLimiter(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.bucket = AdaptiveTokenBucket("test", rate=10, capacity=5, min_rate=1, max_rate=20, additive_increase=1,
+                                          clock=self.clock, sleep=self.clock.sleep)
+
+    def test_burst_then_steady_rate(self):
+        for _ in range(5):
+            self.bucket.acquire()
+        self.assertTrue(self.clock.now == 0)
+
+        for _ in range(10):
+            self.bucket.acquire()
+        self.assertTrue(abs(self.clock.now - 1.0) < 1e-9)
+
+    def test_throttle_halves_rate_once_per_burst(self):
+        self.bucket.on_throttle()
+        self.bucket.on_throttle()
+        self.assertTrue(self.bucket.rate == 5)
+
+        self.clock.now += 1
+        self.bucket.on_throttle()
+        self.assertTrue(self.bucket.rate == 2.5)
+
+        for _ in range(100):
+            self.bucket.on_throttle()
+            self.clock.now += 1
+        self.assertTrue(self.bucket.rate == 1)
+
+    def test_throttle_drops_burst(self):
+        self.bucket.on_throttle()
+        self.bucket.acquire()
+        self.assertTrue(abs(self.clock.now - 1 / 5) < 1e-9)
+
+    def test_retry_after_pauses_requests(self):
+        self.bucket.on_throttle(retry_after=3)
+        self.bucket.acquire()
+        self.assertTrue(self.clock.now > 3)
+
+    def test_success_increases_rate_up_to_max_rate(self):
+        # additive_increase per second of traffic at the current rate
+        for _ in range(10):
+            self.bucket.on_success()
+        self.assertTrue(10.9 < self.bucket.rate < 11)
+
+        for _ in range(1000):
+            self.bucket.on_success()
+        self.assertTrue(self.bucket.rate == 20)
+
+    def test_limiter_routes_by_host(self):
+        limiter = PixivRateLimiter(search_rate=1, download_rate=10)
+        self.assertTrue(limiter.bucket_for("https://app-api.pixiv.net/v1/search/illust") is limiter.search)
+        self.assertTrue(limiter.bucket_for("https://oauth.secure.pixiv.net/auth/token") is limiter.search)
+        self.assertTrue(limiter.bucket_for("https://i.pximg.net/c/540x540_70/img.jpg") is limiter.download)
+
+    def test_limiter_reacts_to_status_codes(self):
+        limiter = PixivRateLimiter(search_rate=1, download_rate=10)
+
+        limiter.record_response(limiter.download, response(404))
+        self.assertTrue(limiter.download.rate == 10)
+
+        limiter.record_response(limiter.download, response(429, {"Retry-After": "2"}))
+        self.assertTrue(limiter.download.rate == 5)
+        self.assertTrue(limiter.download.tokens <= -10)
+
+        limiter.record_response(limiter.search, response(403))
+        self.assertTrue(limiter.search.rate == 0.5)
+
+        limiter.record_response(limiter.search, response(200))
+        self.assertTrue(limiter.search.rate > 0.5)
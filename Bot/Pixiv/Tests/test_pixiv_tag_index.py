@@ -0,0 +1,78 @@
+from unittest import TestCase
+
+from Bot.Pixiv.Source.pixiv_db import PixivDB
+from Bot.Pixiv.Source.pixiv_tag_index import ImageIdSet
+from Bot.Pixiv.Tests.pixiv_test_db import reset_test_db
+
+
+def example_image(pixiv_image_id: int, safety_level: int, tag: str) -> dict:
+    return {"file_path": "filepath" + str(pixiv_image_id), "pixiv_image_id": pixiv_image_id,
+            "safety_level": safety_level, "artist": 123400 + pixiv_image_id, "tag": tag}
+
+
+class TestTagIndex(TestCase):
+    def setUp(self):
+        # stands in for the fetcher process, it writes without an index
+        self.fetcher_db = PixivDB(database="Tests")
+        reset_test_db(self.fetcher_db)
+
+        # image 1: red blue     sfw
+        # image 2: green        nsfw
+        # image 3: red blue     nsfw
+        self.fetcher_db.insert_images([
+            example_image(1, 0, "red"), example_image(1, 0, "blue"),
+            example_image(2, 1, "green"),
+            example_image(3, 1, "red"), example_image(3, 1, "blue"),
+        ])
+
+        self.db = PixivDB(database="Tests", use_tag_index=True)
+
+    def test_image_id_set(self):
+        image_set = ImageIdSet()
+        for pixiv_image_id in [1, 2, 3, 2]:
+            image_set.add(pixiv_image_id)
+        image_set.discard(1)
+        image_set.discard(4)
+
+        self.assertTrue(len(image_set) == 2)
+        self.assertTrue(sorted(image_set) == [2, 3])
+        self.assertTrue(image_set.random_choice() in (2, 3))
+
+    def test_matches_sql(self):
+        sql_db = self.fetcher_db
+        for tags in [["red"], ["green"], ["red", "blue"], ["red", "green"], ["red", "red"], ["yellow"]]:
+            self.assertTrue(self.db.return_image_count(list(tags)) == sql_db.return_image_count(list(tags)))
+
+        self.assertTrue(self.db.return_image(tags=["red", "blue"], safety_level=0)["pixiv_image_id"] == 1)
+        self.assertTrue(self.db.return_image(tags=["red", "blue"], safety_level=1)["pixiv_image_id"] == 3)
+        self.assertFalse(self.db.return_image(tags=["red", "green"], safety_level=1))
+        self.assertFalse(self.db.return_image(tags=["yellow"], safety_level=1))
+
+    def test_picks_up_inserts_of_other_connections(self):
+        self.fetcher_db.insert_images([example_image(4, 0, "green"), example_image(4, 0, "red")])
+
+        self.assertTrue(self.db.return_image_count(["green"]) == 2)
+        self.assertTrue(self.db.return_image(tags=["green", "red"], safety_level=0)["pixiv_image_id"] == 4)
+
+    def test_deletes_update_index(self):
+        self.db.remove_tag_and_delete_from_file_system(tag="red", nsfw_only=False)
+
+        self.assertTrue(self.db.return_image_count(["blue"]) == 0)
+        self.assertFalse(self.db.return_image(tags=["red"], safety_level=0))
+
+        # rowids of deleted rows are handed out again, the index still has to see the new rows
+        self.fetcher_db.insert_images([example_image(5, 0, "red"), example_image(5, 0, "blue")])
+        self.assertTrue(self.db.return_image_count(["red", "blue"]) == 1)
+
+    def test_lookups_switch_to_the_index_once_it_is_loaded(self):
+        db = PixivDB(database="Tests")
+        self.assertTrue(db.tag_index is None)
+        self.assertTrue(db.return_image_count(["red", "blue"]) == 2)
+
+        db.load_tag_index()
+        self.assertTrue(db.tag_index is not None)
+        self.assertTrue(db.return_image_count(["red", "blue"]) == 2)
+        self.assertTrue(db.return_image(tags=["red", "blue"], safety_level=1)["pixiv_image_id"] == 3)
+        # 8 bytes per image id
+        self.assertTrue(db.tag_index.image_sets[(db.tag_id_cache["red"], 0)].ids.itemsize == 8)
+        db.connections.close()
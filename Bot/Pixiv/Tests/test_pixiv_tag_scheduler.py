@@ -0,0 +1,166 @@
+import random
+from collections import Counter
+from unittest import TestCase
+
+from Bot.Pixiv.Source.pixiv_tag_scheduler import FenwickTree, TagScheduler
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TestFenwickTree(TestCase):
+    def test_find_matches_the_prefix_sums(self):
+        generator = random.Random(0)
+        tree = FenwickTree()
+        weights = []
+        for _ in range(100):
+            weight = float(generator.randrange(5))
+            tree.append(weight)
+            weights.append(weight)
+        for _ in range(200):
+            index = generator.randrange(len(weights))
+            weights[index] = float(generator.randrange(5))
+            tree.set(index, weights[index])
+
+        self.assertTrue(tree.total() == sum(weights))
+        prefix_sum = 0
+        for index, weight in enumerate(weights):
+            if weight:
+                self.assertTrue(tree.find(prefix_sum) == index)
+                self.assertTrue(tree.find(prefix_sum + weight - 0.5) == index)
+            prefix_sum += weight
+
+    def test_sample_is_weighted(self):
+        tree = FenwickTree()
+        for weight in [1.0, 0.0, 3.0]:
+            tree.append(weight)
+
+        generator = random.Random(0)
+        samples = Counter(tree.sample(generator) for _ in range(4000))
+        self.assertTrue(samples[1] == 0)
+        self.assertTrue(2500 < samples[2] < 3500)
+
+        for index in range(3):
+            tree.set(index, 0.0)
+        self.assertTrue(tree.sample(generator) is None)
+
+
+class TestTagScheduler(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        # one request every 100 / ln 2 seconds asks for about 25 images in an hour
+        self.scheduler = TagScheduler(half_life=100, recrawl_interval=10, stock_scale=30, min_stock=30,
+                                      low_watermark_hours=1, high_watermark_hours=2, clock=self.clock, seed=0)
+
+    def request(self, tag: str, count: int = 1, safety_level: int = 0):
+        for _ in range(count):
+            self.scheduler.request(tag, safety_level)
+
+    def test_tags_below_the_low_watermark_go_first(self):
+        self.scheduler.add_tags({"stocked": (300, 0), "full": (1000, 0)})
+        self.request("once")
+        self.request("twice", 2)
+        self.request("stocked", 3)
+        self.request("full")
+
+        # 3 requests ask for 75 to 150 images, 300 are above the high watermark
+        self.assertTrue(self.scheduler.watermarks(self.scheduler.index("stocked"), 0)[0] > 70)
+        self.assertTrue(self.scheduler.priority_count() == 2)
+        self.assertTrue(self.scheduler.pop_priority() == "twice")
+        self.assertTrue(self.scheduler.pop_priority() == "once")
+        self.assertTrue(self.scheduler.pop_priority() is None)
+        self.assertTrue(self.scheduler.sample() is None)
+        self.assertTrue(not self.scheduler.is_due("full", 0))
+
+    def test_watermarks_are_per_safety_level(self):
+        self.scheduler.add_tags({"cat": (1000, 0)})
+        self.request("cat", 2, safety_level=0)
+        self.assertTrue(self.scheduler.priority_count() == 0)
+
+        self.request("cat", safety_level=1)
+        self.assertTrue(self.scheduler.is_due("cat", 1))
+        self.assertTrue(self.scheduler.pop_priority() == "cat")
+
+        # the new nsfw images satisfy the nsfw requests
+        self.clock.now += 10
+        self.scheduler.update_stock("cat", (1000, 60))
+        self.assertTrue(self.scheduler.next_tag() is None)
+
+    def test_watermarks_sink_with_the_request_rate(self):
+        self.scheduler.add_tags({"hot": (100, 0)})
+        self.request("hot", 10)
+        self.assertTrue(self.scheduler.priority_count() == 1)
+
+        # 10 requests four half lives ago ask for less than the 100 images
+        self.clock.now += 400
+        self.assertTrue(self.scheduler.pop_priority() is None)
+        self.assertTrue(self.scheduler.sample() is None)
+
+    def test_downloaded_tags_wait_for_the_recrawl_interval(self):
+        self.request("cat")
+        self.assertTrue(self.scheduler.next_tag() == "cat")
+        self.assertTrue(self.scheduler.is_cooling("cat"))
+        self.assertTrue(not self.scheduler.is_due("cat", 0))
+        self.assertTrue(self.scheduler.next_tag() is None)
+
+        self.clock.now += 10
+        self.assertTrue(self.scheduler.is_due("cat", 0))
+        self.assertTrue(self.scheduler.next_tag() == "cat")
+        self.assertTrue(self.scheduler.download_count("cat") == 2)
+
+    def test_tags_without_demand_are_never_sampled(self):
+        self.scheduler.add_tags({"cat": (0, 0), "dog": (0, 0)})
+        self.assertTrue(self.scheduler.next_tag() is None)
+
+    def test_sampling_follows_the_score(self):
+        self.scheduler.recrawl_interval = 0
+        self.scheduler.min_stock = 0
+        # every stock lies between the watermarks
+        self.scheduler.add_tags({"cat": (90, 0), "dog": (30, 0), "fox": (150, 0)})
+        self.request("cat", 3)
+        self.request("dog")
+        self.request("fox", 4)
+        self.assertTrue(self.scheduler.priority_count() == 0)
+
+        samples = Counter(self.scheduler.sample() for _ in range(5000))
+        # scores 3 / (1 + 90 / 30), 1 / (1 + 30 / 30) and 4 / (1 + 150 / 30)
+        self.assertTrue(1750 < samples["cat"] < 2150)
+        self.assertTrue(1100 < samples["dog"] < 1500)
+        self.assertTrue(1550 < samples["fox"] < 1950)
+
+    def test_demand_decays(self):
+        self.request("old", 2)
+        self.clock.now += 200
+        self.request("new")
+
+        # 2 requests two half lives ago weigh as much as 0.5 requests now
+        self.assertTrue(self.scheduler.score(self.scheduler.index("new")) ==
+                        2 * self.scheduler.score(self.scheduler.index("old")))
+        self.assertTrue(self.scheduler.pop_priority() == "new")
+
+    def test_renormalize_keeps_the_scores(self):
+        self.request("old")
+        self.clock.now += 100
+        self.request("new")
+        ratio = self.scheduler.score(self.scheduler.index("new")) / self.scheduler.score(self.scheduler.index("old"))
+
+        self.clock.now += 6400
+        self.request("newest")
+        self.assertTrue(self.scheduler.epoch > 1000.0)
+        self.assertTrue(self.scheduler.score(self.scheduler.index("new")) /
+                        self.scheduler.score(self.scheduler.index("old")) == ratio)
+        self.assertTrue(abs(self.scheduler.sampler.total() - sum(self.scheduler.sampler.weights)) < 1e-9)
+        self.assertTrue(self.scheduler.pop_priority() == "newest")
+
+    def test_tags_are_kept_with_the_tag(self):
+        self.scheduler.add_tags({"blue archive": (10, 0)})
+        self.scheduler.request("blue archive cat", 0, ["blue archive", "cat"])
+
+        self.assertTrue(self.scheduler.tags_of("blue archive cat") == ["blue archive", "cat"])
+        self.assertTrue(self.scheduler.tags_of("blue archive") == ["blue archive"])
+        self.assertTrue(self.scheduler.tags_of("dog") == ["dog"])
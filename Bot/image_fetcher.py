@@ -1,18 +1,23 @@
+import asyncio
 import configparser
 import logging
-import random
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing.connection import Listener
 from pathlib import Path
 
 import schedule
 
-from Pixiv.Source.pixiv_db import PixivDB
 from Pixiv.Source.pixiv_downloader import PixivDownloader
+from Pixiv.Source.pixiv_fetcher_pool import PixivFetcherPool
+from Pixiv.Source.pixiv_tag_scheduler import TagScheduler
 
 
 class ImageFetcherService:
-    def __init__(self):
+    # api and credentials_path are passed to the PixivDownloader, for example to run against a FakePixivAPI
+    # With worker_refresh_tokens, or worker_refresh_tokens in the config.ini, one worker process per account crawls,
+    # see PixivFetcherPool. Their credentials are kept next to credentials_path, api_factory creates their apis.
+    def __init__(self, database: str = "Main", api=None, credentials_path: Path = None,
+                 address: tuple = ('localhost', 6000), worker_refresh_tokens: list = None, api_factory=None):
         self.logger = logging.getLogger()
         logging.basicConfig(
             level=logging.INFO,
@@ -25,31 +30,38 @@ class ImageFetcherService:
         config_path = (Path(__file__).parent.absolute() / "config.ini").resolve()
         config.read(str(config_path))
 
-        # Setup Connection
-        address = ('localhost', 6000)
-        listener = Listener(address, authkey=config["process-communication"]["authkey"].encode())
-        self.logger.info("Waiting for connection.." + str(listener.address))
-        self.conn = listener.accept()
-        self.logger.info("Connection accepted from " + str(listener.last_accepted))
-
-        # Setup Downloader
-        self.pixiv_downloader = PixivDownloader(database="Main")
-        self.active_downloads_per_minute = int(config["pixiv"]["active_downloads_per_minute"])
-        self.idle_downloads_per_minute = int(config["pixiv"]["idle_downloads_per_minute"])
+        # Setup Connection, the bot connects in intake()
+        self.listener = Listener(address, authkey=config["process-communication"]["authkey"].encode())
+        self.conn = None
+
+        # Setup Downloader, a pool of workers or a single downloader
+        if worker_refresh_tokens is None:
+            worker_refresh_tokens = config.get("pixiv", "worker_refresh_tokens", fallback="").split()
+        if worker_refresh_tokens:
+            if credentials_path is None:
+                credentials_path = (Path(__file__).parent / 'Pixiv' / 'Resources' / 'credentials.json').resolve()
+            self.pool = PixivFetcherPool(database, worker_refresh_tokens, credentials_path.parent, api_factory)
+            self.pixiv_downloader = None
+            self.db = self.pool.db
+        else:
+            self.pool = None
+            self.pixiv_downloader = PixivDownloader(database=database, api=api, credentials_path=credentials_path)
+            self.db = self.pixiv_downloader.db
+        # the budgets are per account
+        accounts = self.download_worker_count()
+        self.active_downloads_per_minute = accounts * int(config["pixiv"]["active_downloads_per_minute"])
+        self.idle_downloads_per_minute = accounts * int(config["pixiv"]["idle_downloads_per_minute"])
         self.images_per_download = int(config["pixiv"]["images_per_download"])
         self.downloads_left = self.active_downloads_per_minute
 
-        # Keep track of requests and downloads per tag
-        self.amount_of_requests = defaultdict(int)
-        self.amount_of_downloads = defaultdict(int)
-        self.priority_list = []
-
-        # Fetch existing tags and fill the dicts
-        pixiv_db = PixivDB(database="Main")
-        all_tags: list = pixiv_db.return_all_tags()
-        for row in all_tags:
-            self.amount_of_requests[row] = 0
-            self.amount_of_downloads[row] = 0
+        # Keeps track of requests, downloads and stock per tag and picks the tags to download
+        self.scheduler = TagScheduler(half_life=float(config["pixiv"]["demand_half_life_hours"]) * 60 * 60,
+                                      recrawl_interval=float(config["pixiv"]["recrawl_interval_seconds"]),
+                                      stock_scale=self.images_per_download,
+                                      min_stock=int(config["pixiv"]["min_stock"]),
+                                      low_watermark_hours=float(config["pixiv"]["low_watermark_hours"]),
+                                      high_watermark_hours=float(config["pixiv"]["high_watermark_hours"]))
+        self.scheduler.add_tags(self.db.return_tag_image_counts())
 
         # Keeps track how many requests were made for logging
         self.counter = 0
@@ -57,50 +69,154 @@ class ImageFetcherService:
         # Keep track of whether the bot is ideling
         self.bot_is_active = False
 
+        # Tags waiting for or in a download, the queue is created on the loop in run()
+        self.download_queue = None
+        self.queued_tags = set()
+
+    # Intake, the per minute budget reset, the daily stats check, the downloader's scheduled jobs and the download
+    # worker run as independent tasks on one event loop.
+    # Blocking calls (recv, accept, downloads) run on threads, so requests are received the moment the bot sends them,
+    # even in the middle of a long download.
     def start(self):
-        schedule.every().minute.do(self.reset_requests_left)
+        try:
+            asyncio.run(self.run())
+        finally:
+            self.close()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        # intake waits on recv and accept, every download worker on its downloads
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=2 + self.download_worker_count(),
+                                                     thread_name_prefix="Fetcher"))
+        self.download_queue = asyncio.Queue()
+
+        await asyncio.gather(
+            self.intake(),
+            *[self.download_worker(worker_number) for worker_number in range(self.download_worker_count())],
+            self.every(60, self.reset_requests_left),
+            self.every(24 * 60 * 60, self.check_stats),
+            self.every(1, schedule.run_pending)
+        )
 
+    async def every(self, seconds: float, job):
         while True:
-            schedule.run_pending()
-
-            tag = self.conn.recv()
-            self.logger.info("Received tag " + tag)
-
-            # pixivping just makes sure the scheduled tasks are ran
-            if tag == "pixivping":
-                continue
-
-            # Non-Ping message received
-            self.bot_is_active = True
-            self.amount_of_requests[tag] += 1
-
-            # Add new tags to priority list
-            self.add_new_tag_to_priority_list(tag)
-
-            # Only request stuff if the limit isnt reached yet
-            if self.downloads_left > 0:
-
-                # first check if there are items in the priority list
-                if self.priority_list:
-                    tag = self.priority_list[0]
-                    self.priority_list.remove(tag)
-                    self.download_tag(tag)
+            await asyncio.sleep(seconds)
+            try:
+                result = job()
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception as e:
+                self.logger.exception(e)
+
+    # Receives (tags_list, safety_level) from the bot.
+    # A bot that reconnects, after a restart or a reload of the cog, is accepted again.
+    async def intake(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self.logger.info("Waiting for connection.." + str(self.listener.address))
+            self.conn = await loop.run_in_executor(None, self.listener.accept)
+            self.logger.info("Connection accepted from " + str(self.listener.last_accepted))
+
+            while True:
+                try:
+                    message = await loop.run_in_executor(None, self.conn.recv)
+                except (EOFError, OSError):
+                    self.logger.info("Bot disconnected")
+                    self.conn.close()
+                    break
+                except Exception as e:
+                    # a message that can't be unpickled, the next one is read from the same connection
+                    self.logger.exception(e)
+                    continue
+
+                # a bad message is dropped, it must not stop the intake of the next ones
+                if not self.is_valid_message(message):
+                    self.logger.info("Ignored malformed message " + repr(message))
+                    continue
+
+                try:
+                    self.receive_tags(*message)
+                except Exception as e:
+                    self.logger.exception(e)
+
+    # A message is (tags_list, safety_level), a non empty list of tags and safety level 0 or 1
+    @staticmethod
+    def is_valid_message(message) -> bool:
+        if not isinstance(message, tuple) or len(message) != 2:
+            return False
+        tags, safety_level = message
+        return (isinstance(tags, list) and len(tags) > 0 and all(isinstance(tag, str) and tag for tag in tags) and
+                type(safety_level) is int and safety_level in TagScheduler.safety_levels)
+
+    # The tags are searched together, joined by spaces. The scheduler keeps the list, a tag may contain spaces itself.
+    def receive_tags(self, tags: list, safety_level: int):
+        tag = " ".join(tags)
+        self.logger.info("Received tag " + tag + " safety level " + str(safety_level))
+
+        self.bot_is_active = True
+        self.scheduler.request(tag, safety_level, tags)
+
+        # Only request stuff if the limit isnt reached yet
+        if self.downloads_left > 0:
+            # first check if there are tags below their low watermark,
+            # a tag that was just downloaded or has enough images waits
+            priority_tag = self.scheduler.pop_priority()
+            if priority_tag is not None:
+                tag = priority_tag
+            elif not self.scheduler.is_due(tag, safety_level):
+                return
+            else:
+                self.scheduler.scheduled(tag)
+
+            if self.queue_download(tag):
+                self.downloads_left -= 1
+
+    # A tag that is already waiting or downloading isn't queued twice, returns True if the tag was queued
+    def queue_download(self, tag: str) -> bool:
+        if tag in self.queued_tags:
+            return False
+
+        self.queued_tags.add(tag)
+        self.download_queue.put_nowait(tag)
+        return True
+
+    # One download worker per worker of the pool, or a single one for the single downloader.
+    # PixivDownloader downloads the images of a batch in parallel already and keeps crawl state per tag that
+    # concurrent batches of the same tag would race on, so a tag leaves queued_tags only once its download is done.
+    def download_worker_count(self) -> int:
+        if self.pool is not None:
+            return len(self.pool)
+        return 1
+
+    async def download_worker(self, worker_number: int):
+        loop = asyncio.get_running_loop()
+        while True:
+            tag = await self.download_queue.get()
+            self.counter += 1
+            self.logger.info("Starting download #" + str(self.counter) + " tag " + tag)
 
+            try:
+                if self.pool is not None:
+                    await asyncio.wrap_future(self.pool.submit(worker_number, tag, self.images_per_download))
                 else:
-                    self.download_tag(tag)
-
-    def add_new_tag_to_priority_list(self, tag: str):
-        if tag not in self.priority_list and self.amount_of_downloads[tag] == 0:
-            self.priority_list.append(tag)
-            self.logger.info("Priority List " + str(self.priority_list))
-
-    def download_tag(self, tag: str):
-        self.counter += 1
-        self.downloads_left -= 1
-        self.amount_of_downloads[tag] += 1
-
-        self.logger.info("Starting download #" + str(self.counter) + " tag " + tag)
-        self.pixiv_downloader.add_new_images_to_db(tag, self.images_per_download)
+                    await loop.run_in_executor(None, self.pixiv_downloader.add_new_images_to_db, tag,
+                                               self.images_per_download)
+                stock = await loop.run_in_executor(None, self.db.return_image_counts_by_safety,
+                                                   self.scheduler.tags_of(tag))
+                self.scheduler.update_stock(tag, stock)
+            except Exception as e:
+                self.logger.exception(e)
+            finally:
+                self.queued_tags.discard(tag)
+
+    async def check_stats(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.db.check_stats)
+
+    # Lets the workers of the pool finish, the single downloader stops with the process
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
 
     def reset_requests_left(self):
         # Only fetch images while ideling
@@ -109,22 +225,18 @@ class ImageFetcherService:
             self.bot_is_active = False
         else:
             self.logger.info("Not used downloads count " + str(self.downloads_left))
-            self.logger.info("Priority List " + str(self.priority_list))
-            for _ in range(self.idle_downloads_per_minute):
-                self.counter += 1
-                self.logger.info("Starting download #" + str(self.counter))
-
-                # Prefer using items in priority list over random tags
-                if self.priority_list:
-                    tag = self.priority_list[0]
-                    self.priority_list.remove(tag)
-                    self.logger.info("Priority Tag " + tag)
-                else:
-                    tag = random.choices(list(self.amount_of_requests.keys()),
-                                         weights=list(self.amount_of_requests.values()))[0]
-                    self.logger.info("Random Tag " + tag)
-
-                self.pixiv_downloader.add_new_images_to_db(tag, self.images_per_download)
+            self.logger.info("Priority tags " + str(self.scheduler.priority_count()))
+            # downloads slower than a minute would pile up otherwise
+            while self.download_queue.qsize() < self.idle_downloads_per_minute:
+                # new tags first, then tags sampled by their score
+                tag = self.scheduler.next_tag()
+                if tag is None:
+                    break
+                self.logger.info("Scheduled Tag " + tag)
+
+                # a tag the bot just queued isn't queued twice
+                if not self.queue_download(tag):
+                    break
 
         self.logger.info("Reset requests")
         self.downloads_left = self.active_downloads_per_minute